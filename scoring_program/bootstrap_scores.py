@@ -0,0 +1,120 @@
+"""
+Bootstrap confidence intervals of the leaderboard scores. Each leaderboard score is the mean of a per-item score,
+QA accuracy of the per-question correctness, retrieval recall of the per-query hits and CIDEr of the per-clip scores
+(with the document frequencies of the full GT). So each resample of the items only needs the mean of their scores:
+the resamples are drawn as index matrices, reduced with numpy, and spread across worker processes.
+"""
+import multiprocessing
+from os.path import join
+from collections import OrderedDict
+import numpy as np
+from evaluate_tvc import load_eval_res_by_clip, run_in_processes
+from evaluate_vlep import is_array_submission, load_score_submission, load_json, align_ids
+from validate_submission import TASK2SPLIT_FILES, find_submission_path, load_gt_ids, build_qa_gt_ids
+
+# max number of entries of an index matrix, the resamples of a block are drawn in chunks of rows under it
+MAX_INDEX_MATRIX_SIZE = 1 << 22
+# number of resamples of a job of the worker processes, each block has its own seed,
+# so that the results do not depend on the number of processes
+RESAMPLE_BLOCK_SIZE = 1000
+
+
+def resample_means(values, n_resamples, seed):
+    """
+    Args:
+        values: np.array, (n_items, ) float, the score of each item
+        n_resamples: int
+        seed: int
+    Returns:
+        np.array, (n_resamples, ) float, the mean of values over each resample (with replacement) of the items
+    """
+    rng = np.random.RandomState(seed)
+    n_items = len(values)
+    chunk_size = max(1, MAX_INDEX_MATRIX_SIZE // max(n_items, 1))
+    means = []
+    for start in range(0, n_resamples, chunk_size):
+        indices = rng.randint(0, n_items, size=(min(chunk_size, n_resamples - start), n_items))
+        means.append(values[indices].mean(axis=1))
+    return np.concatenate(means) if len(means) > 0 else np.zeros(0)
+
+
+def bootstrap_means(key2values, n_resamples=1000, seed=0, n_processes=None):
+    """
+    Args:
+        key2values: dict, {key, e.g. a task: np.array, (n_items, ) float}, resampled independently
+        n_resamples: int
+        seed: int, the results only depend on it, not on n_processes
+        n_processes: int, max number of worker processes, defaults to the number of CPUs
+    Returns:
+        dict, {key: np.array, (n_resamples, ) float, the mean of each resample of its values}
+    """
+    n_processes = n_processes if n_processes is not None else multiprocessing.cpu_count()
+    keys = sorted(key2values.keys())
+    # (key, values, n_resamples, seed) of each block of resamples
+    blocks = [(key, np.asarray(key2values[key], dtype=np.float64), min(RESAMPLE_BLOCK_SIZE, n_resamples - start))
+              for key in keys for start in range(0, n_resamples, RESAMPLE_BLOCK_SIZE)]
+    seeds = np.random.RandomState(seed).randint(np.iinfo(np.int32).max, size=len(blocks))
+    jobs = [(values, block_size, block_seed) for (_, values, block_size), block_seed in zip(blocks, seeds)]
+
+    block_means = run_in_processes(resample_means, jobs, n_processes)
+
+    key2means = OrderedDict((key, []) for key in keys)
+    for (key, _, _), means in zip(blocks, block_means):
+        key2means[key].append(means)
+    return OrderedDict((key, np.concatenate(means) if len(means) > 0 else np.zeros(0))
+                       for key, means in key2means.items())
+
+
+def get_confidence_interval(means, confidence=0.95):
+    """(low, high) percentile interval of the bootstrap means, rounded as the leaderboard scores"""
+    tail = (1 - confidence) / 2. * 100
+    low, high = np.percentile(means, [tail, 100 - tail])
+    return float("{:.2f}".format(low)), float("{:.2f}".format(high))
+
+
+def load_qa_corrects(task, submit_dir, truth_dir, split_name):
+    """
+    Args:
+        task: str, a QA task
+        submit_dir, truth_dir: str, the submission and GT directories of the task
+        split_name: str, a split of the task, see `validate_submission.TASK2SPLIT_FILES`
+    Returns:
+        np.array, (n_questions, ) bool, whether the submitted answer of each GT question is correct
+    """
+    submission_name, gt_name = [(s, g) for split, s, g in TASK2SPLIT_FILES[task] if split == split_name][0]
+    gt_path = join(truth_dir, gt_name)
+    gt_qid2ans = load_gt_ids(gt_path, "qid2ans", lambda: build_qa_gt_ids(gt_path, task))
+    gt_qids = np.array(list(gt_qid2ans.keys()), dtype=np.int64)
+    gt_ans = np.array(list(gt_qid2ans.values()), dtype=np.int64)
+    submission_path = find_submission_path(submit_dir, submission_name)
+    if is_array_submission(submission_path):
+        qids, scores = load_score_submission(submission_path)
+        pred_indices, _ = align_ids(gt_qids, qids)
+        pred_ans = scores[pred_indices].argmax(axis=1)
+    else:
+        submission = {int(k): int(v) for k, v in load_json(submission_path).items()}
+        pred_ans = np.array([submission[qid] for qid in gt_qids.tolist()], dtype=np.int64)
+    return gt_ans == pred_ans
+
+
+def load_task_item_scores(task, task_type, split_name, output_dir, submit_dir, truth_dir, recall_topks=(1, 5, 10)):
+    """
+    Args:
+        task: str
+        task_type: str, one of ["vcmr", "vr", "qa", "captioning"]
+        split_name: str, the split of the task
+        output_dir: str, the output directory of the task, with the per-query ranks (retrieval)
+            or per-clip scores (captioning) saved by its evaluation
+        submit_dir, truth_dir: str, the submission and GT directories of the task, for QA
+        recall_topks: the ks of the leaderboard recalls, the retrieval score is their average
+    Returns:
+        np.array, (n_items, ) float, the x100 score of each item, their mean is the leaderboard score of the task
+    """
+    if task_type == "qa":
+        return load_qa_corrects(task, submit_dir, truth_dir, split_name).astype(np.float64) * 100
+    if task_type == "captioning":
+        clip_scores = load_eval_res_by_clip(join(output_dir, "{}_{}_clip_scores.npz".format(task, split_name)))
+        return np.asarray(clip_scores["CIDEr"], dtype=np.float64) * 100
+    with np.load(join(output_dir, "{}_{}_query_ranks.npz".format(task, split_name))) as data:
+        ranks = data["VCMR_0.7_r" if task_type == "vcmr" else "VR_r"]
+    return np.mean([ranks <= k for k in recall_topks], axis=0) * 100
@@ -5,10 +5,13 @@ import os
 import sys
 import json
 import time
+import multiprocessing
 from os.path import join
+from collections import OrderedDict
+import numpy as np
 from evaluate_how2qa import eval_how2qa
 from evaluate_how2r import eval_how2r
-from evaluate_tvc import eval_tvc
+from evaluate_tvc import eval_tvc, PTBTokenizer, MeteorPool, SegmentStatsCache
 from evaluate_tvqa import eval_tvqa
 from evaluate_tvr import eval_tvr
 from evaluate_vatex_en_c import eval_vatex_en_c
@@ -17,6 +20,8 @@ from evaluate_violin import eval_violin
 from evaluate_vlep import eval_vlep
 from evaluate_yc2c import eval_yc2c
 from evaluate_yc2r import eval_yc2r
+from validate_submission import validate_submission
+from bootstrap_scores import bootstrap_means, get_confidence_interval, load_task_item_scores
 
 
 TASK2EVAL_FUNC = dict(
@@ -41,6 +46,14 @@ TYPE2TASKS = dict(
     captioning=["yc2c", "tvc", "vatex_en_c"]  #
 )
 
+# the metrics read by `gather_all_task_scores`, the only ones computed by the evaluators unless all the metrics
+# are requested, see `eval_main`. The QA tasks only compute their accuracy.
+TYPE2LEADERBOARD_METRICS = dict(
+    vcmr=["VCMR/0.7_r1", "VCMR/0.7_r5", "VCMR/0.7_r10"],
+    vr=["VR/r1", "VR/r5", "VR/r10"],
+    captioning=["CIDEr"]
+)
+
 TASK2TYPE = {}
 for task_type, tasks in TYPE2TASKS.items():
     for t in tasks:
@@ -162,6 +175,54 @@ def gather_all_task_scores(output_root_dir, split_name="val"):
     return all_metrics
 
 
+def bootstrap_all_task_scores(output_root_dir, submit_dir, gt_dir, split_name="val", n_resamples=1000,
+                              confidence=0.95, seed=0, n_processes=None):
+    """ confidence intervals of the scores of `gather_all_task_scores`, the items (questions, queries or clips)
+    of each task are resampled, and the task scores of each resample are averaged the same way.
+    The per-item scores are read from the outputs saved with `save_query_ranks` and `save_clip_scores`.
+    Args:
+        output_root_dir, submit_dir, gt_dir: str, see `eval_main`
+        split_name: str, one of ["val", "test"]
+        n_resamples: int
+        confidence: float, the interval covers this fraction of the resampled scores
+        seed: int
+        n_processes: int, see `bootstrap_scores.bootstrap_means`
+    Returns:
+        dict, same structure as the `gather_all_task_scores` output plus the overall "average",
+            with a {"low": float, "high": float} interval for each score
+    """
+    evaluated_tasks = list(set(get_all_subdir_names(output_root_dir)) & set(TASK2TYPE.keys()))
+    task2values = {}
+    for task in evaluated_tasks:
+        task2values[task] = load_task_item_scores(
+            task, TASK2TYPE[task], TASK2SPLIT_NAME[split_name][task],
+            join(output_root_dir, task), join(submit_dir, task), join(gt_dir, task))
+    task2means = bootstrap_means(task2values, n_resamples=n_resamples, seed=seed, n_processes=n_processes)
+
+    # the (n_resamples, ) scores of each task and average, in the same order as `gather_all_task_scores`
+    all_means = {}
+    for task_group, task_types in [("retrieval", ["vr", "vcmr"]), ("qa", ["qa"]), ("captioning", ["captioning"])]:
+        group_means = OrderedDict(
+            (task, task2means[task]) for t in task_types for task in TYPE2TASKS[t] if task in task2means)
+        if len(group_means) > 0:
+            group_means["average"] = np.mean(list(group_means.values()), axis=0)
+        else:
+            group_means["{}-average".format(task_group)] = np.zeros(n_resamples)
+        all_means[task_group] = group_means
+
+    all_intervals = {}
+    for task_group, group_means in all_means.items():
+        all_intervals[task_group] = {}
+        for task, means in group_means.items():
+            low, high = get_confidence_interval(means, confidence=confidence)
+            all_intervals[task_group][task] = dict(low=low, high=high)
+    low, high = get_confidence_interval(
+        np.mean([means for group_means in all_means.values() for means in group_means.values()], axis=0),
+        confidence=confidence)
+    all_intervals["average"] = dict(low=low, high=high)
+    return all_intervals
+
+
 def get_all_subdir_names(root_dir_path):
     subdir_paths = os.listdir(root_dir_path)
     subdir_names = [os.path.basename(p) for p in subdir_paths]
@@ -176,6 +237,22 @@ def eval_main():
     start_time = time.time()
     is_local = True  # set to False when compose bundle
     val_only = True  # if True evaluate on `val` split only, otherwise evaluate on both `val` and `test`
+    # max number of METEOR java processes shared by the captioning tasks, each scores a shard of the captions
+    meteor_pool_size = min(4, multiprocessing.cpu_count())
+    meteor_max_heap = "2G"  # heap cap of each METEOR java process
+    # if True also save the per-clip captioning scores as .npz files, a clip_id array and one array per metric,
+    # see `load_eval_res_by_clip`; all the captioning metrics are then computed, as with full_metrics
+    save_caption_clip_scores = False
+    # if True compute all the metrics of each task, otherwise only the ones of the leaderboard
+    full_metrics = False
+    # if True reuse the captioning sentence stats of the clips scored in previous runs (only when all the
+    # captioning metrics are computed, the leaderboard CIDEr does not use them), see `SegmentStatsCache`
+    cache_caption_stats = True
+    # if True check the submission files of all the tasks before evaluating any of them, see `validate_submission`
+    validate_first = True
+    # if > 0, also save the bootstrap confidence intervals of the leaderboard scores with this many resamples
+    bootstrap_resamples = 0
+    bootstrap_confidence = 0.95
     if is_local:
         gt_dir = sys.argv[1]
         submit_dir = sys.argv[2]
@@ -196,15 +273,51 @@ def eval_main():
     submitted_tasks = list(set(get_all_subdir_names(submit_dir)) & set(TASK2TYPE.keys()))
     print("There are {} submitted tasks in total: {}".format(len(submitted_tasks), submitted_tasks))
 
+    if validate_first:
+        task2errors = validate_submission(submit_dir, gt_dir, submitted_tasks, val_only=val_only)
+        if len(task2errors) > 0:
+            raise ValueError("Invalid submission files, no task is evaluated:\n{}".format("\n".join(
+                ["[{}] {}".format(task, e) for task in sorted(task2errors) for e in task2errors[task]])))
+        print("Submission files of all the tasks are valid")
+
+    # a single tokenizer is shared by all the captioning tasks and splits
+    caption_tokenizer = PTBTokenizer()
+    # and a single pool of METEOR java processes, started on first use
+    meteor_pool = MeteorPool(size=meteor_pool_size, max_heap=meteor_max_heap)
+    # and a single sentence stats cache, written back once all the tasks are evaluated
+    # only used when all the metrics are computed, the cached stats are the ones of BLEU, METEOR and ROUGE-L
+    caption_full_metrics = full_metrics or save_caption_clip_scores
+    caption_stats_cache = SegmentStatsCache() if cache_caption_stats and caption_full_metrics else None
+
     # run evaluation in multi-process.
-    for task in submitted_tasks:
-        task_submission_dir = join(submit_dir, task)
-        task_gt_dir = join(gt_dir, task)
-        task_output_dir = join(output_dir, task)
-        if not os.path.exists(task_output_dir):
-            os.makedirs(task_output_dir)
-        TASK2EVAL_FUNC[task](
-            task_submission_dir, task_gt_dir, task_output_dir, val_only=val_only)
+    # the Java processes are closed even if a task fails, their pipes would keep this process alive
+    try:
+        for task in submitted_tasks:
+            task_submission_dir = join(submit_dir, task)
+            task_gt_dir = join(gt_dir, task)
+            task_output_dir = join(output_dir, task)
+            if not os.path.exists(task_output_dir):
+                os.makedirs(task_output_dir)
+            metrics = None if full_metrics else TYPE2LEADERBOARD_METRICS.get(TASK2TYPE[task])
+            # the bootstrap resamples the per-clip and per-query scores
+            if TASK2TYPE[task] == "captioning":
+                TASK2EVAL_FUNC[task](
+                    task_submission_dir, task_gt_dir, task_output_dir, val_only=val_only,
+                    tokenizer=caption_tokenizer, meteor_pool=meteor_pool,
+                    save_clip_scores=save_caption_clip_scores or bootstrap_resamples > 0,
+                    stats_cache=caption_stats_cache, metrics=None if caption_full_metrics else metrics)
+            elif TASK2TYPE[task] in ["vr", "vcmr"]:
+                TASK2EVAL_FUNC[task](
+                    task_submission_dir, task_gt_dir, task_output_dir, val_only=val_only, metrics=metrics,
+                    save_query_ranks=bootstrap_resamples > 0)
+            else:
+                TASK2EVAL_FUNC[task](
+                    task_submission_dir, task_gt_dir, task_output_dir, val_only=val_only)
+    finally:
+        caption_tokenizer.close()
+        meteor_pool.close()
+    if caption_stats_cache is not None:
+        caption_stats_cache.save()
 
     # gather results
     gathered_scores = {}
@@ -237,6 +350,18 @@ def eval_main():
     with open(gathered_scores_txt_save_path, "w") as f:
         f.write("\n".join(scores_text))
 
+    if bootstrap_resamples > 0:
+        bootstrap_start_time = time.time()
+        score_intervals = {}
+        for split_name in gathered_scores:
+            score_intervals[split_name] = bootstrap_all_task_scores(
+                output_dir, submit_dir, gt_dir, split_name=split_name, n_resamples=bootstrap_resamples,
+                confidence=bootstrap_confidence)
+        with open(join(output_dir, "all_scores_ci.json"), "w") as f:
+            f.write(json.dumps(score_intervals, indent=4))
+        print("Bootstrap confidence intervals of {} resamples computed in {} seconds.".format(
+            bootstrap_resamples, time.time() - bootstrap_start_time))
+
     print("===> Total Evaluation finished in {} seconds.".format(time.time() - start_time))
 
 
@@ -7,6 +7,8 @@ from os.path import join
 import json
 import numpy as np
 import pprint
+from evaluate_vlep import find_submission_path, is_array_submission, load_score_submission, \
+    eval_acc_from_score_arrays, get_acc_breakdowns
 
 
 def load_json(file_path):
@@ -42,7 +44,16 @@ def merge_dicts(list_dicts):
     return result
 
 
-def eval_qa(submission, gt):
+def align_qa_answers(submission, gt):
+    """ GT and submitted answers of the same questions
+    Args:
+        submission: dict, {qid (str): answer (int)}
+        gt: list(dict), GT examples
+    Returns:
+        qids: list(int)
+        gt_array: np.array, (n_questions, ) GT answers of qids
+        submission_array: np.array, (n_questions, ) submitted answers of qids
+    """
     gt_qid2ans = {int(e["qid"]): int(e["answer_idx"]) for e in gt}
     submission_qid2ans = {int(k): int(v) for k, v in submission.items()}
     gt_qids = set(list(gt_qid2ans.keys()))
@@ -55,13 +66,37 @@ def eval_qa(submission, gt):
     for qid in qids:
         gt_array.append(gt_qid2ans[qid])
         submission_array.append(submission_qid2ans[qid])
-    gt_array = np.array(gt_array)
-    submission_array = np.array(submission_array)
+    return qids, np.array(gt_array), np.array(submission_array)
+
+
+def eval_qa(submission, gt):
+    _, gt_array, submission_array = align_qa_answers(submission, gt)
     acc = np.mean(gt_array == submission_array)
     acc = float("{:.2f}".format(100 * acc))
     return acc
 
 
+def eval_qa_breakdowns(submission, gt, breakdown_fields):
+    """ accuracy of the submission grouped by the metadata fields in gt, e.g. ["vid_name"],
+    see `evaluate_vlep.get_acc_breakdowns`
+    Returns:
+        dict, {field: {value: acc}}
+    """
+    qids, gt_array, submission_array = align_qa_answers(submission, gt)
+    gt_qid2data = {int(e["qid"]): e for e in gt}
+    return get_acc_breakdowns(gt_array == submission_array, [gt_qid2data[qid] for qid in qids], breakdown_fields)
+
+
+def eval_qa_scores(qids, scores, gt, breakdown_fields=None):
+    """ evaluate a binary score submission, see `evaluate_vlep.load_score_submission`"""
+    gt_qids = np.array([int(e["qid"]) for e in gt])
+    gt_ans = np.array([int(e["answer_idx"]) for e in gt])
+    assert len(qids) == len(gt_qids) and np.array_equal(np.sort(qids), np.sort(gt_qids)), \
+        "submission question ids (qid) should be the same as GT question ids."
+    return eval_acc_from_score_arrays(gt_qids, gt_ans, qids, scores,
+                                      gt_data=gt, breakdown_fields=breakdown_fields)
+
+
 def get_args():
     import argparse
     parser = argparse.ArgumentParser()
@@ -73,7 +108,7 @@ def get_args():
     return args
 
 
-def eval_how2qa(submit_dir, truth_dir, output_dir, val_only=True):
+def eval_how2qa(submit_dir, truth_dir, output_dir, val_only=True, breakdown_fields=None):
     dataset_name = "how2qa"
     print("Evaluating task {}".format(dataset_name))
 
@@ -90,13 +125,15 @@ def eval_how2qa(submit_dir, truth_dir, output_dir, val_only=True):
     if dataset_name == "how2qa":
         output_path = join(output_dir, "how2qa_metrics.json")
         file_paths = dict(
-            val=dict(submission=join(submit_dir, "how2qa_val_predictions.json"),
-                     solution=join(truth_dir, "how2qa_val_release.jsonl")),
+            val=dict(submission=find_submission_path(submit_dir, "how2qa_val_predictions"),
+                     solution=join(truth_dir, "how2qa_val_release.jsonl"),
+                     output=join(output_dir, "how2qa_val_metrics.json")),
         )
         if not val_only:
             file_paths.update(
-                test_public=dict(submission=join(submit_dir, "how2qa_test_public_predictions.json"),
-                                 solution=join(truth_dir, "how2qa_test_public_gt.jsonl"))
+                test_public=dict(submission=find_submission_path(submit_dir, "how2qa_test_public_predictions"),
+                                 solution=join(truth_dir, "how2qa_test_public_gt.jsonl"),
+                                 output=join(output_dir, "how2qa_test_public_metrics.json"))
             )
     else:
         raise ValueError
@@ -104,9 +141,23 @@ def eval_how2qa(submit_dir, truth_dir, output_dir, val_only=True):
     start_time = time.time()
     output_metrics = {}
     for split_name in file_paths:
-        submission = load_json(file_paths[split_name]["submission"])
+        submission_path = file_paths[split_name]["submission"]
         gt = load_jsonl(file_paths[split_name]["solution"])
-        output_metrics[split_name] = eval_qa(submission, gt)
+        if is_array_submission(submission_path):
+            qids, scores = load_score_submission(submission_path)
+            results = eval_qa_scores(qids, scores, gt, breakdown_fields=breakdown_fields)
+            output_metrics[split_name] = results["qa_acc"]["overall"]
+            save_json_pretty(results, file_paths[split_name]["output"])
+        elif breakdown_fields:
+            submission = load_json(submission_path)
+            acc = eval_qa(submission, gt)
+            output_metrics[split_name] = acc
+            save_json_pretty(dict(qa_acc=dict(overall=acc),
+                                  qa_acc_by_field=eval_qa_breakdowns(submission, gt, breakdown_fields)),
+                             file_paths[split_name]["output"])
+        else:
+            submission = load_json(submission_path)
+            output_metrics[split_name] = eval_qa(submission, gt)
     save_json_pretty(output_metrics, output_path)
     print("Evaluation finished in {} seconds.".format(time.time() - start_time))
 
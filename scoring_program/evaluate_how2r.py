@@ -6,10 +6,11 @@ import os
 from os.path import join
 import time
 import json
+import numpy as np
 from evaluate_tvr import get_args, load_json, eval_retrieval, load_jsonl
 
 
-def eval_how2r(submit_dir, truth_dir, output_dir, val_only=True):
+def eval_how2r(submit_dir, truth_dir, output_dir, val_only=True, metrics=None, save_query_ranks=False):
     dataset_name = "how2r"
     print("Evaluating task {}".format(dataset_name))
 
@@ -43,7 +44,12 @@ def eval_how2r(submit_dir, truth_dir, output_dir, val_only=True):
         submission = load_json(file_paths[split_name]["submission"])
         submission["video2idx"] = video2idx[split_name]
         gt = load_jsonl(file_paths[split_name]["solution"])
-        results = eval_retrieval(submission, gt, iou_thds=(0.5, 0.7), verbose=False, use_desc_type=False)
+        results = eval_retrieval(submission, gt, iou_thds=(0.5, 0.7), verbose=False, use_desc_type=False,
+                                 metrics=metrics, return_hit_ranks=save_query_ranks)
+        if save_query_ranks:
+            results, hit_ranks = results
+            np.savez_compressed(
+                join(output_dir, "{}_{}_query_ranks.npz".format(dataset_name, split_name)), **hit_ranks)
         output_metrics[split_name] = results
 
     with open(output_path, "w") as f:
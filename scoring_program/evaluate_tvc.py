@@ -2,15 +2,40 @@ import os
 import sys
 import json
 import time
+import hashlib
+import tempfile
+import threading
+import traceback
+import multiprocessing
 from os.path import join
+from collections import defaultdict, OrderedDict
+import numpy as np
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 sys.path.insert(0, "./scoring_program")
 sys.path.insert(0, "./pycocoevalcap")
 from pycocoevalcap.bleu.bleu import Bleu
+from pycocoevalcap.bleu.bleu_scorer import BleuScorer, corpus_bleu, cook_refs
 from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer
-from pycocoevalcap.meteor.meteor import Meteor
+from pycocoevalcap.meteor.meteor import Meteor, MeteorPool, METEOR_JAR
 from pycocoevalcap.rouge.rouge import Rouge
-from pycocoevalcap.cider.cider import Cider
+from pycocoevalcap.cider.cider import Cider, CiderReferenceIndex
+from pycocoevalcap.cider.cider_scorer import CiderScorer, compute_cider_sparse
+from pycocoevalcap.cooked_corpus import CookedCorpus, precook
+
+# data derived from the ground-truth captions (tokenized captions, CIDEr reference index) is cached here,
+# keyed by the content of the ground-truth file and the tokenizer version,
+# so that it is computed only once for all the submissions.
+CACHE_DIR = join(os.path.expanduser("~"), ".cache", "value_evaluation")
+# number of clips tokenized and scored at once in the streaming mode, see `TVRCaptionEval.evaluate_streaming`
+STREAM_CHUNK_SIZE = 5000
+# min number of clips per worker process when the clips are split across processes, see `compute_stats`
+MIN_SHARD_SIZE = 500
+# max number of clips kept in the sentence stats cache, see `SegmentStatsCache`
+SEGMENT_STATS_CACHE_SIZE = 200000
 
 
 def remove_nonascii(text):
@@ -22,6 +47,50 @@ def load_jsonl(filename):
         return [json.loads(l.strip("\n")) for l in f.readlines()]
 
 
+def load_pickle(filename):
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def save_pickle(data, filename):
+    """write to a temporary file first, so that readers in other processes never see a partial file"""
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp_filename, "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_filename, filename)
+
+
+def index_jsonl_clip_ids(filename):
+    """{clip_id: byte offset of its line} of a .jsonl file, the last line is kept for repeated clip ids"""
+    offsets = {}
+    offset = 0
+    with open(filename, "r") as f:
+        for line in iter(f.readline, ""):
+            offsets[json.loads(line.strip("\n"))["clip_id"]] = offset
+            offset += len(line)
+    return offsets
+
+
+def load_eval_res_by_clip(filename):
+    """
+    Args:
+        filename: str, .npz file saved by `TVRCaptionEval.save_eval_res_by_clip`
+    Returns:
+        dict, {"clip_id": array, metric: array of the (not x100) scores of each clip}
+    """
+    with np.load(filename) as data:
+        return {k: data[k] for k in data.files}
+
+
+def get_file_hash(filename):
+    """sha1 hex digest of the file content"""
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
 def save_json(data, filename, save_pretty=False, sort_keys=False):
     with open(filename, "w") as f:
         if save_pretty:
@@ -30,6 +99,150 @@ def save_json(data, filename, save_pretty=False, sort_keys=False):
             json.dump(data, f)
 
 
+def run_jobs_in_process(func, jobs, conn):
+    """
+    target of the worker processes of `start_worker_processes`, sends (True, [func(*job) for job in jobs])
+    or (False, traceback) back via conn
+    """
+    try:
+        result = [func(*job) for job in jobs]
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+    else:
+        conn.send((True, result))
+    conn.close()
+
+
+def start_worker_processes(func, jobs, n_processes):
+    """
+    Fork min(n_processes, len(jobs)) worker processes computing func(*job) for the jobs, assigned round-robin.
+    The workers share func and the jobs with this process instead of receiving a pickled copy,
+    only the results are sent back. Fork them before starting any thread.
+    Returns:
+        list((process, conn, job indices)), to give to `join_worker_processes`
+    """
+    n_workers = max(1, min(n_processes, len(jobs)))
+    workers = []
+    for worker_idx in range(n_workers):
+        job_idxs = list(range(worker_idx, len(jobs), n_workers))
+        recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_jobs_in_process, args=(
+            func, [jobs[idx] for idx in job_idxs], send_conn))
+        process.daemon = True
+        process.start()
+        send_conn.close()
+        workers.append((process, recv_conn, job_idxs))
+    return workers
+
+
+def join_worker_processes(workers, n_jobs):
+    """
+    Args:
+        workers: the output of `start_worker_processes`
+        n_jobs: int, number of jobs given to `start_worker_processes`
+    Returns:
+        list, the func(*job) result of each job, in the order of the jobs
+    Raises:
+        RuntimeError with the traceback of each failed worker, once all the workers exited
+    """
+    results = [None] * n_jobs
+    errors = []
+    for process, recv_conn, job_idxs in workers:
+        try:
+            success, result = recv_conn.recv()
+        except EOFError:
+            process.join()
+            success, result = False, "worker process exited with code {}".format(process.exitcode)
+        recv_conn.close()
+        process.join()
+        if success:
+            for idx, job_result in zip(job_idxs, result):
+                results[idx] = job_result
+        else:
+            errors.append(result)
+    if errors:
+        raise RuntimeError("\n".join("worker process failed:\n{}".format(e) for e in errors))
+    return results
+
+
+def run_in_processes(func, jobs, n_processes):
+    """func(*job) for each job, split across up to n_processes worker processes, see `start_worker_processes`.
+    Runs in this process if a single worker would be used. Returns the results in the order of the jobs."""
+    if min(n_processes, len(jobs)) <= 1:
+        return [func(*job) for job in jobs]
+    return join_worker_processes(start_worker_processes(func, jobs, n_processes), len(jobs))
+
+
+def compute_scorer_stats(scorers, gts, preds, clip_ids):
+    """the compute_stats result of each scorer on clip_ids, the job of the scorer worker processes"""
+    return [scorer.compute_stats(gts, preds, clip_ids) for scorer in scorers]
+
+
+class SegmentStatsCache:
+    """
+    Sentence level statistics of the clips scored before, kept across evaluations and submissions in cache_dir:
+    the METEOR stats line, the BLEU counts (as returned by `cook_test`) and the ROUGE-L LCS precision and recall.
+    Submissions often share many captions, e.g. of the same baseline model, those clips are not scored again.
+    An entry is keyed by the hash of the clip id, the tokenized prediction, the tokenized references and the
+    scorer version (tokenizer and METEOR jar), so that it is never reused once the references of the clip or
+    the way they are tokenized or scored change.
+    At most max_size entries are kept, the least recently used ones are evicted first. The file is only
+    loaded on first use, and only written back by `save` if entries were added, so the recency of the
+    entries which were only read is not kept across runs.
+    """
+    VERSION = 2
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size=SEGMENT_STATS_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.cache_path = join(cache_dir, "segment_stats_v{}.pkl".format(self.VERSION))
+        self.max_size = max_size
+        self._entries = None
+        self.modified = False
+
+    @property
+    def entries(self):
+        """{key: (meteor stats, bleu comps, (rouge prec_max, rouge rec_max))}, least recently used first"""
+        if self._entries is None:
+            self._entries = load_pickle(self.cache_path) if os.path.exists(self.cache_path) else OrderedDict()
+        return self._entries
+
+    @classmethod
+    def key(cls, clip_id, prediction, references, version):
+        """
+        Args:
+            clip_id: the clip id
+            prediction: str, the tokenized predicted caption
+            references: list(str), the tokenized ground-truth captions
+            version: str, the version of the tokenizer and the scorers, see `TVRCaptionEval.stats_version`
+        """
+        return hashlib.sha1("\n".join([version, repr(clip_id), prediction] + references)).digest()
+
+    def get(self, key):
+        """the entry of key, None if it is not cached"""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self.modified = True
+
+    def save(self):
+        if not self.modified:
+            return
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            save_pickle(self.entries, self.cache_path)
+            self.modified = False
+        except (IOError, OSError) as e:
+            print("Failed to cache the sentence stats at {}: {}".format(self.cache_path, e))
+
+
 class TVRCaptionEval:
     """
     ground_truth_path: str, .jsonl file path to the ground truth captions
@@ -56,54 +269,606 @@ class TVRCaptionEval:
                 {"desc": "Rachael walks up to Phoebe and Phoebe turns around."}
              ]  # if multiple descriptions are given, only use the first one in the list.
         }
+    tokenizer: PTBTokenizer, shared by the evaluators so that the Java tokenizer is started only once,
+        a new one is created if not given.
+    cache_dir: str, dir to cache the tokenized ground-truth captions and the CIDEr reference index,
+        set to None to disable the cache.
+    parallel: bool, run the scorers concurrently, METEOR in a thread (it waits on its Java process)
+        and the other scorers in worker processes, see `compute_stats`.
+    n_processes: int, max number of worker processes the clips are split across,
+        the number of CPUs by default.
+    meteor_pool: MeteorPool, METEOR Java processes shared by the evaluators,
+        if not given, a Meteor is started for this evaluation and closed after it.
+    streaming: bool, evaluate chunk_size clips at a time instead of loading all the captions,
+        for caption sets that do not fit in memory, see `evaluate_streaming`.
+    stats_cache: SegmentStatsCache, the METEOR, BLEU and ROUGE-L statistics of the clips found in it are reused,
+        the ones of the other clips are added to it, see `compute_cached_scores`. Not used in the streaming mode.
+    metrics: list(str), only compute these metrics among Bleu_1 to Bleu_4, METEOR, ROUGE_L and CIDEr,
+        the scorers of the other ones are not run, e.g. METEOR's Java process is not started.
+        All the metrics are computed by default. Not used in the streaming mode.
     """
 
-    def __init__(self, prediction_path, ground_truth_path):
-        self.ground_truth = self.load_captions(ground_truth_path, is_ground_truth=True)
-        self.prediction = self.load_captions(prediction_path, is_ground_truth=False)
+    def __init__(self, prediction_path, ground_truth_path, tokenizer=None, cache_dir=CACHE_DIR, parallel=True,
+                 meteor_pool=None, streaming=False, chunk_size=STREAM_CHUNK_SIZE, stats_cache=None,
+                 n_processes=None, metrics=None):
+        self.tokenizer = tokenizer if tokenizer is not None else PTBTokenizer()
+        self.meteor_pool = meteor_pool
+        self.prediction_path = prediction_path
+        self.ground_truth_path = ground_truth_path
+        self.cache_dir = cache_dir
+        self.parallel = parallel
+        self.n_processes = n_processes if n_processes is not None else multiprocessing.cpu_count()
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        self.stats_cache = stats_cache
+        self.metrics = metrics
+        self.ground_truth_hash = None
+        self.prediction = None if streaming or prediction_path is None \
+            else self.load_captions(prediction_path, is_ground_truth=False)
         self.eval_res = {}
-        self.eval_res_by_clip = {}  # TODO add eval res by clip
+        # per-clip scores as columns, {"clip_id": array, metric: array of the scores of each clip}
+        self.eval_res_by_clip = {}
 
     @classmethod
-    def load_captions(cls, filename, is_ground_truth=False):
-        captions = load_jsonl(filename)
-        if is_ground_truth:
-            return {c["clip_id"]: [{"caption": remove_nonascii(e["desc"])} for e in c["descs"]] for c in captions}
+    def parse_captions(cls, c, is_ground_truth=False, n_best=False):
+        """
+        (clip_id, list(dict)) of an entry of a caption file, the captions are in the format of the tokenizer.
+        Only the first prediction is kept, unless n_best is True.
+        """
+        if is_ground_truth or n_best:
+            return c["clip_id"], [{"caption": remove_nonascii(e["desc"])} for e in c["descs"]]
         else:
-            return {c["clip_id"]: [{"caption": remove_nonascii(c["descs"][0]["desc"])}] for c in captions}
+            return c["clip_id"], [{"caption": remove_nonascii(c["descs"][0]["desc"])}]
+
+    @classmethod
+    def load_captions(cls, filename, is_ground_truth=False, n_best=False):
+        return dict(cls.parse_captions(c, is_ground_truth=is_ground_truth, n_best=n_best)
+                    for c in load_jsonl(filename))
+
+    @classmethod
+    def iter_caption_chunks(cls, filename, chunk_size, is_ground_truth=False):
+        """yield the captions of chunk_size clips at a time, as returned by `load_captions`"""
+        chunk = {}
+        with open(filename, "r") as f:
+            for line in f:
+                clip_id, captions = cls.parse_captions(json.loads(line.strip("\n")), is_ground_truth=is_ground_truth)
+                chunk[clip_id] = captions
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = {}
+        if len(chunk) > 0:
+            yield chunk
+
+    @classmethod
+    def load_caption_lines(cls, f, offsets, clip_ids, is_ground_truth=False):
+        """
+        Args:
+            f: file object of a .jsonl caption file
+            offsets: dict, {clip_id: byte offset of its line}, see `index_jsonl_clip_ids`
+            clip_ids: list, the clips to read
+        Returns:
+            the captions of clip_ids, as returned by `load_captions`
+        """
+        captions = {}
+        for clip_id in sorted(clip_ids, key=offsets.get):
+            f.seek(offsets[clip_id])
+            _, captions[clip_id] = cls.parse_captions(json.loads(f.readline().strip("\n")),
+                                                      is_ground_truth=is_ground_truth)
+        return captions
+
+    def load_cached_gt_data(self, name, build_func):
+        """
+        Args:
+            name: str, name of the data derived from the ground-truth captions, used in the cache file name
+            build_func: function, computes the data when it is not cached
+        Returns:
+            the data, read from the cache if possible.
+        """
+        if self.cache_dir is None:
+            return build_func()
+
+        if self.ground_truth_hash is None:
+            self.ground_truth_hash = get_file_hash(self.ground_truth_path)
+        cache_path = join(self.cache_dir, "{}_{}_{}.pkl".format(
+            name, self.ground_truth_hash, self.tokenizer.version()))
+        if os.path.exists(cache_path):
+            return load_pickle(cache_path)
+        data = build_func()
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            save_pickle(data, cache_path)
+        except (IOError, OSError) as e:
+            print("Failed to cache {} at {}: {}".format(name, cache_path, e))
+        return data
+
+    def tokenize_ground_truth(self):
+        """
+        Returns:
+            dict, {clip_id: list(str)}, the tokenized ground-truth captions, read from the cache if possible.
+        """
+        return self.load_cached_gt_data("tokenized_gt", lambda: self.tokenizer.tokenize(
+            self.load_captions(self.ground_truth_path, is_ground_truth=True)))
+
+    def load_cider_ref_index(self, gts):
+        """
+        Args:
+            gts: dict, {clip_id: list(str)}, the tokenized ground-truth captions
+        Returns:
+            CiderReferenceIndex of gts, read from the cache if possible.
+        """
+        # the reference side of CIDEr only depends on the ground-truth
+        return self.load_cached_gt_data(
+            "cider_index_v{}".format(CiderReferenceIndex.VERSION), lambda: Cider().build_ref_index(gts))
+
+    def compute_scores(self, scorers, gts, preds):
+        """
+        Args:
+            scorers: list(scorer), objects with `compute_stats(gts, preds, clip_ids)`, `eval_stats(stats)`
+                and `method()`
+            gts: dict, {clip_id: list(str)}, tokenized ground-truth captions
+            preds: dict, {clip_id: list(str)}, tokenized predicted captions
+        Returns:
+            list((score, scores)), the compute_score results, in the order of scorers.
+        """
+        clip_ids = list(gts.keys())
+        stats = self.compute_stats(scorers, gts, preds, clip_ids)
+        return [scorer.eval_stats(scorer_stats) for scorer, scorer_stats in zip(scorers, stats)]
+
+    def compute_stats(self, scorers, gts, preds, clip_ids):
+        """
+        Args:
+            scorers, gts, preds: see `compute_scores`
+            clip_ids: list, the clips to compute the statistics of
+        Returns:
+            list(list), the sentence statistics of each scorer, in the order of clip_ids.
+
+        With self.parallel, the clips are split into contiguous shards of at least MIN_SHARD_SIZE clips,
+        the statistics of the pure-Python scorers on each shard are computed in a forked worker process.
+        The workers share gts, preds and the scorers with this process instead of receiving a pickled copy,
+        only the statistics are sent back. METEOR only feeds its Java processes, it runs in a thread of this process.
+        """
+        if not self.parallel:
+            stats = []
+            for scorer in scorers:
+                print("Computing {} score...".format(scorer.method()))
+                stats.append(scorer.compute_stats(gts, preds, clip_ids))
+            return stats
+
+        stats = [None] * len(scorers)
+        cpu_idxs = [idx for idx, scorer in enumerate(scorers) if not isinstance(scorer, (Meteor, MeteorPool))]
+        cpu_scorers = [scorers[idx] for idx in cpu_idxs]
+        n_shards = max(1, min(self.n_processes, len(clip_ids) // MIN_SHARD_SIZE))
+        shard_size = max(1, -(-len(clip_ids) // n_shards))
+        shard_jobs = [(cpu_scorers, gts, preds, clip_ids[start:start + shard_size])
+                      for start in range(0, max(len(clip_ids), 1), shard_size)]
+        # fork the worker processes before starting any thread, one per shard,
+        # a single shard is computed in this process while METEOR runs in its thread
+        workers = None
+        if len(cpu_scorers) > 0 and len(shard_jobs) > 1:
+            print("Computing {} scores in {} worker processes...".format(
+                ", ".join(scorer.method() for scorer in cpu_scorers), n_shards))
+            workers = start_worker_processes(compute_scorer_stats, shard_jobs, len(shard_jobs))
+
+        errors = []
+
+        def run_scorer_in_thread(idx, scorer):
+            try:
+                stats[idx] = scorer.compute_stats(gts, preds, clip_ids)
+            except Exception:
+                errors.append((scorer.method(), traceback.format_exc()))
+
+        threads = []
+        for idx, scorer in enumerate(scorers):
+            if isinstance(scorer, (Meteor, MeteorPool)):
+                print("Computing {} score in a thread...".format(scorer.method()))
+                thread = threading.Thread(target=run_scorer_in_thread, args=(idx, scorer))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        shard_stats = []
+        if workers is not None:
+            try:
+                shard_stats = join_worker_processes(workers, len(shard_jobs))
+            except RuntimeError as e:
+                errors.append((", ".join(scorer.method() for scorer in cpu_scorers), str(e)))
+        elif len(cpu_scorers) > 0:
+            print("Computing {} scores...".format(", ".join(scorer.method() for scorer in cpu_scorers)))
+            try:
+                shard_stats = [compute_scorer_stats(*shard_jobs[0])]
+            except Exception:
+                errors.append((", ".join(scorer.method() for scorer in cpu_scorers), traceback.format_exc()))
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise RuntimeError("\n".join("{} scorer failed:\n{}".format(m, e) for m, e in errors))
+        # the stats of each scorer, concatenated in the order of the shards
+        for i, idx in enumerate(cpu_idxs):
+            stats[idx] = [stat for result in shard_stats for stat in result[i]]
+        return stats
+
+    def compute_cached_scores(self, scorers, gts, preds):
+        """
+        Same results as `compute_scores` with the Bleu, METEOR, Rouge and Cider scorers of `score_predictions`,
+        the METEOR, BLEU and ROUGE-L sentence statistics of the clips found in self.stats_cache are reused
+        instead of computed, the statistics of the other clips are computed and added to it.
+        CIDEr is computed for all the clips.
+        """
+        bleu, meteor, rouge, cider = scorers
+        assert gts.keys() == preds.keys()
+        clip_ids = list(gts.keys())
+        version = self.stats_version()
+        keys = [self.stats_cache.key(clip_id, preds[clip_id][0], gts[clip_id], version) for clip_id in clip_ids]
+        entries = [self.stats_cache.get(key) for key in keys]
+        missing_clip_ids = [clip_id for clip_id, entry in zip(clip_ids, entries) if entry is None]
+        print("Computing the sentence stats of {} clips, {} are cached...".format(
+            len(missing_clip_ids), len(clip_ids) - len(missing_clip_ids)))
+
+        if len(missing_clip_ids) > 0:
+            bleu_stats, meteor_stats, rouge_stats = self.compute_stats(
+                [bleu, meteor, rouge], gts, preds, missing_clip_ids)
+            missing_entries = iter(zip(meteor_stats, bleu_stats, rouge_stats))
+            for idx in range(len(clip_ids)):
+                if entries[idx] is None:
+                    entries[idx] = next(missing_entries)
+                    self.stats_cache.put(keys[idx], entries[idx])
+
+        return [
+            bleu.eval_stats([bleu_comps for _, bleu_comps, _ in entries]),
+            meteor.eval_stats([meteor_stat for meteor_stat, _, _ in entries]),
+            rouge.eval_stats([rouge_stats for _, _, rouge_stats in entries]),
+            cider.compute_score(gts, preds),
+        ]
+
+    def stats_version(self):
+        """str, the version of the tokenizer and the METEOR jar the cached sentence statistics depend on"""
+        return "{}|{}|{}".format(self.tokenizer.version(), METEOR_JAR, SegmentStatsCache.VERSION)
+
+    def save_eval_res_by_clip(self, filename):
+        """save the per-clip scores to a .npz file with one array per column, see `load_eval_res_by_clip`.
+        Only the computed metrics have a column, e.g. CIDEr alone with the leaderboard metrics."""
+        np.savez_compressed(filename, **self.eval_res_by_clip)
 
     def evaluate(self):
+        if self.streaming:
+            return self.evaluate_streaming()
+
         # =================================================
         # Tokenization
         # =================================================
         print("Tokenization")
-        tokenizer = PTBTokenizer()
-        gts = tokenizer.tokenize(self.ground_truth)
-        preds = tokenizer.tokenize(self.prediction)
+        gts = self.tokenize_ground_truth()
+        preds = self.tokenizer.tokenize(self.prediction)
+        cider_ref_index = self.load_cider_ref_index(gts) if self.is_requested("CIDEr") else None
+
+        meteor = None
+        if self.is_requested("METEOR"):
+            meteor = self.meteor_pool if self.meteor_pool is not None else Meteor()
+        try:
+            self.eval_res, self.eval_res_by_clip = self.score_predictions(gts, preds, cider_ref_index, meteor)
+        finally:
+            if meteor is not None and self.meteor_pool is None:
+                meteor.close()
+
+    def is_requested(self, metric):
+        """whether metric is computed, see metrics"""
+        return self.metrics is None or metric in self.metrics
+
+    def score_predictions(self, gts, preds, cider_ref_index, meteor, cooked_refs=None):
+        """
+        Args:
+            gts: dict, {clip_id: list(str)}, the tokenized ground-truth captions
+            preds: dict, {clip_id: list(str)}, the tokenized predicted captions
+            cider_ref_index: CiderReferenceIndex of gts, None if CIDEr is not requested
+            meteor: Meteor or MeteorPool, None if METEOR is not requested
+            cooked_refs: dict, the cooked references of gts (`CookedCorpus.refs`), cooked here if not given
+        Returns:
+            eval_res: dict, {metric: score x100}
+            eval_res_by_clip: dict, {"clip_id": array, metric: array of the scores of each clip}
+        """
+        # n-gram counts shared by Bleu and Cider
+        cooked_corpus = CookedCorpus(gts, preds, refs=cooked_refs)
 
         # =================================================
         # Setup scorers
         # =================================================
         print("Setting up scorers...")
         scorers = [
-            (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
-            (Meteor(), "METEOR"),
+            (Bleu(4, cooked_corpus=cooked_corpus), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
+            (meteor, "METEOR"),
             (Rouge(), "ROUGE_L"),
-            (Cider(), "CIDEr"),
+            (Cider(ref_index=cider_ref_index, cooked_corpus=cooked_corpus), "CIDEr"),
             # (Spice(), "SPICE")
         ]
+        if self.metrics is not None:
+            scorers = [(scorer, method) for scorer, method in scorers
+                       if any(self.is_requested(m) for m in (method if isinstance(method, list) else [method]))]
 
         # =================================================
         # Compute scores
         # =================================================
-        for scorer, method in scorers:
-            print("Computing {} score...".format(scorer.method()))
-            score, scores = scorer.compute_score(gts, preds)
+        # the cached entries hold the sentence stats of all the scorers
+        if self.stats_cache is not None and self.metrics is None:
+            results = self.compute_cached_scores([scorer for scorer, _ in scorers], gts, preds)
+        else:
+            results = self.compute_scores([scorer for scorer, _ in scorers], gts, preds)
+        # all the scorers return the clip scores in the order of gts.keys()
+        eval_res = {}
+        eval_res_by_clip = {"clip_id": np.array(list(gts.keys()))}
+        for (scorer, method), (score, scores) in zip(scorers, results):
             if isinstance(method, list):
                 for sc, scs, m in zip(score, scores, method):
-                    self.eval_res[m] = float("{:.2f}".format(sc * 100))
+                    if not self.is_requested(m):
+                        continue
+                    eval_res[m] = float("{:.2f}".format(sc * 100))
+                    eval_res_by_clip[m] = np.array(scs, dtype=np.float64)
             else:
-                self.eval_res[method] = float("{:.2f}".format(score * 100))
+                eval_res[method] = float("{:.2f}".format(score * 100))
+                eval_res_by_clip[method] = np.array(scores, dtype=np.float64)
+        return eval_res, eval_res_by_clip
+
+    def evaluate_streaming(self):
+        """
+        Same metrics as `evaluate`, computed in two passes over the caption files, chunk_size clips at a time.
+        The first pass tokenizes the ground-truth captions into a temporary file and counts the CIDEr
+        document frequency of their n-grams. The second pass reads back the tokenized ground-truth,
+        tokenizes the predictions of the same clips and accumulates the corpus statistics of each chunk:
+        the BLEU counts, the METEOR segment statistics and the sums of the ROUGE-L and CIDEr clip scores.
+        Only the prediction line offsets, the document frequency and the METEOR statistics (a short line
+        per clip) are kept across chunks.
+        """
+        print("Indexing predictions")
+        pred_offsets = index_jsonl_clip_ids(self.prediction_path)
+
+        tokenized_gt_file = tempfile.TemporaryFile()
+        meteor = self.meteor_pool if self.meteor_pool is not None else Meteor()
+        try:
+            # =================================================
+            # First pass, tokenization and CIDEr document frequency
+            # =================================================
+            print("Tokenization")
+            document_frequency = defaultdict(float)
+            n_clips = 0
+            n_chunks = 0
+            for gt_chunk in self.iter_caption_chunks(self.ground_truth_path, self.chunk_size, is_ground_truth=True):
+                assert all(clip_id in pred_offsets for clip_id in gt_chunk), \
+                    "submission clip ids should be the same as ground-truth clip ids."
+                gts = self.tokenizer.tokenize(gt_chunk)
+                pickle.dump(gts, tokenized_gt_file, protocol=pickle.HIGHEST_PROTOCOL)
+                for refs in gts.itervalues():
+                    for ngram in set(ngram for ref in refs for ngram in precook(ref)[1]):
+                        document_frequency[ngram] += 1
+                n_clips += len(gts)
+                n_chunks += 1
+            assert n_clips == len(pred_offsets), "submission clip ids should be the same as ground-truth clip ids."
+            ref_len = np.log(float(n_clips))
+
+            # =================================================
+            # Second pass, corpus statistics of each chunk
+            # =================================================
+            print("Computing scores...")
+            bleu_totals = dict(testlen=0, reflen=0, guess=[0] * 4, correct=[0] * 4)
+            meteor_stats = []
+            rouge = Rouge()
+            rouge_sum = 0.
+            cider_sum = 0.
+            tokenized_gt_file.seek(0)
+            with open(self.prediction_path, "r") as pred_file:
+                for _ in range(n_chunks):
+                    gts = pickle.load(tokenized_gt_file)
+                    clip_ids = gts.keys()
+                    preds = self.tokenizer.tokenize(self.load_caption_lines(pred_file, pred_offsets, clip_ids))
+
+                    bleu_scorer = BleuScorer(n=4)
+                    for clip_id in clip_ids:
+                        bleu_scorer += (preds[clip_id][0], gts[clip_id])
+                    bleu_scorer.compute_score(option="closest")
+                    for k in ["testlen", "reflen"]:
+                        bleu_totals[k] += bleu_scorer.totalcomps[k]
+                    for k in ["guess", "correct"]:
+                        bleu_totals[k] = [a + b for a, b in zip(bleu_totals[k], bleu_scorer.totalcomps[k])]
+
+                    meteor_stats.extend(meteor.compute_stats(gts, preds, clip_ids))
+
+                    rouge_sum += sum(rouge.calc_score(preds[clip_id], gts[clip_id]) for clip_id in clip_ids)
+
+                    # the reference vectors of the chunk, weighted by the document frequency of all the clips
+                    cider_ref_index = CiderReferenceIndex(gts, document_frequency=document_frequency, ref_len=ref_len)
+                    cider_sum += compute_cider_sparse(
+                        cider_ref_index, clip_ids, [precook(preds[clip_id][0])[1] for clip_id in clip_ids],
+                        document_frequency=document_frequency).sum()
+
+            meteor_score, _ = meteor.eval_stats(meteor_stats)
+        finally:
+            tokenized_gt_file.close()
+            if self.meteor_pool is None:
+                meteor.close()
+
+        bleu_scores = corpus_bleu(bleu_totals, n=4, verbose=1)
+        for sc, m in zip(bleu_scores, ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]):
+            self.eval_res[m] = float("{:.2f}".format(sc * 100))
+        self.eval_res["METEOR"] = float("{:.2f}".format(meteor_score * 100))
+        self.eval_res["ROUGE_L"] = float("{:.2f}".format(rouge_sum / n_clips * 100))
+        self.eval_res["CIDEr"] = float("{:.2f}".format(cider_sum / n_clips * 100))
+
+
+class OnlineCaptionEval(TVRCaptionEval):
+    """
+    Running BLEU, ROUGE-L and CIDEr of predictions added in batches, e.g. while they are generated during training.
+    The ground-truth is tokenized and the CIDEr reference index (with the document frequency of all the clips)
+    is built once, both read from the cache if possible. Each `add` only scores the clips of the batch and adds
+    their statistics to the running corpus statistics, `evaluate` computes the metrics of the clips added so far.
+    Once all the clips are added, the metrics are the same as TVRCaptionEval's (METEOR is not computed).
+
+    ground_truth_path: str, .jsonl file path to the ground truth captions, see TVRCaptionEval
+    tokenizer: PTBTokenizer, a new one is created if not given.
+    cache_dir: str, see TVRCaptionEval
+    """
+
+    def __init__(self, ground_truth_path, tokenizer=None, cache_dir=CACHE_DIR):
+        TVRCaptionEval.__init__(self, None, ground_truth_path, tokenizer=tokenizer, cache_dir=cache_dir)
+        self.gts = self.tokenize_ground_truth()
+        self.cider_ref_index = self.load_cider_ref_index(self.gts)
+        self.rouge = Rouge()
+        self.evaluated_clip_ids = set()
+        self.bleu_totals = dict(testlen=0, reflen=0, guess=[0] * 4, correct=[0] * 4)
+        self.rouge_sum = 0.
+        self.cider_sum = 0.
+
+    def add(self, predictions):
+        """
+        Args:
+            predictions: dict, {clip_id: str}, generated captions of ground-truth clips not added before
+        """
+        for clip_id in predictions:
+            if clip_id not in self.gts:
+                raise ValueError("clip {} is not in the ground-truth".format(clip_id))
+            if clip_id in self.evaluated_clip_ids:
+                raise ValueError("clip {} is already evaluated".format(clip_id))
+        if len(predictions) == 0:
+            return
+        preds = self.tokenizer.tokenize(
+            {clip_id: [{"caption": remove_nonascii(caption)}] for clip_id, caption in predictions.items()})
+        clip_ids = list(preds.keys())
+
+        bleu_scorer = BleuScorer(n=4)
+        cider_scorer = CiderScorer(ref_index=self.cider_ref_index)
+        for clip_id in clip_ids:
+            bleu_scorer += (preds[clip_id][0], self.gts[clip_id])
+            cider_scorer.append_indexed(preds[clip_id][0], clip_id)
+            self.rouge_sum += self.rouge.calc_score(preds[clip_id], self.gts[clip_id])
+        bleu_scorer.compute_score(option="closest")
+        for k in ["testlen", "reflen"]:
+            self.bleu_totals[k] += bleu_scorer.totalcomps[k]
+        for k in ["guess", "correct"]:
+            self.bleu_totals[k] = [a + b for a, b in zip(self.bleu_totals[k], bleu_scorer.totalcomps[k])]
+        self.cider_sum += cider_scorer.compute_score()[1].sum()
+        self.evaluated_clip_ids.update(clip_ids)
+
+    def evaluate(self):
+        """
+        Returns:
+            dict, the metrics of the clips added so far, also kept in eval_res, empty if no clip is added.
+        """
+        n_clips = len(self.evaluated_clip_ids)
+        if n_clips == 0:
+            return {}
+        bleu_scores = corpus_bleu(self.bleu_totals, n=4)
+        for sc, m in zip(bleu_scores, ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]):
+            self.eval_res[m] = float("{:.2f}".format(sc * 100))
+        self.eval_res["ROUGE_L"] = float("{:.2f}".format(self.rouge_sum / n_clips * 100))
+        self.eval_res["CIDEr"] = float("{:.2f}".format(self.cider_sum / n_clips * 100))
+        return self.eval_res
+
+
+class MultiSystemCaptionEval(TVRCaptionEval):
+    """
+    Evaluate the predictions of several systems (e.g. checkpoints) against the same ground-truth.
+    The reference side, i.e. the tokenized ground-truth, the cooked reference n-grams, the CIDEr reference
+    index and the METEOR java processes, is prepared once and shared by all the systems.
+
+    prediction_paths: dict, {system name: .jsonl file path to the generated captions}
+    ground_truth_path, tokenizer, cache_dir, parallel, stats_cache, n_processes: see TVRCaptionEval
+    meteor_pool: MeteorPool, a new one is started (and closed after the evaluation) if not given.
+    """
+
+    def __init__(self, prediction_paths, ground_truth_path, tokenizer=None, cache_dir=CACHE_DIR, parallel=True,
+                 meteor_pool=None, stats_cache=None, n_processes=None):
+        TVRCaptionEval.__init__(self, None, ground_truth_path, tokenizer=tokenizer, cache_dir=cache_dir,
+                                parallel=parallel, meteor_pool=meteor_pool, stats_cache=stats_cache,
+                                n_processes=n_processes)
+        self.prediction_paths = prediction_paths
+        # {system name: eval_res}, {system name: eval_res_by_clip}
+        self.eval_res = {}
+        self.eval_res_by_clip = {}
+
+    def evaluate(self):
+        """
+        Returns:
+            dict, {system name: {metric: score x100}}, also kept in eval_res
+        """
+        print("Tokenization")
+        gts = self.tokenize_ground_truth()
+        cider_ref_index = self.load_cider_ref_index(gts)
+        cooked_refs = CookedCorpus(gts, {}).refs
+
+        meteor_pool = self.meteor_pool if self.meteor_pool is not None else MeteorPool()
+        try:
+            for name in sorted(self.prediction_paths):
+                print("Evaluating system {}".format(name))
+                preds = self.tokenizer.tokenize(
+                    self.load_captions(self.prediction_paths[name], is_ground_truth=False))
+                self.eval_res[name], self.eval_res_by_clip[name] = self.score_predictions(
+                    gts, preds, cider_ref_index, meteor_pool, cooked_refs=cooked_refs)
+        finally:
+            if self.meteor_pool is None:
+                meteor_pool.close()
+        return self.eval_res
+
+    def save_eval_res_by_clip(self, filename):
+        """save the per-clip scores of each system to filename.format(system name), see TVRCaptionEval"""
+        for name, eval_res_by_clip in self.eval_res_by_clip.items():
+            np.savez_compressed(filename.format(name), **eval_res_by_clip)
+
+
+class NBestCaptionEval(TVRCaptionEval):
+    """
+    Score n-best prediction lists: every caption in "descs" of a prediction is a hypothesis of the clip,
+    instead of only the first one. All the hypotheses are scored in one pass against the references
+    of their clip, which are prepared once per clip: the CIDEr reference vectors come from the reference index,
+    the BLEU reference n-grams are cooked once and shared by the hypotheses.
+    For BLEU-1..4 (sentence level), ROUGE-L and CIDEr, eval_res reports "{metric}_mean", the average over the clips
+    of the mean score of their hypotheses, and "{metric}_oracle", the average of the score of their best hypothesis.
+
+    prediction_path: str, .jsonl file path to the n-best generated captions, same format as in TVRCaptionEval
+    ground_truth_path, tokenizer, cache_dir: see TVRCaptionEval
+    """
+
+    def __init__(self, prediction_path, ground_truth_path, tokenizer=None, cache_dir=CACHE_DIR):
+        TVRCaptionEval.__init__(self, None, ground_truth_path, tokenizer=tokenizer, cache_dir=cache_dir)
+        self.prediction = self.load_captions(prediction_path, is_ground_truth=False, n_best=True)
+
+    def evaluate(self):
+        print("Tokenization")
+        gts = self.tokenize_ground_truth()
+        preds = self.tokenizer.tokenize(self.prediction)
+        assert set(gts.keys()) == set(preds.keys()), \
+            "submission clip ids should be the same as ground-truth clip ids."
+        assert all(len(hyps) > 0 for hyps in preds.values()), "each clip should have at least one prediction."
+        cider_ref_index = self.load_cider_ref_index(gts)
+
+        # the hypotheses of all the clips, clip_ids[i] has n_hyps[i] of them
+        clip_ids = list(gts.keys())
+        n_hyps = np.array([len(preds[clip_id]) for clip_id in clip_ids], dtype=np.int64)
+        hyp_clip_ids = [clip_id for clip_id in clip_ids for _ in preds[clip_id]]
+        hyps = [hyp for clip_id in clip_ids for hyp in preds[clip_id]]
+
+        print("Computing scores...")
+        bleu_scorer = BleuScorer(n=4)
+        for clip_id in clip_ids:
+            crefs = cook_refs(gts[clip_id])
+            for hyp in preds[clip_id]:
+                bleu_scorer.append_cooked_refs(hyp, crefs)
+        _, bleu_scores = bleu_scorer.compute_score(option="closest")
+        rouge = Rouge()
+        rouge_scores = [rouge.calc_score([hyp], gts[clip_id]) for clip_id, hyp in zip(hyp_clip_ids, hyps)]
+        cider_scores = compute_cider_sparse(cider_ref_index, hyp_clip_ids, [precook(hyp)[1] for hyp in hyps])
+
+        hyp_clips = np.repeat(np.arange(len(clip_ids)), n_hyps)
+        self.eval_res_by_clip = {"clip_id": np.array(clip_ids), "n_hyps": n_hyps}
+        for metric, scores in zip(["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4", "ROUGE_L", "CIDEr"],
+                                  bleu_scores + [rouge_scores, cider_scores]):
+            scores = np.array(scores, dtype=np.float64)
+            mean_scores = np.bincount(hyp_clips, weights=scores, minlength=len(clip_ids)) / n_hyps
+            oracle_scores = np.full(len(clip_ids), -np.inf)
+            np.maximum.at(oracle_scores, hyp_clips, scores)
+            self.eval_res["{}_mean".format(metric)] = float("{:.2f}".format(mean_scores.mean() * 100))
+            self.eval_res["{}_oracle".format(metric)] = float("{:.2f}".format(oracle_scores.mean() * 100))
+            self.eval_res_by_clip["{}_mean".format(metric)] = mean_scores
+            self.eval_res_by_clip["{}_oracle".format(metric)] = oracle_scores
+        return self.eval_res
 
 
 def get_args():
@@ -116,7 +881,8 @@ def get_args():
     return args
 
 
-def eval_tvc(submit_dir, truth_dir, output_dir, val_only=True):
+def eval_tvc(submit_dir, truth_dir, output_dir, val_only=True, tokenizer=None, meteor_pool=None,
+             save_clip_scores=False, stats_cache=None, metrics=None):
     dataset_name = "tvc"
     print("Evaluating task {}".format(dataset_name))
 
@@ -142,11 +908,24 @@ def eval_tvc(submit_dir, truth_dir, output_dir, val_only=True):
 
     start_time = time.time()
     output_metrics = {}
+    shared_tokenizer = tokenizer if tokenizer is not None else PTBTokenizer()
+    shared_meteor_pool = meteor_pool if meteor_pool is not None else MeteorPool()
     for split_name in file_paths:
         evaluator = TVRCaptionEval(file_paths[split_name]["submission"],
-                                   file_paths[split_name]["solution"])
+                                   file_paths[split_name]["solution"],
+                                   tokenizer=shared_tokenizer,
+                                   meteor_pool=shared_meteor_pool,
+                                   stats_cache=stats_cache,
+                                   metrics=metrics)
         evaluator.evaluate()
         output_metrics[split_name] = evaluator.eval_res
+        if save_clip_scores:
+            evaluator.save_eval_res_by_clip(
+                join(output_dir, "{}_{}_clip_scores.npz".format(dataset_name, split_name)))
+    if tokenizer is None:
+        shared_tokenizer.close()
+    if meteor_pool is None:
+        shared_meteor_pool.close()
 
     with open(output_path, "w") as f:
         f.write(json.dumps(output_metrics, indent=4))
@@ -5,6 +5,8 @@ import json
 import numpy as np
 import pprint
 from os.path import join
+from evaluate_vlep import find_submission_path, is_array_submission, load_score_submission, \
+    eval_acc_from_score_arrays
 
 
 def load_json(file_path):
@@ -55,6 +57,16 @@ def eval_tvqa_acc(predictions_path, gt_path):
     return float("{:.2f}".format(100 * acc))
 
 
+def eval_tvqa_scores(predictions_path, gt_path):
+    """ evaluate a binary score submission, see `evaluate_vlep.load_score_submission`"""
+    qids, scores = load_score_submission(predictions_path)
+    gt = load_json(gt_path)
+    gt = merge_dicts(list(gt["solution"].values()))
+    gt_qids = np.array([int(k) for k in gt.keys()])
+    gt_answers = np.array([int(v) for v in gt.values()])
+    return eval_acc_from_score_arrays(gt_qids, gt_answers, qids, scores)
+
+
 def get_args():
     import argparse
     parser = argparse.ArgumentParser()
@@ -81,16 +93,18 @@ def eval_tvqa(submit_dir, truth_dir, output_dir, val_only=True):
             output_dir, "{}_metrics.json".format(dataset_name))
         file_paths = dict(
             val=dict(
-                submission=join(submit_dir, "tvqa_val_predictions.json"),
-                solution=join(truth_dir, "tvqa_val_solution.json")
+                submission=find_submission_path(submit_dir, "tvqa_val_predictions"),
+                solution=join(truth_dir, "tvqa_val_solution.json"),
+                output=join(output_dir, "tvqa_val_metrics.json")
             ),
         )
         print("val_only", val_only)
         if not val_only:
             file_paths.update(
                 test=dict(
-                    submission=join(submit_dir, "tvqa_test_predictions.json"),
-                    solution=join(truth_dir, "tvqa_test_solution.json")
+                    submission=find_submission_path(submit_dir, "tvqa_test_predictions"),
+                    solution=join(truth_dir, "tvqa_test_solution.json"),
+                    output=join(output_dir, "tvqa_test_metrics.json")
                 )
             )
     else:
@@ -99,10 +113,18 @@ def eval_tvqa(submit_dir, truth_dir, output_dir, val_only=True):
     output_metrics = {}
     for split_name in file_paths:
         print("split_name ", split_name)
-        output_metrics[split_name] = eval_tvqa_acc(
-            file_paths[split_name]["submission"],
-            file_paths[split_name]["solution"]
-        )
+        if is_array_submission(file_paths[split_name]["submission"]):
+            results = eval_tvqa_scores(
+                file_paths[split_name]["submission"],
+                file_paths[split_name]["solution"]
+            )
+            output_metrics[split_name] = results["qa_acc"]["overall"]
+            save_json_pretty(results, file_paths[split_name]["output"])
+        else:
+            output_metrics[split_name] = eval_tvqa_acc(
+                file_paths[split_name]["submission"],
+                file_paths[split_name]["solution"]
+            )
 
     with open(output_path, "w") as f:
         f.write(json.dumps(output_metrics, indent=4))
@@ -73,6 +73,27 @@ def compute_temporal_iou_batch(preds, gt):
     return np.divide(intersection, union, out=np.zeros_like(intersection), where=union != 0)
 
 
+def get_first_hit_ranks(corrects, ranked=None):
+    """
+    Args:
+        corrects: np.array, (n_desc, n_pred) bool, whether each prediction of each query is positive
+        ranked: np.array, (n_desc, n_pred) bool, the predictions that are ranked, e.g. only the ones of the
+            GT video for SVMR, all of them by default.
+    Returns:
+        np.array, (n_desc, ) float, 1-based rank of the first positive prediction of each query, inf if there is
+            none, so that the query is a hit for R@K if its rank <= K
+    """
+    if ranked is not None:
+        corrects = np.logical_and(corrects, ranked)
+    first_hit = corrects.argmax(axis=1)
+    if ranked is None:
+        ranks = first_hit.astype(np.float64) + 1
+    else:
+        ranks = np.cumsum(ranked, axis=1)[np.arange(len(first_hit)), first_hit].astype(np.float64)
+    ranks[~corrects.any(axis=1)] = np.inf
+    return ranks
+
+
 def get_rounded_percentage(float_number, n_floats=2):
     return round(float_number * 100, n_floats)
 
@@ -86,7 +107,8 @@ TASK_TYPES = OrderedDict([
 
 def eval_by_task_type(moment_predictions, video2idx, ground_truth,
                      iou_thds=(0.5, 0.7), recall_topks=(1, 5, 10, 100),
-                     task_type="SVMR", max_pred_per_query=100, match_number=True, verbose=True, use_desc_type=True):
+                     task_type="SVMR", max_pred_per_query=100, match_number=True, verbose=True, use_desc_type=True,
+                     return_hit_ranks=False):
     """ a predicted triplet is positive only if:
     1) its vid_name matches the GT vid_name
     2) IoU between its timestamp and GT timestamp is higher than the given threshold
@@ -122,7 +144,13 @@ def eval_by_task_type(moment_predictions, video2idx, ground_truth,
         match_number: bool, must set to True if when do evaluation, False is only used for debug.
         verbose:
         use_desc_type: only TVR has desc type
+        return_hit_ranks: bool, if True also return the rank of the first hit of each query, see below
     Returns:
+        metrics: OrderedDict, {metric: recall}
+        metrics_by_type: OrderedDict, the metrics of each desc type, empty if not use_desc_type
+        hit_ranks: OrderedDict, only returned if return_hit_ranks, {"desc_id": (n_desc, ) int array, and
+            for each metric name without its k, e.g. "0.7_r" for VCMR or "r" for VR: (n_desc, ) array,
+            see `get_first_hit_ranks`}. The mean of (ranks <= k) of a query subset is its R@k.
 
     """
     assert task_type in TASK_TYPES, "task_type must be one of {}".format(list(TASK_TYPES.keys()))
@@ -134,6 +162,7 @@ def eval_by_task_type(moment_predictions, video2idx, ground_truth,
     gt_by_desc_id = {int(e["desc_id"]): e for e in ground_truth}
     desc_type2idx = {"v": 0, "t": 1, "vt": 2}
     desc_types = []  # n_desc
+    desc_ids = []  # n_desc
 
     if match_number:
         assert set(gt_by_desc_id.keys()).issubset(set(predictions_by_desc_id.keys())), \
@@ -146,11 +175,12 @@ def eval_by_task_type(moment_predictions, video2idx, ground_truth,
         if not match_number and k not in predictions_by_desc_id:
             continue
         pred_info_matrix = np.array(
-            [e[:3] for e in predictions_by_desc_id[k]["predictions"]][:max_pred_per_query],
+            [e[:3] for e in predictions_by_desc_id[k]["predictions"][:max_pred_per_query]],
             dtype=np.float32)  # (n_pred, 3)
 
         if use_desc_type:
             desc_types.append(desc_type2idx[gt_item["type"]])
+        desc_ids.append(k)
         vid_name_matched_pred = pred_info_matrix[:, 0] == video2idx[gt_item["vid_name"]]  # bool, (n_pred, )
         pred_info_matrix = np.concatenate([pred_info_matrix, vid_name_matched_pred[:, None]], axis=1)  # (n_pred, 4)
 
@@ -258,27 +288,82 @@ def eval_by_task_type(moment_predictions, video2idx, ground_truth,
         metrics_by_type["desc_type_ratio"] = "v {} t {} vt {}"\
             .format(*[get_rounded_percentage(1.0 * np.sum(desc_types == desc_type2idx[k]) / len(desc_types))
                       for k in ["v", "t", "vt"]])
-    return metrics, metrics_by_type
+    if not return_hit_ranks:
+        return metrics, metrics_by_type
+
+    hit_ranks = OrderedDict([("desc_id", np.array(desc_ids, dtype=np.int64))])
+    vid_name_matched = pred_info_matrix_collection[:, :, 3].astype(np.bool)  # (n_desc, n_pred)
+    if task_type == "VR":
+        hit_ranks["r"] = get_first_hit_ranks(vid_name_matched)
+    else:
+        for iou_idx, iou_thd in enumerate(iou_thds):
+            iou_corrects = pred_info_matrix_collection[:, :, iou_c_offset + iou_idx].astype(np.bool)
+            hit_ranks["{}_r".format(iou_thd)] = get_first_hit_ranks(
+                iou_corrects, ranked=vid_name_matched if task_type == "SVMR" else None)
+    return metrics, metrics_by_type, hit_ranks
 
 
-def eval_retrieval(submission, ground_truth, iou_thds=(0.5, 0.7), verbose=True, match_number=True, use_desc_type=True):
+def parse_retrieval_metrics(metrics, task_type, iou_thds=(0.5, 0.7), recall_topks=(1, 5, 10, 100)):
+    """
+    Args:
+        metrics: list(str), metric names "{task_type}/{iou_thd}_r{k}", or "VR/r{k}" for VR, e.g. "VCMR/0.7_r1"
+        task_type: str, one of TASK_TYPES
+        iou_thds, recall_topks: the defaults, used when metrics is None
+    Returns:
+        (iou_thds, recall_topks), the thresholds and top ks to compute for task_type, both empty if
+        metrics has no metric of task_type.
+    """
+    if metrics is None:
+        return iou_thds, recall_topks
+    iou_thds = set()
+    recall_topks = set()
+    for metric in metrics:
+        metric_task_type, name = metric.split("/", 1)
+        if metric_task_type != task_type:
+            continue
+        iou_thd, k = name.split("r", 1)
+        if iou_thd:
+            iou_thds.add(float(iou_thd.rstrip("_")))
+        recall_topks.add(int(k))
+    return tuple(sorted(iou_thds)), tuple(sorted(recall_topks))
+
+
+def eval_retrieval(submission, ground_truth, iou_thds=(0.5, 0.7), verbose=True, match_number=True, use_desc_type=True,
+                   metrics=None, return_hit_ranks=False):
+    """
+    metrics: list(str), only compute these metrics (and the other combinations of their IoU thresholds and top ks),
+        see `parse_retrieval_metrics`. All the metrics are computed by default.
+    return_hit_ranks: bool, if True also return the per-query hit ranks of each task type,
+        {"{task_type}_{name}": array} for each name of the hit_ranks of `eval_by_task_type`, e.g. "VCMR_0.7_r".
+    """
     video2idx = submission["video2idx"]
-    submitted_task_types = [k for k in TASK_TYPES if k in submission]
+    # {task_type: (iou_thds, recall_topks)}
+    task_type2thds_topks = {k: parse_retrieval_metrics(metrics, k, iou_thds=iou_thds) for k in TASK_TYPES}
+    submitted_task_types = [k for k in TASK_TYPES if k in submission and len(task_type2thds_topks[k][1]) > 0]
     if verbose:
         print("Evaluating for task {}".format(submitted_task_types))
     eval_metrics = OrderedDict()
     metrics_raw_dict = {}
+    hit_ranks = OrderedDict()
     for task_type in submitted_task_types:
         task_submission = submission[task_type]
         if task_type == "VR":  # reformat input data
             task_submission = [
                 {"desc_id": d["desc_id"], "predictions": [[e, 0, 0, 0] for e in d["predictions"]]}
                 for d in task_submission]
-        metrics, metrics_by_type = eval_by_task_type(
+        task_iou_thds, recall_topks = task_type2thds_topks[task_type]
+        # VCMR and VR recalls only depend on the top k predictions, SVMR first drops the ones of other videos
+        max_pred_per_query = 100 if task_type == "SVMR" else min(100, max(recall_topks))
+        task_results = eval_by_task_type(
             task_submission, video2idx, ground_truth,
-            iou_thds=iou_thds, recall_topks=(1, 5, 10, 100),
-            task_type=task_type, max_pred_per_query=100,
-            match_number=match_number, verbose=verbose, use_desc_type=use_desc_type)
+            iou_thds=task_iou_thds, recall_topks=recall_topks,
+            task_type=task_type, max_pred_per_query=max_pred_per_query,
+            match_number=match_number, verbose=verbose, use_desc_type=use_desc_type,
+            return_hit_ranks=return_hit_ranks)
+        metrics, metrics_by_type = task_results[:2]
+        if return_hit_ranks:
+            for name, ranks in task_results[2].items():
+                hit_ranks["{}_{}".format(task_type, name)] = ranks
         metrics_raw_dict[task_type] = metrics
         metrics_raw_dict[task_type+"_by_type"] = metrics_by_type
 
@@ -287,6 +372,8 @@ def eval_retrieval(submission, ground_truth, iou_thds=(0.5, 0.7), verbose=True,
     if use_desc_type:
         for task_type in submitted_task_types:
             eval_metrics[task_type+"_by_type"] = metrics_raw_dict[task_type+"_by_type"]
+    if return_hit_ranks:
+        return eval_metrics, hit_ranks
     return eval_metrics
 
 
@@ -301,7 +388,7 @@ def get_args():
     return args
 
 
-def eval_tvr(submit_dir, truth_dir, output_dir, val_only=True):
+def eval_tvr(submit_dir, truth_dir, output_dir, val_only=True, metrics=None, save_query_ranks=False):
     dataset_name = "tvr"
     print("Evaluating task {}".format(dataset_name))
 
@@ -335,7 +422,12 @@ def eval_tvr(submit_dir, truth_dir, output_dir, val_only=True):
         submission = load_json(file_paths[split_name]["submission"])
         submission["video2idx"] = video2idx[split_name]
         gt = load_jsonl(file_paths[split_name]["solution"])
-        results = eval_retrieval(submission, gt, iou_thds=(0.5, 0.7), verbose=False, use_desc_type=False)
+        results = eval_retrieval(submission, gt, iou_thds=(0.5, 0.7), verbose=False, use_desc_type=False,
+                                 metrics=metrics, return_hit_ranks=save_query_ranks)
+        if save_query_ranks:
+            results, hit_ranks = results
+            np.savez_compressed(
+                join(output_dir, "{}_{}_query_ranks.npz".format(dataset_name, split_name)), **hit_ranks)
         output_metrics[split_name] = results
 
     with open(output_path, "w") as f:
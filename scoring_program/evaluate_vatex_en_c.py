@@ -3,10 +3,11 @@ import json
 import time
 from os.path import join
 
-from evaluate_tvc import TVRCaptionEval, get_args
+from evaluate_tvc import TVRCaptionEval, PTBTokenizer, MeteorPool, get_args
 
 
-def eval_vatex_en_c(submit_dir, truth_dir, output_dir, val_only=True):
+def eval_vatex_en_c(submit_dir, truth_dir, output_dir, val_only=True, tokenizer=None, meteor_pool=None,
+                    save_clip_scores=False, stats_cache=None, metrics=None):
     dataset_name="vatex_en_c"
     print("Evaluating task {}".format(dataset_name))
 
@@ -32,11 +33,24 @@ def eval_vatex_en_c(submit_dir, truth_dir, output_dir, val_only=True):
 
     start_time = time.time()
     output_metrics = {}
+    shared_tokenizer = tokenizer if tokenizer is not None else PTBTokenizer()
+    shared_meteor_pool = meteor_pool if meteor_pool is not None else MeteorPool()
     for split_name in file_paths:
         evaluator = TVRCaptionEval(file_paths[split_name]["submission"],
-                                   file_paths[split_name]["solution"])
+                                   file_paths[split_name]["solution"],
+                                   tokenizer=shared_tokenizer,
+                                   meteor_pool=shared_meteor_pool,
+                                   stats_cache=stats_cache,
+                                   metrics=metrics)
         evaluator.evaluate()
         output_metrics[split_name] = evaluator.eval_res
+        if save_clip_scores:
+            evaluator.save_eval_res_by_clip(
+                join(output_dir, "{}_{}_clip_scores.npz".format(dataset_name, split_name)))
+    if tokenizer is None:
+        shared_tokenizer.close()
+    if meteor_pool is None:
+        shared_meteor_pool.close()
 
     with open(output_path, "w") as f:
         f.write(json.dumps(output_metrics, indent=4))
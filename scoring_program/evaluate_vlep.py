@@ -36,7 +36,48 @@ def get_acc_1d_bool_array(array_1d, rounded_percentage=True):
     return get_rounded_percentage(acc) if rounded_percentage else acc
 
 
-def eval_qa_acc(gt_ans, pred_ans):
+MISSING_FIELD_VALUE = "<missing>"
+
+
+def get_breakdown_value(example, field):
+    if field not in example:
+        return MISSING_FIELD_VALUE
+    value = example[field]
+    return json.dumps(value) if isinstance(value, (list, dict)) else value
+
+
+def get_acc_breakdowns(corrects, gt_data, breakdown_fields):
+    """ accuracy grouped by the values of each metadata field.
+    Args:
+        corrects: np.array, (n_examples, ) bool
+        gt_data: list(dict), GT examples aligned with corrects
+        breakdown_fields: list(str), metadata fields in gt_data to group by, e.g. ["vid_name", "tag"]
+
+    Returns:
+        dict, {field: {value: acc}}
+    """
+    breakdown_fields = list(breakdown_fields)
+    if len(breakdown_fields) == 0:
+        return {}
+    # a single pass over the GT to collect all the fields, list values (e.g. `ts`) are grouped as strings,
+    # examples without the field are grouped under MISSING_FIELD_VALUE, other values are kept as they are
+    columns = list(zip(*[[get_breakdown_value(d, f) for f in breakdown_fields] for d in gt_data]))
+    if len(columns) == 0:
+        return {f: {} for f in breakdown_fields}
+    corrects = np.asarray(corrects, dtype=np.float64)
+    breakdowns = {}
+    for field, column in zip(breakdown_fields, columns):
+        # grouped by the original values, np.unique would coerce a column of mixed types to a single dtype
+        value2group_id = {}
+        group_ids = np.array([value2group_id.setdefault(v, len(value2group_id)) for v in column])
+        n_examples = np.bincount(group_ids, minlength=len(value2group_id))
+        n_corrects = np.bincount(group_ids, weights=corrects, minlength=len(value2group_id))
+        breakdowns[field] = {v: get_rounded_percentage(1.0 * n_corrects[i] / n_examples[i])
+                             for v, i in value2group_id.items()}
+    return breakdowns
+
+
+def eval_qa_acc(gt_ans, pred_ans, gt_data=None, breakdown_fields=None):
     eval_res = {}
     gt_ans = np.array(gt_ans)
     pred_ans = np.array(pred_ans)
@@ -45,30 +86,175 @@ def eval_qa_acc(gt_ans, pred_ans):
     eval_res["qa_acc"] = dict(
         overall=get_acc_1d_bool_array(gt_ans == pred_ans, rounded_percentage=True),
     )
+    if breakdown_fields:
+        eval_res["qa_acc_by_field"] = get_acc_breakdowns(gt_ans == pred_ans, gt_data, breakdown_fields)
     return eval_res
 
 
-def eval_acc_from_files(gt_path, submission_path, skip_missing=False):
+ARRAY_SUBMISSION_EXTENSIONS = (".npz", ".npy")
+
+
+def find_submission_path(submit_dir, name):
+    """ return the binary score submission `name`.npz or `name`.npy if one is submitted,
+    otherwise the regular `name`.json answer submission."""
+    for ext in ARRAY_SUBMISSION_EXTENSIONS:
+        path = join(submit_dir, name + ext)
+        if os.path.exists(path):
+            return path
+    return join(submit_dir, name + ".json")
+
+
+def is_array_submission(submission_path):
+    return os.path.splitext(submission_path)[1] in ARRAY_SUBMISSION_EXTENSIONS
+
+
+def load_score_submission(filename):
+    """
+    Args:
+        filename: str, binary multiple choice QA submission, either
+            - .npz file with two arrays, `qid` (n_questions, ) and `scores` (n_questions, n_choices),
+            - .npy file with a single (n_questions, 1 + n_choices) array, the first column is
+              the qid, the remaining columns are the scores of each answer choice.
+            scores can be either logits or probabilities.
+
+    Returns:
+        qids: np.array, (n_questions, ) int
+        scores: np.array, (n_questions, n_choices) float
+    """
+    if filename.endswith(".npz"):
+        data = np.load(filename)
+        qids, scores = data["qid"], data["scores"]
+    else:
+        data = np.load(filename)
+        assert data.ndim == 2 and data.shape[1] > 1, \
+            ".npy submission must be a (n_questions, 1 + n_choices) array"
+        qids, scores = data[:, 0], data[:, 1:]
+    qids = np.asarray(qids).astype(np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+    assert qids.ndim == 1 and scores.ndim == 2 and len(qids) == len(scores), \
+        "qid should be (n_questions, ) and scores should be (n_questions, n_choices), got {} and {}"\
+        .format(qids.shape, scores.shape)
+    return qids, scores
+
+
+def scores_to_probs(scores):
+    """ rows that already are probability distributions are kept, otherwise scores are treated as logits."""
+    if np.all(scores >= 0) and np.allclose(scores.sum(axis=1), 1, atol=1e-3):
+        return scores / scores.sum(axis=1, keepdims=True)
+    exp_scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+    return exp_scores / exp_scores.sum(axis=1, keepdims=True)
+
+
+def align_ids(gt_ids, pred_ids):
+    """
+    Args:
+        gt_ids: np.array, (n_gt, ) int
+        pred_ids: np.array, (n_pred, ) int, unique ids
+
+    Returns:
+        pred_indices: np.array, (n_gt, ) int, index of each GT id in pred_ids, only valid where found is True
+        found: np.array, (n_gt, ) bool
+    """
+    assert len(np.unique(pred_ids)) == len(pred_ids), "duplicated question ids in your predictions."
+    if len(pred_ids) == 0:
+        return np.zeros(len(gt_ids), dtype=np.int64), np.zeros(len(gt_ids), dtype=bool)
+    order = np.argsort(pred_ids)
+    pos = np.minimum(np.searchsorted(pred_ids[order], gt_ids), len(pred_ids) - 1)
+    pred_indices = order[pos]
+    found = pred_ids[pred_indices] == gt_ids
+    return pred_indices, found
+
+
+def get_calibration_metrics(probs, gt_ans, n_bins=15):
+    """ Expected Calibration Error (equal-width confidence bins) and Negative Log-Likelihood.
+    Args:
+        probs: np.array, (n_questions, n_choices)
+        gt_ans: np.array, (n_questions, ) int
+        n_bins: int, number of confidence bins for ECE
+    """
+    confidence = probs.max(axis=1)
+    corrects = (probs.argmax(axis=1) == gt_ans).astype(np.float64)
+    bin_ids = np.minimum((confidence * n_bins).astype(np.int64), n_bins - 1)
+    bin_confidence = np.bincount(bin_ids, weights=confidence, minlength=n_bins)
+    bin_corrects = np.bincount(bin_ids, weights=corrects, minlength=n_bins)
+    ece = divide_with_zero(np.sum(np.abs(bin_corrects - bin_confidence)), len(gt_ans))
+    gt_probs = probs[np.arange(len(gt_ans)), gt_ans]
+    nll = float(np.mean(-np.log(np.maximum(gt_probs, 1e-12)))) if len(gt_ans) > 0 else 0
+    return dict(ece=get_rounded_percentage(ece), nll=round(nll, 4))
+
+
+def eval_acc_from_score_arrays(gt_ids, gt_ans, pred_ids, pred_scores, skip_missing=False,
+                               gt_data=None, breakdown_fields=None):
+    """ accuracy + calibration from aligned arrays, predicted answers are the argmax of pred_scores.
+    Args:
+        gt_ids: np.array, (n_gt, ) int
+        gt_ans: np.array, (n_gt, ) int
+        pred_ids: np.array, (n_pred, ) int
+        pred_scores: np.array, (n_pred, n_choices) float, logits or probabilities
+        skip_missing: bool, if False, raise ValueError when GT ids are missing from pred_ids
+        gt_data: list(dict), GT examples aligned with gt_ids, only needed for breakdown_fields
+        breakdown_fields: list(str), see `get_acc_breakdowns`
+    """
+    gt_ids = np.asarray(gt_ids, dtype=np.int64)
+    gt_ans = np.asarray(gt_ans, dtype=np.int64)
+    pred_indices, found = align_ids(gt_ids, pred_ids)
+    skipped = gt_ids[~found].tolist()
+    if len(skipped) > 0 and not skip_missing:
+        raise ValueError("one id {} from ground-truth file is missing from your predictions.".format(skipped[0]))
+    gt_ans = gt_ans[found]
+    if len(gt_ans) > 0 and gt_ans.max() >= pred_scores.shape[1]:
+        raise ValueError("predictions have {} answer choices, but ground-truth answers go up to {}."
+                         .format(pred_scores.shape[1], gt_ans.max()))
+    print("Evaluating {} examples, missing {}".format(len(gt_ans), len(skipped)))
+    probs = scores_to_probs(pred_scores[pred_indices[found]])
+    if breakdown_fields:
+        gt_data = [gt_data[idx] for idx in np.flatnonzero(found)]
+    results = eval_qa_acc(gt_ans, probs.argmax(axis=1), gt_data=gt_data, breakdown_fields=breakdown_fields)
+    results["calibration"] = get_calibration_metrics(probs, gt_ans)
+    if len(skipped) > 0:
+        results["skipped_samples"] = \
+            "Your predistions missing {} examples: e.g. (only shown 3 here), {}".format(len(skipped), skipped[:3])
+    return results
+
+
+def eval_acc_from_files(gt_path, submission_path, skip_missing=False, breakdown_fields=None):
     # load + preprocess data
     gt_data = load_jsonl(gt_path)
+    if is_array_submission(submission_path):
+        qids, scores = load_score_submission(submission_path)
+        gt_ids = [int(d["example_id"]) for d in gt_data]
+        gt_ans = [int(d["answer"]) for d in gt_data]
+        return eval_acc_from_score_arrays(gt_ids, gt_ans, qids, scores, skip_missing=skip_missing,
+                                          gt_data=gt_data, breakdown_fields=breakdown_fields)
     submission_data = load_json(submission_path)
-    return eval_acc_from_data(gt_data, submission_data, skip_missing=skip_missing)
+    return eval_acc_from_data(gt_data, submission_data, skip_missing=skip_missing, breakdown_fields=breakdown_fields)
 
 
-def eval_acc_from_data(gt_data, submission_data, skip_missing=False):
+def eval_acc_from_data(gt_data, submission_data, skip_missing=False, breakdown_fields=None):
+    """
+    Args:
+        gt_data: list(dict), GT examples
+        submission_data: dict, {example_id (str): answer (int)}
+        skip_missing: bool, if False, raise ValueError when GT examples are missing from the submission
+        breakdown_fields: list(str), metadata fields in gt_data, e.g. ["vid_name", "tag"], accuracy
+            grouped by each of them is returned in `qa_acc_by_field`, see `get_acc_breakdowns`
+    """
     print("Loaded {} GT lines, {} submission lines".format(len(gt_data), len(submission_data)))
 
     gt_id2ans = {int(d["example_id"]): int(d["answer"]) for d in gt_data}
+    gt_id2data = {int(d["example_id"]): d for d in gt_data}
     pred_id2ans = {int(k): int(v) for k, v in submission_data.items()}
     gt_ids = list(gt_id2ans.keys())
 
     pred_ans = []
     gt_ans = []
+    evaluated_gt_data = []
     skipped = []
     for k in gt_ids:
         if k in pred_id2ans:
             pred_ans.append(pred_id2ans[k])
             gt_ans.append(gt_id2ans[k])
+            evaluated_gt_data.append(gt_id2data[k])
         else:
             if skip_missing:
                 skipped.append(k)
@@ -82,7 +268,7 @@ def eval_acc_from_data(gt_data, submission_data, skip_missing=False):
     print("Evaluating {} examples, missing {}"
           .format(len(pred_ans), len(gt_data) - len(pred_ans)))
     # eval + print + save
-    results = eval_qa_acc(gt_ans, pred_ans)
+    results = eval_qa_acc(gt_ans, pred_ans, gt_data=evaluated_gt_data, breakdown_fields=breakdown_fields)
     if len(skipped) > 0:
         results["skipped_samples"] = \
             "Your predistions missing {} examples: e.g. (only shown 3 here), {}".format(len(skipped), skipped[:3])
@@ -100,7 +286,7 @@ def get_args():
     return args
 
 
-def eval_vlep(submit_dir, truth_dir, output_dir, val_only=True):
+def eval_vlep(submit_dir, truth_dir, output_dir, val_only=True, breakdown_fields=None):
     dataset_name = "vlep"
     print("Evaluating task {}".format(dataset_name))
 
@@ -110,13 +296,13 @@ def eval_vlep(submit_dir, truth_dir, output_dir, val_only=True):
     output_path = join(
         output_dir, "{}_metrics.json".format(dataset_name))
     file_paths = dict(
-        dev=dict(submission=join(submit_dir, "vlep_dev_predictions.json"),
+        dev=dict(submission=find_submission_path(submit_dir, "vlep_dev_predictions"),
                  solution=join(truth_dir, "vlep_dev_archive.jsonl"),
                  output=join(output_dir, "vlep_dev_metrics.json")),
     )
     if not val_only:
         file_paths.update(
-            test=dict(submission=join(submit_dir, "vlep_test_predictions.json"),
+            test=dict(submission=find_submission_path(submit_dir, "vlep_test_predictions"),
                       solution=join(truth_dir, "vlep_test_archive.jsonl"),
                       output=join(output_dir, "vlep_test_metrics.json"))
         )
@@ -126,8 +312,11 @@ def eval_vlep(submit_dir, truth_dir, output_dir, val_only=True):
         results = eval_acc_from_files(
             gt_path=file_paths[split_name]["solution"],
             submission_path=file_paths[split_name]["submission"],
-            skip_missing=False)
+            skip_missing=False,
+            breakdown_fields=breakdown_fields)
         output_metrics[split_name] = results["qa_acc"]["overall"]
+        with open(file_paths[split_name]["output"], "w") as f:
+            f.write(json.dumps(results, indent=4))
 
     with open(output_path, "w") as f:
         f.write(json.dumps(output_metrics, indent=4))
@@ -8,21 +8,32 @@
 # Last Modified : Thu 19 Mar 2015 09:13:28 PM PDT
 # Authors : Hao Fang <hfang@uw.edu> and Tsung-Yi Lin <tl483@cornell.edu>
 
-from bleu_scorer import BleuScorer
+from bleu_scorer import BleuScorer, cook_refs, cook_test
 
 
 class Bleu:
-    def __init__(self, n=4):
+    def __init__(self, n=4, cooked_corpus=None):
         # default compute Blue score up to 4
         self._n = n
         self._hypo_for_image = {}
         self.ref_for_image = {}
+        # CookedCorpus of the gts and res, to reuse the n-gram counts shared with the other metrics
+        self._cooked_corpus = cooked_corpus
 
     def compute_score(self, gts, res):
         assert(gts.keys() == res.keys())
         imgIds = gts.keys()
+        stats = self.compute_stats(gts, res, imgIds)
+        return self.eval_stats(stats)
 
-        bleu_scorer = BleuScorer(n=self._n)
+    def compute_stats(self, gts, res, imgIds):
+        # counts of each sentence against its references (see cook_test), in the order of imgIds,
+        # the images can be split in shards whose stats are computed separately
+        cooked = self._cooked_corpus
+        if cooked is not None and not cooked.matches(gts, res, n=self._n):
+            cooked = None
+
+        stats = []
         for id in imgIds:
             hypo = res[id]
             ref = gts[id]
@@ -33,7 +44,19 @@ class Bleu:
             assert(type(ref) is list)
             assert(len(ref) >= 1)
 
-            bleu_scorer += (hypo[0], ref)
+            if cooked is not None:
+                # already cooked sentences, see bleu_scorer.precook
+                hypo = [cooked.tests[id]]
+                ref = cooked.refs[id]
+
+            stats.append(cook_test(hypo[0], cook_refs(ref)))
+        return stats
+
+    def eval_stats(self, stats):
+        # corpus and per image scores of the sentence stats of all the images
+        bleu_scorer = BleuScorer(n=self._n)
+        for comps in stats:
+            bleu_scorer.append_cooked_test(comps)
 
         #score, scores = bleu_scorer.compute_score(option='shortest')
         score, scores = bleu_scorer.compute_score(option='closest', verbose=1)
@@ -19,18 +19,17 @@ cook_test(test, refs, n=4): Transform a test sentence as a string (together with
 import copy
 import sys, math, re
 from collections import defaultdict
+import numpy as np
+from pycocoevalcap import cooked_corpus
 
 def precook(s, n=4, out=False):
     """Takes a string as input and returns an object that can be given to
     either cook_refs or cook_test. This is optional: cook_refs and cook_test
-    can take string arguments as well."""
-    words = s.split()
-    counts = defaultdict(int)
-    for k in xrange(1,n+1):
-        for i in xrange(len(words)-k+1):
-            ngram = tuple(words[i:i+k])
-            counts[ngram] += 1
-    return (len(words), counts)
+    can take string arguments as well.
+    s can also be the (length, counts) already returned by cooked_corpus.precook."""
+    if type(s) is tuple:
+        return s
+    return cooked_corpus.precook(s, n)
 
 def cook_refs(refs, eff=None, n=4): ## lhuang: oracle will call with "average"
     '''Takes a list of reference sentences for a single segment
@@ -82,11 +81,34 @@ def cook_test(test, (reflen, refmaxcounts), eff=None, n=4):
 
     return result
 
+def corpus_bleu(totalcomps, n=4, verbose=0):
+    '''BLEU-1 to BLEU-n of a corpus from the statistics summed over its sentences,
+    totalcomps holds testlen, reflen and the guess and correct lists, see BleuScorer.compute_score.'''
+    small = 1e-9
+    tiny = 1e-15 ## so that if guess is 0 still return 0
+
+    bleus = []
+    bleu = 1.
+    for k in xrange(n):
+        bleu *= float(totalcomps['correct'][k] + tiny) \
+                / (totalcomps['guess'][k] + small)
+        bleus.append(bleu ** (1./(k+1)))
+    ratio = (totalcomps['testlen'] + tiny) / (totalcomps['reflen'] + small) ## N.B.: avoid zero division
+    if ratio < 1:
+        for k in xrange(n):
+            bleus[k] *= math.exp(1 - 1/ratio)
+
+    if verbose > 0:
+        print totalcomps
+        print "ratio:", ratio
+
+    return bleus
+
 class BleuScorer(object):
     """Bleu scorer.
     """
 
-    __slots__ = "n", "crefs", "ctest", "_score", "_ratio", "_testlen", "_reflen", "special_reflen"
+    __slots__ = "n", "crefs", "ctest", "_score", "_ratio", "_testlen", "_reflen", "special_reflen", "totalcomps"
     # special_reflen is used in oracle (proportional effective ref len for a node).
 
     def copy(self):
@@ -105,6 +127,7 @@ class BleuScorer(object):
         self.ctest = []
         self.cook_append(test, refs)
         self.special_reflen = special_reflen
+        self.totalcomps = None
 
     def cook_append(self, test, refs):
         '''called by constructor and __iadd__ to avoid creating new instances.'''
@@ -119,6 +142,20 @@ class BleuScorer(object):
 
         self._score = None ## need to recompute
 
+    def append_cooked_refs(self, test, crefs):
+        '''add a test sentence with references already cooked by cook_refs,
+        e.g. to score several test sentences against the same references.'''
+        self.crefs.append(crefs)
+        self.ctest.append(cook_test(test, crefs))
+        self._score = None ## need to recompute
+
+    def append_cooked_test(self, comps):
+        '''add a test sentence already cooked by cook_test against its references, e.g. kept from
+        a previous evaluation. Its references are not needed anymore, only a placeholder is added to crefs.'''
+        self.crefs.append(None)
+        self.ctest.append(comps)
+        self._score = None ## need to recompute
+
     def ratio(self, option=None):
         self.compute_score(option=option)
         return self._ratio
@@ -191,6 +228,33 @@ class BleuScorer(object):
 
         return reflen
 
+    def _single_reflens(self, reflens, option=None, testlens=None):
+        '''same as _single_reflen, for the reference lengths of all the sentences at once.'''
+
+        n_refs = np.array([len(r) for r in reflens], dtype=np.int64)
+        if len(n_refs) == 0:
+            return np.zeros(0, dtype=np.int64)
+        # (n_sent, max number of refs) array of the reference lengths, valid marks the actual references
+        valid = np.arange(n_refs.max()) < n_refs[:, None]
+        lens = np.zeros(valid.shape, dtype=np.int64)
+        lens[valid] = np.concatenate([np.asarray(r, dtype=np.int64) for r in reflens])
+        # larger than any reference length and difference to testlen, for the padding
+        maxlen = int(max(lens.max(), testlens.max() if testlens is not None else 0)) * 2 + 1
+
+        if option == "shortest":
+            reflen = np.where(valid, lens, maxlen).min(axis=1)
+        elif option == "average":
+            reflen = lens.sum(axis=1) / n_refs.astype(np.float64)
+        elif option == "closest":
+            # the closest length to testlen, the shorter one on ties
+            diffs = np.where(valid, np.abs(lens - testlens[:, None]), maxlen)
+            closest = diffs == diffs.min(axis=1)[:, None]
+            reflen = np.where(closest, lens, maxlen).min(axis=1)
+        else:
+            assert False, "unsupported reflen option %s" % option
+
+        return reflen
+
     def recompute_score(self, option=None, verbose=0):
         self._score = None
         return self.compute_score(option, verbose)
@@ -199,7 +263,6 @@ class BleuScorer(object):
         n = self.n
         small = 1e-9
         tiny = 1e-15 ## so that if guess is 0 still return 0
-        bleu_list = [[] for _ in range(n)]
 
         if self._score is not None:
             return self._score
@@ -207,57 +270,31 @@ class BleuScorer(object):
         if option is None:
             option = "average" if len(self.crefs) == 1 else "closest"
 
-        self._testlen = 0
-        self._reflen = 0
-        totalcomps = {'testlen':0, 'reflen':0, 'guess':[0]*n, 'correct':[0]*n}
-
-        # for each sentence
-        for comps in self.ctest:            
-            testlen = comps['testlen']
-            self._testlen += testlen
-
-            if self.special_reflen is None: ## need computation
-                reflen = self._single_reflen(comps['reflen'], option, testlen)
-            else:
-                reflen = self.special_reflen
-
-            self._reflen += reflen
-                
-            for key in ['guess','correct']:
-                for k in xrange(n):
-                    totalcomps[key][k] += comps[key][k]
-
-            # append per image bleu score
-            bleu = 1.
-            for k in xrange(n):
-                bleu *= (float(comps['correct'][k]) + tiny) \
-                        /(float(comps['guess'][k]) + small) 
-                bleu_list[k].append(bleu ** (1./(k+1)))
-            ratio = (testlen + tiny) / (reflen + small) ## N.B.: avoid zero division
-            if ratio < 1:
-                for k in xrange(n):
-                    bleu_list[k][-1] *= math.exp(1 - 1/ratio)
-
-            if verbose > 1:
-                print comps, reflen
-
-        totalcomps['reflen'] = self._reflen
-        totalcomps['testlen'] = self._testlen
-
-        bleus = []
-        bleu = 1.
-        for k in xrange(n):
-            bleu *= float(totalcomps['correct'][k] + tiny) \
-                    / (totalcomps['guess'][k] + small)
-            bleus.append(bleu ** (1./(k+1)))
-        ratio = (self._testlen + tiny) / (self._reflen + small) ## N.B.: avoid zero division
-        if ratio < 1:
-            for k in xrange(n):
-                bleus[k] *= math.exp(1 - 1/ratio)
-
-        if verbose > 0:
-            print totalcomps
-            print "ratio:", ratio
-
-        self._score = bleus
-        return self._score, bleu_list
+        # per sentence statistics, (n_sent,) and (n_sent, n) arrays
+        n_sent = len(self.ctest)
+        testlen = np.array([comps['testlen'] for comps in self.ctest], dtype=np.int64)
+        guess = np.array([comps['guess'] for comps in self.ctest], dtype=np.int64).reshape((n_sent, n))
+        correct = np.array([comps['correct'] for comps in self.ctest], dtype=np.int64).reshape((n_sent, n))
+        if self.special_reflen is None: ## need computation
+            reflen = self._single_reflens([comps['reflen'] for comps in self.ctest], option, testlen)
+        else:
+            reflen = np.array([self.special_reflen] * n_sent)
+
+        if verbose > 1:
+            for comps, r in zip(self.ctest, reflen.tolist()):
+                print comps, r
+
+        # per image bleu scores, (n_sent, n) array
+        bleu_list = np.cumprod((correct + tiny) / (guess + small), axis=1) ** (1. / np.arange(1, n + 1))
+        ratio = (testlen + tiny) / (reflen + small) ## N.B.: avoid zero division
+        bleu_list *= np.where(ratio < 1, np.exp(1 - 1 / ratio), 1.)[:, None]
+
+        # summed in order, same as adding the sentences one by one
+        self._testlen = sum(testlen.tolist())
+        self._reflen = sum(reflen.tolist())
+        # kept to combine the statistics of several scorers, see corpus_bleu
+        self.totalcomps = {'testlen':self._testlen, 'reflen':self._reflen,
+                           'guess':guess.sum(axis=0).tolist(), 'correct':correct.sum(axis=0).tolist()}
+
+        self._score = corpus_bleu(self.totalcomps, n, verbose)
+        return self._score, [bleu_list[:, k].tolist() for k in xrange(n)]
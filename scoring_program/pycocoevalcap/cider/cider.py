@@ -7,7 +7,8 @@
 #
 # Authors: Ramakrishna Vedantam <vrama91@vt.edu> and Tsung-Yi Lin <tl483@cornell.edu>
 
-from cider_scorer import CiderScorer
+from cider_scorer import CiderScorer, CiderReferenceIndex, compute_cider_sparse, cook_test
+import numpy as np
 import pdb
 
 class Cider:
@@ -15,11 +16,18 @@ class Cider:
     Main Class to compute the CIDEr metric 
 
     """
-    def __init__(self, test=None, refs=None, n=4, sigma=6.0):
+    def __init__(self, test=None, refs=None, n=4, sigma=6.0, ref_index=None, sparse=True, cooked_corpus=None):
         # set cider to sum over 1 to 4-grams
         self._n = n
         # set the standard deviation parameter for gaussian penalty
         self._sigma = sigma
+        # precomputed CiderReferenceIndex of gts, see `build_ref_index`
+        self._ref_index = ref_index
+        # compute the scores of all the images at once with numpy arrays, see `compute_cider_sparse`,
+        # set to False to use the original per n-gram implementation in CiderScorer
+        self._sparse = sparse
+        # CookedCorpus of the gts and res, to reuse the n-gram counts shared with the other metrics
+        self._cooked_corpus = cooked_corpus
 
     def compute_score(self, gts, res):
         """
@@ -32,7 +40,17 @@ class Cider:
         assert(gts.keys() == res.keys())
         imgIds = gts.keys()
 
-        cider_scorer = CiderScorer(n=self._n, sigma=self._sigma)
+        # the document frequency depends on the evaluated images,
+        # so the index is only used when it is built for the same images.
+        ref_index = self._ref_index
+        if ref_index is not None and not ref_index.matches(gts, n=self._n):
+            ref_index = None
+        cooked = self._cooked_corpus
+        if cooked is not None and not cooked.matches(gts, res, n=self._n):
+            cooked = None
+        if self._sparse and ref_index is None:
+            ref_index = CiderReferenceIndex(gts if cooked is None else cooked.refs, n=self._n)
+        cider_scorer = CiderScorer(n=self._n, sigma=self._sigma, ref_index=ref_index)
 
         for id in imgIds:
             hypo = res[id]
@@ -44,11 +62,57 @@ class Cider:
             assert(type(ref) is list)
             assert(len(ref) > 0)
 
-            cider_scorer += (hypo[0], ref)
+            if cooked is not None:
+                # already cooked sentences, see cider_scorer.precook
+                hypo = [cooked.tests[id]]
+                if ref_index is None:
+                    ref = cooked.refs[id]
+
+            if ref_index is None:
+                cider_scorer += (hypo[0], ref)
+            else:
+                cider_scorer.append_indexed(hypo[0], id)
+
+        if self._sparse:
+            scores = compute_cider_sparse(ref_index, cider_scorer.crefs, cider_scorer.ctest, sigma=self._sigma)
+            return np.mean(scores), scores
 
         (score, scores) = cider_scorer.compute_score()
 
         return score, scores
 
+    def compute_stats(self, gts, res, imgIds):
+        """
+        Compute the CIDEr score of the images imgIds only, e.g. a shard of the dataset,
+        the document frequency is still the one of all the images of gts
+        :return: scores (list of float) : score of each image of imgIds, to be given to eval_stats
+        """
+        ref_index = self._ref_index
+        if not self._sparse or ref_index is None or not ref_index.matches(gts, n=self._n):
+            # the document frequency of gts is computed by scoring all the images
+            scores = dict(zip(gts.keys(), self.compute_score(gts, res)[1]))
+            return [scores[id] for id in imgIds]
+        cooked = self._cooked_corpus
+        if cooked is not None and not cooked.matches(gts, res, n=self._n):
+            cooked = None
+        ctest = [cook_test(cooked.tests[id] if cooked is not None else res[id][0]) for id in imgIds]
+        return compute_cider_sparse(ref_index, imgIds, ctest, sigma=self._sigma).tolist()
+
+    def eval_stats(self, stats):
+        """
+        :param stats (list of float) : the scores of all the images, see compute_stats
+        :return: cider (float) : CIDEr score for the corpus, and the scores of each image
+        """
+        scores = np.array(stats, dtype=np.float64)
+        return np.mean(scores), scores
+
+    def build_ref_index(self, gts):
+        """
+        Precompute the reference side of the CIDEr score
+        :param gts (dict) : dictionary with key <image> and value <tokenized reference sentence>
+        :return: ref_index (CiderReferenceIndex) : can be saved and given to Cider(ref_index=...)
+        """
+        return CiderReferenceIndex(gts, n=self._n)
+
     def method(self):
         return "CIDEr"
\ No newline at end of file
@@ -5,6 +5,7 @@
 import copy
 from collections import defaultdict
 import numpy as np
+from pycocoevalcap import cooked_corpus
 import pdb
 import math
 
@@ -13,17 +14,13 @@ def precook(s, n=4, out=False):
     Takes a string as input and returns an object that can be given to
     either cook_refs or cook_test. This is optional: cook_refs and cook_test
     can take string arguments as well.
-    :param s: string : sentence to be converted into ngrams
+    :param s: string : sentence to be converted into ngrams, or (length, counts) from cooked_corpus.precook
     :param n: int    : number of ngrams for which representation is calculated
     :return: term frequency vector for occuring ngrams
     """
-    words = s.split()
-    counts = defaultdict(int)
-    for k in xrange(1,n+1):
-        for i in xrange(len(words)-k+1):
-            ngram = tuple(words[i:i+k])
-            counts[ngram] += 1
-    return counts
+    if type(s) is tuple:
+        return s[1]
+    return cooked_corpus.precook(s, n)[1]
 
 def cook_refs(refs, n=4): ## lhuang: oracle will call with "average"
     '''Takes a list of reference sentences for a single segment
@@ -55,7 +52,7 @@ class CiderScorer(object):
         new.crefs = copy.copy(self.crefs)
         return new
 
-    def __init__(self, test=None, refs=None, n=4, sigma=6.0):
+    def __init__(self, test=None, refs=None, n=4, sigma=6.0, ref_index=None):
         ''' singular instance '''
         self.n = n
         self.sigma = sigma
@@ -64,6 +61,8 @@ class CiderScorer(object):
         self.document_frequency = defaultdict(float)
         self.cook_append(test, refs)
         self.ref_len = None
+        # CiderReferenceIndex, if given, crefs holds the image ids of the references in the index
+        self.ref_index = ref_index
 
     def cook_append(self, test, refs):
         '''called by constructor and __iadd__ to avoid creating new instances.'''
@@ -90,6 +89,12 @@ class CiderScorer(object):
             self.crefs.extend(other.crefs)
 
         return self
+
+    def append_indexed(self, test, img_id):
+        '''add a test sentence, its references are looked up in the reference index by the image id.'''
+        self.ctest.append(cook_test(test))
+        self.crefs.append(img_id)
+
     def compute_doc_freq(self):
         '''
         Compute term frequency for reference data.
@@ -103,77 +108,84 @@ class CiderScorer(object):
                 self.document_frequency[ngram] += 1
             # maxcounts[ngram] = max(maxcounts.get(ngram,0), count)
 
-    def compute_cider(self):
-        def counts2vec(cnts):
-            """
-            Function maps counts of ngram to vector of tfidf weights.
-            The function returns vec, an array of dictionary that store mapping of n-gram and tf-idf weights.
-            The n-th entry of array denotes length of n-grams.
-            :param cnts:
-            :return: vec (array of dict), norm (array of float), length (int)
-            """
-            vec = [defaultdict(float) for _ in range(self.n)]
-            length = 0
-            norm = [0.0 for _ in range(self.n)]
-            for (ngram,term_freq) in cnts.iteritems():
-                # give word count 1 if it doesn't appear in reference corpus
-                df = np.log(max(1.0, self.document_frequency[ngram]))
-                # ngram index
-                n = len(ngram)-1
-                # tf (term_freq) * idf (precomputed idf) for n-grams
-                vec[n][ngram] = float(term_freq)*(self.ref_len - df)
-                # compute norm for the vector.  the norm will be used for computing similarity
-                norm[n] += pow(vec[n][ngram], 2)
-
-                if n == 1:
-                    length += term_freq
-            norm = [np.sqrt(n) for n in norm]
-            return vec, norm, length
-
-        def sim(vec_hyp, vec_ref, norm_hyp, norm_ref, length_hyp, length_ref):
-            '''
-            Compute the cosine similarity of two vectors.
-            :param vec_hyp: array of dictionary for vector corresponding to hypothesis
-            :param vec_ref: array of dictionary for vector corresponding to reference
-            :param norm_hyp: array of float for vector corresponding to hypothesis
-            :param norm_ref: array of float for vector corresponding to reference
-            :param length_hyp: int containing length of hypothesis
-            :param length_ref: int containing length of reference
-            :return: array of score for each n-grams cosine similarity
-            '''
-            delta = float(length_hyp - length_ref)
-            # measure consine similarity
-            val = np.array([0.0 for _ in range(self.n)])
-            for n in range(self.n):
-                # ngram
-                for (ngram,count) in vec_hyp[n].iteritems():
-                    # vrama91 : added clipping
-                    val[n] += min(vec_hyp[n][ngram], vec_ref[n][ngram]) * vec_ref[n][ngram]
-
-                if (norm_hyp[n] != 0) and (norm_ref[n] != 0):
-                    val[n] /= (norm_hyp[n]*norm_ref[n])
-
-                assert(not math.isnan(val[n]))
-                # vrama91: added a length based gaussian penalty
-                val[n] *= np.e**(-(delta**2)/(2*self.sigma**2))
-            return val
+    def counts2vec(self, cnts):
+        """
+        Function maps counts of ngram to vector of tfidf weights.
+        The function returns vec, an array of dictionary that store mapping of n-gram and tf-idf weights.
+        The n-th entry of array denotes length of n-grams.
+        :param cnts:
+        :return: vec (array of dict), norm (array of float), length (int)
+        """
+        vec = [defaultdict(float) for _ in range(self.n)]
+        length = 0
+        norm = [0.0 for _ in range(self.n)]
+        for (ngram,term_freq) in cnts.iteritems():
+            # give word count 1 if it doesn't appear in reference corpus
+            df = np.log(max(1.0, self.document_frequency.get(ngram, 0.0)))
+            # ngram index
+            n = len(ngram)-1
+            # tf (term_freq) * idf (precomputed idf) for n-grams
+            vec[n][ngram] = float(term_freq)*(self.ref_len - df)
+            # compute norm for the vector.  the norm will be used for computing similarity
+            norm[n] += pow(vec[n][ngram], 2)
 
+            if n == 1:
+                length += term_freq
+        norm = [np.sqrt(n) for n in norm]
+        return vec, norm, length
+
+    def sim(self, vec_hyp, vec_ref, norm_hyp, norm_ref, length_hyp, length_ref):
+        '''
+        Compute the cosine similarity of two vectors.
+        :param vec_hyp: array of dictionary for vector corresponding to hypothesis
+        :param vec_ref: array of dictionary for vector corresponding to reference
+        :param norm_hyp: array of float for vector corresponding to hypothesis
+        :param norm_ref: array of float for vector corresponding to reference
+        :param length_hyp: int containing length of hypothesis
+        :param length_ref: int containing length of reference
+        :return: array of score for each n-grams cosine similarity
+        '''
+        delta = float(length_hyp - length_ref)
+        # measure consine similarity
+        val = np.array([0.0 for _ in range(self.n)])
+        for n in range(self.n):
+            # ngram
+            for (ngram,count) in vec_hyp[n].iteritems():
+                # vrama91 : added clipping
+                # (.get() leaves the reference vectors unchanged, they can be shared through the index)
+                ref_weight = vec_ref[n].get(ngram, 0.0)
+                val[n] += min(vec_hyp[n][ngram], ref_weight) * ref_weight
+
+            if (norm_hyp[n] != 0) and (norm_ref[n] != 0):
+                val[n] /= (norm_hyp[n]*norm_ref[n])
+
+            assert(not math.isnan(val[n]))
+            # vrama91: added a length based gaussian penalty
+            val[n] *= np.e**(-(delta**2)/(2*self.sigma**2))
+        return val
+
+    def compute_cider(self):
         # compute log reference length
-        self.ref_len = np.log(float(len(self.crefs)))
+        if self.ref_index is None:
+            self.ref_len = np.log(float(len(self.crefs)))
 
         scores = []
         for test, refs in zip(self.ctest, self.crefs):
             # compute vector for test captions
-            vec, norm, length = counts2vec(test)
+            vec, norm, length = self.counts2vec(test)
             # compute vector for ref captions
+            if self.ref_index is None:
+                ref_vecs = [self.counts2vec(ref) for ref in refs]
+            else:
+                # refs is the image id, only the weights of the test n-grams are needed from the references
+                ref_vecs = self.ref_index.get_ref_vecs(refs, [(ngram, self.ngram_ids[ngram]) for ngram in test])
             score = np.array([0.0 for _ in range(self.n)])
-            for ref in refs:
-                vec_ref, norm_ref, length_ref = counts2vec(ref)
-                score += sim(vec, vec_ref, norm, norm_ref, length, length_ref)
+            for vec_ref, norm_ref, length_ref in ref_vecs:
+                score += self.sim(vec, vec_ref, norm, norm_ref, length, length_ref)
             # change by vrama91 - mean of ngram scores, instead of sum
             score_avg = np.mean(score)
             # divide by number of references
-            score_avg /= len(refs)
+            score_avg /= len(ref_vecs)
             # multiply score by 10
             score_avg *= 10.0
             # append score of an image to the score list
@@ -182,11 +194,230 @@ class CiderScorer(object):
 
     def compute_score(self, option=None, verbose=0):
         # compute idf
-        self.compute_doc_freq()
-        # assert to check document frequency
-        assert(len(self.ctest) >= max(self.document_frequency.values()))
+        if self.ref_index is None:
+            self.compute_doc_freq()
+            # assert to check document frequency
+            assert(len(self.ctest) >= max(self.document_frequency.values()))
+        else:
+            # only the document frequency of the test n-grams is looked up in the index
+            test_ngrams = list(set([ngram for test in self.ctest for ngram in test]))
+            test_ngram_ids = self.ref_index.lookup(test_ngrams)
+            self.ngram_ids = dict(zip(test_ngrams, test_ngram_ids.tolist()))
+            self.document_frequency = dict((ngram, df) for ngram, ngram_id, df in zip(
+                test_ngrams, test_ngram_ids, self.ref_index.doc_freq[test_ngram_ids].tolist()) if ngram_id >= 0)
+            self.ref_len = self.ref_index.ref_len
         # compute cider score
         score = self.compute_cider()
         # debug
         # print score
-        return np.mean(np.array(score)), np.array(score)
\ No newline at end of file
+        return np.mean(np.array(score)), np.array(score)
+
+
+class CiderReferenceIndex(object):
+    """The reference side of CIDEr-D: the document frequency of the n-grams and the tf-idf vectors
+    of the references. It only depends on the references, so it can be built once and saved,
+    then scoring hypotheses only computes the hypothesis vectors.
+
+    The n-grams are interned as integer ids, in the order of their space separated strings,
+    and the reference vectors are stored as flat arrays of (n-gram id, weight) entries.
+    """
+    # bump this when the saved format changes
+    VERSION = 2
+
+    def __init__(self, refs_for_image, n=4, document_frequency=None, ref_len=None):
+        """
+        :param refs_for_image: dict : {image id: list of tokenized reference sentences}
+        :param n: int : number of ngrams
+        :param document_frequency: dict : {ngram: number of images}, and
+        :param ref_len: float : log number of images, both of a larger corpus refs_for_image is a part of,
+            by default they are computed from refs_for_image
+        """
+        img_ids = list(refs_for_image.keys())
+        ngram2id = {}
+        # references of image i are ref_offsets[i]:ref_offsets[i+1],
+        # entries of reference j are entry_offsets[j]:entry_offsets[j+1]
+        ref_offsets = [0]
+        entry_offsets = [0]
+        entry_ngram_ids = []
+        entry_term_freqs = []
+        for img_id in img_ids:
+            for ref in refs_for_image[img_id]:
+                counts = precook(ref, n)
+                entry_ngram_ids.extend([ngram2id.setdefault(ngram, len(ngram2id)) for ngram in counts])
+                entry_term_freqs.extend(counts.values())
+                entry_offsets.append(len(entry_ngram_ids))
+            ref_offsets.append(len(entry_offsets) - 1)
+        ngrams = [None] * len(ngram2id)
+        for ngram, ngram_id in ngram2id.iteritems():
+            ngrams[ngram_id] = ngram
+
+        # renumber the n-grams in sorted order, to look them up with np.searchsorted
+        ngram_strs = np.array([' '.join(ngram) for ngram in ngrams] if len(ngrams) > 0 else [], dtype=str)
+        order = np.argsort(ngram_strs, kind='mergesort')
+        new_ids = np.empty(len(ngrams), dtype=np.int64)
+        new_ids[order] = np.arange(len(ngrams))
+        entry_ngram_ids = new_ids[np.array(entry_ngram_ids, dtype=np.int64)]
+        entry_term_freqs = np.array(entry_term_freqs, dtype=np.float64)
+
+        self.n = n
+        self.img_id2idx = dict(zip(img_ids, range(len(img_ids))))
+        self.ngrams = ngram_strs[order]
+        self.ngram_orders = np.array([len(ngrams[i]) - 1 for i in order], dtype=np.int64)
+        self.ref_offsets = np.array(ref_offsets, dtype=np.int64)
+        self.entry_offsets = np.array(entry_offsets, dtype=np.int64)
+        self.entry_ngram_ids = entry_ngram_ids
+
+        # document frequency: number of images whose references contain the n-gram
+        n_refs = len(self.entry_offsets) - 1
+        entry_refs = np.repeat(np.arange(n_refs), np.diff(self.entry_offsets))
+        if document_frequency is None:
+            entry_imgs = np.repeat(np.arange(len(img_ids)), np.diff(self.ref_offsets))[entry_refs]
+            img_ngram_keys = np.unique(entry_imgs * max(len(ngrams), 1) + entry_ngram_ids)
+            self.doc_freq = np.bincount(img_ngram_keys % max(len(ngrams), 1),
+                                        minlength=len(ngrams)).astype(np.float64)
+        else:
+            self.doc_freq = np.array([document_frequency.get(ngrams[i], 0.0) for i in order], dtype=np.float64)
+        self.ref_len = np.log(float(len(img_ids))) if ref_len is None else ref_len
+
+        # tf-idf weights, norms and lengths (number of bigrams, as in CiderScorer.counts2vec) of the references
+        entry_orders = self.ngram_orders[entry_ngram_ids]
+        self.entry_weights = entry_term_freqs * (self.ref_len - np.log(np.maximum(1.0, self.doc_freq[entry_ngram_ids])))
+        self.ref_norms = np.sqrt(np.bincount(entry_refs * n + entry_orders, weights=self.entry_weights ** 2,
+                                             minlength=n_refs * n)).reshape((n_refs, n))
+        self.ref_lengths = np.bincount(entry_refs, weights=entry_term_freqs * (entry_orders == 1),
+                                       minlength=n_refs).astype(np.int64)
+
+    def matches(self, refs_for_image, n=4):
+        '''whether the index is built for the same images with the same number of references.'''
+        if self.n != n or len(refs_for_image) != len(self.img_id2idx):
+            return False
+        for img_id, refs in refs_for_image.iteritems():
+            if img_id not in self.img_id2idx:
+                return False
+            idx = self.img_id2idx[img_id]
+            if self.ref_offsets[idx + 1] - self.ref_offsets[idx] != len(refs):
+                return False
+        return True
+
+    def lookup(self, ngrams):
+        '''
+        :param ngrams: list of tuple : n-grams
+        :return: ngram_ids (array of int) : ids of the n-grams, -1 for n-grams not in the references
+        '''
+        if len(ngrams) == 0 or len(self.ngrams) == 0:
+            return -np.ones(len(ngrams), dtype=np.int64)
+        ngram_strs = np.array([' '.join(ngram) for ngram in ngrams])
+        ngram_ids = np.minimum(np.searchsorted(self.ngrams, ngram_strs), len(self.ngrams) - 1)
+        return np.where(self.ngrams[ngram_ids] == ngram_strs, ngram_ids, -1)
+
+    def get_ref_vecs(self, img_id, ngram_ids):
+        '''
+        :param img_id: image id of the references
+        :param ngram_ids: list of (ngram, ngram id) : the n-grams to get the weights of
+        :return: list of (vec, norm, length) : vectors of the references as returned by CiderScorer.counts2vec,
+            but only with the weights of the given n-grams
+        '''
+        idx = self.img_id2idx[img_id]
+        ref_vecs = []
+        for j in range(self.ref_offsets[idx], self.ref_offsets[idx + 1]):
+            st, ed = self.entry_offsets[j], self.entry_offsets[j + 1]
+            id2weight = dict(zip(self.entry_ngram_ids[st:ed].tolist(), self.entry_weights[st:ed].tolist()))
+            vec = [{} for _ in range(self.n)]
+            for ngram, ngram_id in ngram_ids:
+                if ngram_id in id2weight:
+                    vec[len(ngram) - 1][ngram] = id2weight[ngram_id]
+            ref_vecs.append((vec, self.ref_norms[j].tolist(), int(self.ref_lengths[j])))
+        return ref_vecs
+
+
+def gather_ranges(starts, counts):
+    '''
+    :param starts: array of int : start of each range
+    :param counts: array of int : length of each range
+    :return: indices (array of int) : the concatenated ranges starts[i]:starts[i]+counts[i]
+    '''
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) > 0 else 0) - np.repeat(ends - counts - starts, counts)
+
+def compute_cider_sparse(ref_index, img_ids, ctest, sigma=6.0, document_frequency=None):
+    '''
+    Compute the CIDEr-D scores of all the images at once. The n-grams of the test sentences are interned
+    with the ids of the reference index, the clipped dot products with the references, the norms and
+    the gaussian length penalties are then computed with numpy, same as CiderScorer.compute_cider.
+    :param ref_index: CiderReferenceIndex : references of the images
+    :param img_ids: list : image id of each test sentence, the references of each image are looked up in ref_index,
+        an image id can be repeated to score several test sentences of the image
+    :param ctest: list of dict : cooked test sentence of each image, see cook_test
+    :param sigma: float : standard deviation of the gaussian length penalty
+    :param document_frequency: dict : {ngram: number of images}, the document frequency of the test n-grams
+        when ref_index only holds a part of the images, see CiderReferenceIndex
+    :return: scores (array of float) : score of each image
+    '''
+    n = ref_index.n
+    n_imgs = len(img_ids)
+
+    # test n-gram entries, n-grams not in the references get an id of -1
+    test_imgs = []
+    test_ngrams = []
+    test_term_freqs = []
+    for i, test in enumerate(ctest):
+        for ngram, term_freq in test.iteritems():
+            test_imgs.append(i)
+            test_ngrams.append(ngram)
+            test_term_freqs.append(term_freq)
+    unique_ngrams = list(set(test_ngrams))
+    ngram2id = dict(zip(unique_ngrams, ref_index.lookup(unique_ngrams).tolist()))
+    test_imgs = np.array(test_imgs, dtype=np.int64)
+    test_ngram_ids = np.array([ngram2id[ngram] for ngram in test_ngrams], dtype=np.int64)
+    test_orders = np.array([len(ngram) - 1 for ngram in test_ngrams], dtype=np.int64)
+    test_term_freqs = np.array(test_term_freqs, dtype=np.float64)
+
+    # test vectors, n-grams not in the references have a document frequency of 0
+    in_refs = test_ngram_ids >= 0
+    if document_frequency is None:
+        doc_freq = np.zeros(len(test_ngram_ids))
+        doc_freq[in_refs] = ref_index.doc_freq[test_ngram_ids[in_refs]]
+    else:
+        doc_freq = np.array([document_frequency.get(ngram, 0.0) for ngram in test_ngrams], dtype=np.float64)
+    test_weights = test_term_freqs * (ref_index.ref_len - np.log(np.maximum(1.0, doc_freq)))
+    test_norms = np.sqrt(np.bincount(test_imgs * n + test_orders, weights=test_weights ** 2,
+                                     minlength=n_imgs * n)).reshape((n_imgs, n))
+    test_lengths = np.bincount(test_imgs, weights=test_term_freqs * (test_orders == 1), minlength=n_imgs)
+
+    # the references of each test sentence, gathered from the index, an image may be scored several times.
+    # ref_imgs is the test sentence of each reference, entry_refs the reference of each entry.
+    img_idxs = np.array([ref_index.img_id2idx[img_id] for img_id in img_ids], dtype=np.int64)
+    ref_counts = ref_index.ref_offsets[img_idxs + 1] - ref_index.ref_offsets[img_idxs]
+    ref_imgs = np.repeat(np.arange(n_imgs), ref_counts)
+    ref_ids = gather_ranges(ref_index.ref_offsets[img_idxs], ref_counts)
+    n_refs = len(ref_ids)
+    entry_counts = ref_index.entry_offsets[ref_ids + 1] - ref_index.entry_offsets[ref_ids]
+    entry_refs = np.repeat(np.arange(n_refs), entry_counts)
+    entry_ids = gather_ranges(ref_index.entry_offsets[ref_ids], entry_counts)
+    entry_ngram_ids = ref_index.entry_ngram_ids[entry_ids]
+    entry_weights = ref_index.entry_weights[entry_ids]
+
+    # match the reference entries with the test entries of the same image and n-gram
+    n_ngrams = max(len(ref_index.ngrams), 1)
+    test_keys = test_imgs[in_refs] * n_ngrams + test_ngram_ids[in_refs]
+    test_order = np.argsort(test_keys)
+    test_keys = test_keys[test_order]
+    test_matched_weights = test_weights[in_refs][test_order]
+    entry_keys = ref_imgs[entry_refs] * n_ngrams + entry_ngram_ids
+    pos = np.minimum(np.searchsorted(test_keys, entry_keys), max(len(test_keys) - 1, 0))
+    matched = test_keys[pos] == entry_keys if len(test_keys) > 0 else np.zeros(len(entry_keys), dtype=bool)
+
+    # vrama91 : added clipping
+    clipped = np.minimum(test_matched_weights[pos[matched]], entry_weights[matched]) * entry_weights[matched]
+    val = np.bincount(entry_refs[matched] * n + ref_index.ngram_orders[entry_ngram_ids[matched]],
+                      weights=clipped, minlength=n_refs * n).reshape((n_refs, n))
+    # cosine similarity, left as is when one of the norms is 0
+    norms = test_norms[ref_imgs] * ref_index.ref_norms[ref_ids]
+    val = np.where(norms != 0, val / np.where(norms != 0, norms, 1.0), val)
+    # vrama91: added a length based gaussian penalty
+    delta = test_lengths[ref_imgs] - ref_index.ref_lengths[ref_ids]
+    val *= (np.e ** (-(delta ** 2) / (2 * sigma ** 2)))[:, None]
+
+    # mean of the n-gram scores, averaged over the references, times 10
+    scores = np.bincount(ref_imgs, weights=val.mean(axis=1), minlength=n_imgs)
+    return scores / ref_counts * 10.0
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+# File Name : cooked_corpus.py
+#
+# Description : Extract the n-gram counts of the tokenized captions once, to be shared by
+#               the n-gram based metrics (Bleu and Cider).
+
+from collections import defaultdict
+
+
+def precook(s, n=4):
+    """
+    Takes a string as input and returns its length and n-gram counts, as used by
+    bleu_scorer.cook_refs / cook_test and cider_scorer.cook_refs / cook_test.
+    :param s: string : sentence to be converted into ngrams
+    :param n: int    : number of ngrams for which representation is calculated
+    :return: (int, dict) : number of words, term frequency of the occurring ngrams
+    """
+    words = s.split()
+    counts = defaultdict(int)
+    for k in xrange(1,n+1):
+        for i in xrange(len(words)-k+1):
+            ngram = tuple(words[i:i+k])
+            counts[ngram] += 1
+    return (len(words), counts)
+
+
+class CookedCorpus(object):
+    """
+    The n-gram counts of the hypotheses and references of an evaluation, each sentence is cooked once.
+    Give it to Bleu and Cider with the same gts and res to skip their own n-gram extraction,
+    so that they share the same counts instead of building a copy each.
+    """
+
+    def __init__(self, gts, res, n=4, refs=None):
+        """
+        :param gts: dict : {image id: list of tokenized reference sentences}
+        :param res: dict : {image id: list of one tokenized hypothesis sentence}
+        :param n: int : number of ngrams
+        :param refs: dict : the cooked references of gts, e.g. the refs of another CookedCorpus of gts,
+            to share them between the hypotheses of several systems
+        """
+        self.gts = gts
+        self.res = res
+        self.n = n
+        # repeated sentences are cooked once and share their counts, which are only read by the scorers
+        self._cooked_sentences = {}
+        self.tests = dict((img_id, self.precook(hypo[0])) for img_id, hypo in res.iteritems())
+        self._refs = refs
+
+    def precook(self, s):
+        """precook with the counts of the sentences cooked before"""
+        if s not in self._cooked_sentences:
+            self._cooked_sentences[s] = precook(s, self.n)
+        return self._cooked_sentences[s]
+
+    @property
+    def refs(self):
+        """references are cooked on first use, scorers with precomputed references do not need them"""
+        if self._refs is None:
+            self._refs = dict((img_id, [self.precook(ref) for ref in refs])
+                              for img_id, refs in self.gts.iteritems())
+        return self._refs
+
+    def matches(self, gts, res, n=4):
+        """whether the corpus is cooked from these gts and res"""
+        return self.gts is gts and self.res is res and self.n == n
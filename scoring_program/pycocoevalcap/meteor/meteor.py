@@ -11,60 +11,105 @@ import threading
 # Assumes meteor-1.5.jar is in the same directory as meteor.py.  Change as needed.
 METEOR_JAR = 'meteor-1.5.jar'
 # print METEOR_JAR
+# number of SCORE lines written to the java process at once
+WRITE_CHUNK_SIZE = 1000
+# min number of segments per worker when MeteorPool splits an evaluation
+MIN_SHARD_SIZE = 500
 
 class Meteor:
 
-    def __init__(self):
-        self.meteor_cmd = ['java', '-jar', '-Xmx2G', METEOR_JAR, \
+    def __init__(self, max_heap='2G'):
+        # max_heap: heap cap of the java process, as given to -Xmx
+        self.meteor_cmd = ['java', '-jar', '-Xmx{}'.format(max_heap), METEOR_JAR, \
                 '-', '-', '-stdio', '-l', 'en', '-norm']
-        self.meteor_p = subprocess.Popen(self.meteor_cmd, \
+        # buffered pipes, the output is read line by line; stderr is inherited, a pipe that is
+        # never read would block the java process once its buffer is full
+        self.meteor_p = subprocess.Popen(self.meteor_cmd, bufsize=-1, \
                 cwd=os.path.dirname(os.path.abspath(__file__)), \
                 stdin=subprocess.PIPE, \
-                stdout=subprocess.PIPE, \
-                stderr=subprocess.PIPE)
+                stdout=subprocess.PIPE)
         # Used to guarantee thread safety
         self.lock = threading.Lock()
 
     def compute_score(self, gts, res):
         assert(gts.keys() == res.keys())
         imgIds = gts.keys()
-        scores = []
+        stats = self.compute_stats(gts, res, imgIds)
+        return self.eval_stats(stats)
 
-        eval_line = 'EVAL'
-        self.lock.acquire()
+    def compute_stats(self, gts, res, imgIds):
+        # sufficient statistics of each segment, in the order of imgIds
+        score_lines = []
         for i in imgIds:
             assert(len(res[i]) == 1)
-            stat = self._stat(res[i][0], gts[i])
-            eval_line += ' ||| {}'.format(stat)
+            score_lines.append(self._score_line(res[i][0], gts[i]))
 
-        self.meteor_p.stdin.write('{}\n'.format(eval_line))
-        for i in range(0,len(imgIds)):
-            scores.append(float(self.meteor_p.stdout.readline().strip()))
-        score = float(self.meteor_p.stdout.readline().strip())
-        self.lock.release()
+        self.lock.acquire()
+        try:
+            if not self.is_alive():
+                raise IOError('METEOR java process is not running')
+            # the SCORE lines are written from another thread while the stats are read,
+            # so that neither side blocks on a full pipe and there is no round trip per line
+            writer = threading.Thread(target=self._write_lines, args=(score_lines,))
+            writer.start()
+            try:
+                stats = [self._read_line() for _ in score_lines]
+            finally:
+                writer.join()
+        finally:
+            self.lock.release()
+        return stats
+
+    def eval_stats(self, stats):
+        # segment scores and corpus score of the segment statistics, which may come from other workers
+        scores = []
+        self.lock.acquire()
+        try:
+            eval_line = ' ||| '.join(['EVAL'] + stats)
+            self._write_lines([eval_line])
+            for i in range(0,len(stats)):
+                scores.append(float(self._read_line()))
+            score = float(self._read_line())
+        finally:
+            self.lock.release()
 
         return score, scores
 
     def method(self):
         return "METEOR"
 
-    def _stat(self, hypothesis_str, reference_list):
+    def _score_line(self, hypothesis_str, reference_list):
         # SCORE ||| reference 1 words ||| reference n words ||| hypothesis words
         hypothesis_str = hypothesis_str.replace('|||','').replace('  ',' ')
-        score_line = ' ||| '.join(('SCORE', ' ||| '.join(reference_list), hypothesis_str))
-        self.meteor_p.stdin.write('{}\n'.format(score_line))
+        return ' ||| '.join(('SCORE', ' ||| '.join(reference_list), hypothesis_str))
+
+    def _write_lines(self, lines):
+        try:
+            for start in range(0, len(lines), WRITE_CHUNK_SIZE):
+                self.meteor_p.stdin.write(''.join('{}\n'.format(line) for line in lines[start:start + WRITE_CHUNK_SIZE]))
+            self.meteor_p.stdin.flush()
+        except IOError:
+            # the java process died, the reader gets an empty line and fails
+            pass
+
+    def _read_line(self):
+        # one stripped output line, IOError if the java process exited before writing it,
+        # so that MeteorPool replaces the worker instead of passing on empty stats
+        line = self.meteor_p.stdout.readline()
+        if line == '':
+            raise IOError('METEOR java process exited with code {}'.format(self.meteor_p.poll()))
+        return line.strip()
+
+    def _stat(self, hypothesis_str, reference_list):
+        self._write_lines([self._score_line(hypothesis_str, reference_list)])
         return self.meteor_p.stdout.readline().strip()
 
     def _score(self, hypothesis_str, reference_list):
         self.lock.acquire()
-        # SCORE ||| reference 1 words ||| reference n words ||| hypothesis words
-        hypothesis_str = hypothesis_str.replace('|||','').replace('  ',' ')
-        score_line = ' ||| '.join(('SCORE', ' ||| '.join(reference_list), hypothesis_str))
-        self.meteor_p.stdin.write('{}\n'.format(score_line))
-        stats = self.meteor_p.stdout.readline().strip()
+        stats = self._stat(hypothesis_str, reference_list)
         eval_line = 'EVAL ||| {}'.format(stats)
         # EVAL ||| stats 
-        self.meteor_p.stdin.write('{}\n'.format(eval_line))
+        self._write_lines([eval_line])
         score = float(self.meteor_p.stdout.readline().strip())
         # bug fix: there are two values returned by the jar file, one average, and one all, so do it twice
         # thanks for Andrej for pointing this out
@@ -72,9 +117,159 @@ class Meteor:
         self.lock.release()
         return score
  
-    def __del__(self):
+    def is_alive(self):
+        # whether the java process is still running
+        return self.meteor_p is not None and self.meteor_p.poll() is None
+
+    def close(self):
         self.lock.acquire()
-        self.meteor_p.stdin.close()
-        self.meteor_p.kill()
-        self.meteor_p.wait()
+        if self.meteor_p is not None:
+            self.meteor_p.stdin.close()
+            if self.meteor_p.poll() is None:
+                self.meteor_p.kill()
+            self.meteor_p.wait()
+            self.meteor_p = None
         self.lock.release()
+
+    def __del__(self):
+        if hasattr(self, 'lock'):
+            self.close()
+
+
+class MeteorPool:
+    '''
+    Long-lived Meteor workers shared by all the caption evaluations of a run, so that the java
+    processes are started once instead of once per evaluation.
+    Workers are started lazily, at most size of them with a heap cap of max_heap each.
+    A worker whose java process died or whose output could not be read is closed and replaced.
+    Used as a scorer, compute_score splits the segments across the workers.
+    '''
+
+    def __init__(self, size=1, max_heap='2G'):
+        assert(size > 0)
+        self.size = size
+        self.max_heap = max_heap
+        self.workers = []
+        self.idle_workers = []
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        # returns a live worker, waits for one to be released if size of them are busy
+        self.cond.acquire()
+        try:
+            while True:
+                if self.closed:
+                    raise RuntimeError('MeteorPool is closed')
+                while self.idle_workers:
+                    worker = self.idle_workers.pop()
+                    if worker.is_alive():
+                        return worker
+                    self._discard(worker)
+                if len(self.workers) < self.size:
+                    worker = Meteor(max_heap=self.max_heap)
+                    self.workers.append(worker)
+                    return worker
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def release(self, worker, healthy=True):
+        # give the worker back to the pool, unhealthy workers are closed
+        self.cond.acquire()
+        try:
+            if healthy and not self.closed and worker.is_alive():
+                self.idle_workers.append(worker)
+            else:
+                self._discard(worker)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def _discard(self, worker):
+        if worker in self.workers:
+            self.workers.remove(worker)
+        worker.close()
+
+    def check_health(self):
+        # closes the idle workers whose java process died, returns the number of workers left
+        self.cond.acquire()
+        try:
+            for worker in list(self.idle_workers):
+                if not worker.is_alive():
+                    self.idle_workers.remove(worker)
+                    self._discard(worker)
+            self.cond.notify_all()
+            return len(self.workers)
+        finally:
+            self.cond.release()
+
+    def run(self, func):
+        # func(worker) on a free worker, a worker which broke while running it
+        # is replaced and func is run once more
+        for attempt in range(2):
+            worker = self.acquire()
+            try:
+                result = func(worker)
+            except (IOError, ValueError):
+                self.release(worker, healthy=False)
+                if attempt > 0:
+                    raise
+            except:
+                self.release(worker)
+                raise
+            else:
+                self.release(worker)
+                return result
+
+    def compute_score(self, gts, res):
+        assert(gts.keys() == res.keys())
+        imgIds = gts.keys()
+        stats = self.compute_stats(gts, res, imgIds)
+        return self.eval_stats(stats)
+
+    def compute_stats(self, gts, res, imgIds):
+        # the segments are split into contiguous shards scored by different workers at the same time,
+        # the stats are returned in the order of imgIds
+        n_shards = max(1, min(self.size, len(imgIds) // MIN_SHARD_SIZE))
+        if n_shards == 1:
+            return self.run(lambda worker: worker.compute_stats(gts, res, imgIds))
+
+        shard_size = -(-len(imgIds) // n_shards)
+        shards = [imgIds[start:start + shard_size] for start in range(0, len(imgIds), shard_size)]
+        shard_stats = [None] * len(shards)
+        errors = []
+
+        def compute_shard_stats(idx):
+            try:
+                shard_stats[idx] = self.run(lambda worker: worker.compute_stats(gts, res, shards[idx]))
+            except Exception:
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=compute_shard_stats, args=(idx,)) for idx in range(len(shards))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return [stat for stats in shard_stats for stat in stats]
+
+    def eval_stats(self, stats):
+        # the corpus score is computed by a single worker from all the segment statistics
+        return self.run(lambda worker: worker.eval_stats(stats))
+
+    def method(self):
+        return "METEOR"
+
+    def close(self):
+        self.cond.acquire()
+        try:
+            self.closed = True
+            for worker in self.workers:
+                worker.close()
+            self.workers = []
+            self.idle_workers = []
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
@@ -10,6 +10,35 @@
 import numpy as np
 import pdb
 
+def lcs_masks(tokens):
+    """
+    Interns the tokens of a sentence into bitmasks of their positions, for bit_lcs
+    :param tokens : list of str : tokens from a string split using whitespace
+    :returns: masks (dict): token -> int with bit i set where tokens[i] is that token
+    """
+    masks = {}
+    for i, token in enumerate(tokens):
+        masks[token] = masks.get(token, 0) | (1 << i)
+    return masks
+
+def bit_lcs(masks, length, tokens):
+    """
+    Calculates the length of the longest common subsequence with the bit-parallel algorithm
+    of Allison-Dix / Hyyro, each token of tokens updates all the columns of the DP row at once
+    :param masks : dict : lcs_masks of the first string
+    :param length : int : number of tokens of the first string
+    :param tokens : list of str : tokens of the second string
+    :returns: length (int): length of the longest common subsequence between the two strings
+    """
+    full = (1 << length) - 1
+    v = full
+    for token in tokens:
+        u = v & masks.get(token, 0)
+        if u:
+            v = ((v + u) | (v - u)) & full
+    # the zero bits of v mark the positions where the lcs grows
+    return length - bin(v).count("1")
+
 def my_lcs(string, sub):
     """
     Calculates longest common subsequence for a pair of tokenized strings
@@ -22,16 +51,7 @@ def my_lcs(string, sub):
     if(len(string)< len(sub)):
         sub, string = string, sub
 
-    lengths = [[0 for i in range(0,len(sub)+1)] for j in range(0,len(string)+1)]
-
-    for j in range(1,len(sub)+1):
-        for i in range(1,len(string)+1):
-            if(string[i-1] == sub[j-1]):
-                lengths[i][j] = lengths[i-1][j-1] + 1
-            else:
-                lengths[i][j] = max(lengths[i-1][j] , lengths[i][j-1])
-
-    return lengths[len(string)][len(sub)]
+    return bit_lcs(lcs_masks(sub), len(sub), string)
 
 class Rouge():
     '''
@@ -42,13 +62,25 @@ class Rouge():
         # vrama91: updated the value below based on discussion with Hovey
         self.beta = 1.2
 
-    def calc_score(self, candidate, refs):
+    def calc_score(self, candidate, refs, lcs_cache=None):
         """
         Compute ROUGE-L score given one candidate and references for an image
         :param candidate: str : candidate sentence to be evaluated
         :param refs: list of str : COCO reference sentences for the particular image to be evaluated
+        :param lcs_cache: dict : LCS lengths by (candidate, reference), shared by the calls of compute_score
         :returns score: int (ROUGE-L score for the candidate evaluated against references)
         """
+        prec_max, rec_max = self.calc_stats(candidate, refs, lcs_cache=lcs_cache)
+        return self.score_stats(prec_max, rec_max)
+
+    def calc_stats(self, candidate, refs, lcs_cache=None):
+        """
+        Compute the LCS precision and recall of one candidate, the max over its references
+        :param candidate: str : candidate sentence to be evaluated
+        :param refs: list of str : COCO reference sentences for the particular image to be evaluated
+        :param lcs_cache: dict : see calc_score
+        :returns (prec_max, rec_max): (float, float) (the statistics the ROUGE-L score is computed from)
+        """
         assert(len(candidate)==1)	
         assert(len(refs)>0)         
         prec = []
@@ -56,18 +88,34 @@ class Rouge():
 
         # split into tokens
         token_c = candidate[0].split(" ")
+        # candidate tokens are interned once for all the references, if needed
+        masks_c = None
     	
         for reference in refs:
             # split into tokens
             token_r = reference.split(" ")
             # compute the longest common subsequence
-            lcs = my_lcs(token_r, token_c)
+            key = (candidate[0], reference)
+            if lcs_cache is not None and key in lcs_cache:
+                lcs = lcs_cache[key]
+            else:
+                if masks_c is None:
+                    masks_c = lcs_masks(token_c)
+                lcs = bit_lcs(masks_c, len(token_c), token_r)
+                if lcs_cache is not None:
+                    lcs_cache[key] = lcs
             prec.append(lcs/float(len(token_c)))
             rec.append(lcs/float(len(token_r)))
 
         prec_max = max(prec)
         rec_max = max(rec)
+        return prec_max, rec_max
 
+    def score_stats(self, prec_max, rec_max):
+        """
+        Compute the ROUGE-L score from the statistics returned by calc_stats
+        :returns score: float (ROUGE-L score)
+        """
         if(prec_max!=0 and rec_max !=0):
             score = ((1 + self.beta**2)*prec_max*rec_max)/float(rec_max + self.beta**2*prec_max)
         else:
@@ -84,13 +132,22 @@ class Rouge():
         """
         assert(gts.keys() == res.keys())
         imgIds = gts.keys()
+        stats = self.compute_stats(gts, res, imgIds)
+        return self.eval_stats(stats)
 
-        score = []
+    def compute_stats(self, gts, res, imgIds):
+        """
+        Computes the LCS precision and recall (see calc_stats) of the images imgIds, e.g. a shard of the dataset
+        :returns: stats: list of (float, float) (in the order of imgIds, to be given to eval_stats)
+        """
+        stats = []
+        # repeated (candidate, reference) pairs are only scored once
+        lcs_cache = {}
         for id in imgIds:
             hypo = res[id]
             ref  = gts[id]
 
-            score.append(self.calc_score(hypo, ref))
+            stats.append(self.calc_stats(hypo, ref, lcs_cache=lcs_cache))
 
             # Sanity check.
             assert(type(hypo) is list)
@@ -98,6 +155,14 @@ class Rouge():
             assert(type(ref) is list)
             assert(len(ref) > 0)
 
+        return stats
+
+    def eval_stats(self, stats):
+        """
+        Computes the ROUGE-L scores from the stats of all the images
+        :returns: average_score: float (mean ROUGE-L score), and the scores of each image
+        """
+        score = [self.score_stats(prec_max, rec_max) for prec_max, rec_max in stats]
         average_score = np.mean(np.array(score))
         return average_score, np.array(score)
 
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+#
+# File Name : ptblexer.py
+#
+# Description : Pure python re-implementation of the Stanford CoreNLP 3.4.1
+#               PTBLexer, as run by `PTBTokenizer -preserveLines -lowerCase`.
+#               The rules follow the JFlex longest-match semantics, where the
+#               trailing context of a rule counts towards the match length.
+#               A few rules of the Java lexer (abbreviations, urls, sgml) depend
+#               on long lists and on the following lines, lines hitting them
+#               are reported as not exact so that the caller can tokenize them
+#               with the Java tokenizer instead.
+
+import re
+import sys
+
+# bump this when the tokenization output changes
+PTBLEXER_VERSION = "3.4.1-py.3"
+
+if sys.version_info[0] < 3:
+    NBSP = "\xc2\xa0"  # java outputs utf-8 encoded bytes
+else:
+    NBSP = u"\u00a0"
+
+
+def _ignore_case(regex):
+    """make the letters of a regex case insensitive, python 2 has no scoped (?i:...) flag"""
+    return "".join(["[%s%s]" % (c.lower(), c.upper()) if c.isalpha() else c for c in regex])
+
+
+# ======================================================
+# token definitions, see edu/stanford/nlp/process/PTBLexer.flex
+# ======================================================
+SPACE = r"[ \t]"
+SPACENL = r"[ \t\n]"
+WORD = r"[A-Za-z][A-Za-z0-9]*(?:[.!?][A-Za-z][A-Za-z0-9]*)*"
+REDAUX = r"'(?:[msdMSD]|%s)" % _ignore_case(r"re|ve|ll")
+SWORD = r"[A-Za-z]*[A-MO-Za-mo-z]"
+SREDAUX = r"[nN]['`][tT]"
+NUM = r"[0-9]*(?:[.:,][0-9]+)+|[0-9]+"
+NUMBER = r"[\-+]?(?:%s)" % NUM
+DATE = r"[0-9]{1,2}[\-/][0-9]{1,2}[\-/][0-9]{2,4}"
+FRAC = r"(?:[0-9]{1,4}[- ])?[0-9]{1,4}\\?/[0-9]{1,4}"
+PHONE = r"(?:\([0-9]{2,3}\) ?|(?:\+\+?)?(?:[0-9]{2,4}[\- ])?[0-9]{2,4}[\- /])[0-9]{3,4}[\- ]?[0-9]{3,5}" \
+        r"|(?:(?:\+\+?)?[0-9]{2,4}\.)?[0-9]{2,4}\.[0-9]{3,4}\.[0-9]{3,5}"
+DOLSIGN = r"[A-Z]*\$|#"
+THING_PART = r"(?:[dDoOlL]['`][A-Za-z0-9])?[A-Za-z0-9]+"
+THING = r"%s(?:[-_]%s)*" % (THING_PART, THING_PART)
+THINGA = r"[A-Z]+(?:[+&][A-Z]+)+"
+THING3 = r"[A-Za-z0-9]+(?:-[A-Za-z]+){0,2}(?:\\?/[A-Za-z0-9]+(?:-[A-Za-z]+){0,2}){1,2}"
+ACRO = r"[A-Za-z](?:\.[A-Za-z])+"
+HTHING = r"[A-Za-z0-9][A-Za-z0-9.,]*(?:-(?:[A-Za-z0-9]+|%s\.))+" % ACRO
+ABMONTH = r"Jan|Feb|Mar|Apr|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec"
+ABDAYS = r"Mon|Tue|Tues|Wed|Thu|Thurs|Fri"
+ABSTATE = r"Ala|Ariz|Az|Ark|Calif|Colo|Conn|Ct|Dak|Del|Fla|Ga|Ill|Ind|Kans?|Ky|La|Mass|Md|Mich|Minn|" \
+          r"Miss|Mo|Mont|Neb|Nev|Okla|Ore|Pa|Penn|Tenn|Tex|Va|Vt|Wash|Wisc?|Wyo"
+ABCOMP = r"Inc|Cos?|Corp|Pp?t[ye]s?|Ltd|Plc|Rt|Bancorp|Dept|Bhd|Assn|Univ|Intl|Sys"
+ABNUM = r"tel|est|ext"
+ABNUM3 = _ignore_case(r"art|ca|figs?|nos?|op|pp")
+ABNUM2 = r"Ph|Tel|sq|ft"
+ABPTIT = r"Jr|Sr|Bros|(?:Ed|Ph)\.D|Blvd|Rd|Esq"
+ABBREV1 = r"(?:%s|%s|%s|%s|%s|%s|etc|al|seq|Bldg|[Vv]ol)\." % (ABMONTH, ABDAYS, ABSTATE, ABCOMP, ABNUM, ABPTIT)
+ABTITLE = r"Mr|Mrs|Ms|Miss|Drs?|Profs?|Sens?|Reps?|Attys?|Lt|Col|Gen|Messrs|Govs?|Adm|Rev|Maj|Sgt|Cpl|Pvt|Capt|" \
+          r"Ste?|Ave|Pres|Lieut|Hon|Brig|Co?mdr|Pfc|Spc|Supts?|Det|Mt|Ft|Adj|Adv|Asst|Assoc|Ens|Insp|Mlle|Mme|" \
+          r"Msgr|Sfc"
+ABCOMP2 = r"Invt|Elec|Natl|M[ft]g"
+ABBREV2 = r"(?:%s|%s|%s|%s)\." % (ABTITLE, ACRO, ABCOMP2, ABNUM2)
+ABBREV4 = r"[A-Za-z]|%s|vs|%s|%s|%s" % (_ignore_case(ABTITLE), _ignore_case(r"Alex|Cie|a\.k\.a|TREAS|Wm|Jos|cf"),
+                                        ACRO, ABCOMP2)
+ABBREV3 = r"(?:%s)\." % ABBREV4
+ACRONYM = r"(?:%s)\." % ACRO
+SENTEND = r"%s(?:%s|[A-Z])" % (SPACENL, SPACENL)
+SENTEND_FOLLOW = r"[ \t\n]+(?:About|According|Additionally|After|An|A|As|At|But|Earlier|He|Her|Here|However|" \
+                 r"If|In|It|Last|Many|More|Mr\.|Ms\.|Now|Once|One|Other|Our|She|Since|So|Some|Such|That|The|" \
+                 r"Their|Then|There|These|They|This|We|When|While|What|Yet|You)[ \t\n]"
+APOWORD = [r"'[nN]'", r"[lLdDjJ]'", _ignore_case(r"Dunkin'"), _ignore_case(r"somethin'"), _ignore_case(r"ol'"),
+           r"'[Ee][Mm]", r"[A-HJ-XZn]['`][A-Za-z]{2}[A-Za-z]*", r"'[2-9]0[sS]", _ignore_case(r"'till?"),
+           r"[A-Za-z][A-Za-z]*[aeiouyAEIOUY]['`][aeiouA-Z][A-Za-z]*", _ignore_case(r"'cause"), r"cont'd",
+           _ignore_case(r"cont'd\."), _ignore_case(r"nor'easter"), r"c'mon", r"e'er", r"s'mores",
+           _ignore_case(r"ev'ry"), r"li'l", _ignore_case(r"nat'l"), r"[oO]['`][oO]"]
+FULLURL = r"https?://[^ \t\n\f\r\"<>|()]+[^ \t\n\f\r\"<>|.!?(){},-]"
+LIKELYURL = r"(?:(?:www\.(?:[^ \t\n\f\r\"<>|.!?(){},]+\.)+[a-zA-Z]{2,4})|(?:(?:[^ \t\n\f\r\"`'<>|.!?(){},-_$]+\.)+" \
+            r"(?:com|net|org|edu)))(?:/[^ \t\n\f\r\"<>|()]+[^ \t\n\f\r\"<>|.!?(){},-])?"
+EMAIL = r"[a-zA-Z0-9][^ \t\n\f\r\"<>|(){}]*@(?:[^ \t\n\f\r\"<>|(){}.]+\.)*(?:[^ \t\n\f\r\"<>|(){}\[\].,;:]+)"
+TWITTER = r"@[a-zA-Z_][a-zA-Z_0-9]*|#[A-Za-z]+"
+TBSPEC = _ignore_case(r"-(?:RRB|LRB|RCB|LCB|RSB|LSB)-|C\.D\.s|pro-|anti-|S&P-500|S&Ls|Cap'n|c'est|C#|F#")
+SMILEY = r"[<>]?[:;=][\-o*']?[()DPdpO\\{@|\[\]]"
+ASSIMILATIONS3 = _ignore_case(r"cannot|gonna|gotta|lemme|gimme|wanna")
+
+BRACKETS = {"(": "-LRB-", ")": "-RRB-", "[": "-LSB-", "]": "-RSB-", "{": "-LCB-", "}": "-RCB-"}
+
+
+def _rule(name, regex, trailing_context=None):
+    """compile a lexer rule, the matched token is group 1, the trailing context is not consumed"""
+    if trailing_context is not None:
+        regex = "(%s)(?:%s)" % (regex, trailing_context)
+    else:
+        regex = "(%s)" % regex
+    return name, re.compile(regex)
+
+
+# in case of a tie on the match length, the first rule wins
+RULES = [
+    _rule("sgml", r"</?[A-Za-z!?][^>\r\n]*>"),
+    _rule("assimilation", ASSIMILATIONS3, r"[^A-Za-z0-9]|$"),
+    _rule("word", r"[yY]['`]", r"[aA][lL][lL]|[kK][nN][oO][wW]|[eE][mM]"),
+    _rule("word", r"'[tT]", r"[iI][sS]|[wW][aA][sS]"),
+    _rule("word", WORD, REDAUX),
+    _rule("word", SWORD, SREDAUX),
+] + [_rule("word", a) for a in APOWORD] + [
+    _rule("word", FULLURL),
+    _rule("word", LIKELYURL),
+    _rule("word", EMAIL),
+    _rule("word", TWITTER),
+    _rule("word", REDAUX, r"[^A-Za-z]|$"),
+    _rule("word", SREDAUX, r"[^A-Za-z]|$"),
+    _rule("word", WORD),
+    _rule("word", DATE),
+    _rule("word", NUMBER),
+    _rule("frac", FRAC),
+    _rule("word", TBSPEC),
+    _rule("word", THING3),
+    _rule("word", DOLSIGN),
+    _rule("sentence_end", ACRONYM, SENTEND_FOLLOW),
+    _rule("sentence_end", ABBREV1, SENTEND),
+    _rule("word", ABBREV1, r"[\s\S][\s\S]"),
+    _rule("sentence_end", ABBREV1),
+    _rule("word", ABBREV2),
+    _rule("word", ABBREV3, SPACE),
+    _rule("word", ABBREV3, r"\n|$"),
+    _rule("letter_end", r"[A-Za-z]\.", SENTEND_FOLLOW),
+    _rule("word", r"(?:%s)\." % ABNUM3, r"[ \t\n]?[0-9]"),
+    _rule("word", ACRO, SPACENL),
+    _rule("word", r"'[0-9][0-9]", SPACENL),
+    _rule("word", r"(?:%s|%s|%s)\." % (WORD, THING, THINGA), r"[,;:]"),
+    _rule("phone", PHONE),
+    _rule("open_dblquote", r"\"", r"[A-Za-z0-9$]"),
+    _rule("close_dblquote", r"\""),
+    _rule("word", r"<|>"),
+    _rule("bracket", r"[{}\[\]()]"),
+    _rule("hyphens", r"-+"),
+    _rule("ldots", r"\.\.\.+", r"\.[ \t\n]+[A-Za-z]"),
+    _rule("ldots", r"\.\.\.+"),
+    _rule("ldots", r"\. \. \."),
+    _rule("word", r"@+|#+|_+"),
+    _rule("word", r"\*+|(?:\\\*){1,3}"),
+    _rule("word", r"[,;:]"),
+    _rule("word", r"\.|[?!]+"),
+    _rule("word", r"=|/"),
+    _rule("word", THING),
+    _rule("word", HTHING),
+    _rule("word", THINGA),
+    _rule("quote", r"''?|`{1,2}"),
+    _rule("word", r"'[nN]", r"[ \t\n]|$"),
+    _rule("word", r"<<|>>"),
+    _rule("word", r"[+%&~^|\\]"),
+    _rule("smiley", SMILEY, r"[^A-Za-z0-9]|$"),
+]
+
+# fast paths for the bulk of the caption text, plain words and sentence punctuations
+ALPHA_WORD = re.compile(r"[A-Za-z]+(?=[ \t\n]|[,;:?!.](?:[ \t\n]|$)|$)")
+FAST_PUNCT = re.compile(r"(?:[,;]|[?!]+)(?=[ \t\n]|$)|\.(?=\n|$)")
+SIMPLE_LINE = re.compile(r"[A-Za-z ,;?!.\t]*$")
+SIMPLE_LINE_EXCEPTION = re.compile(r"[,;?!.][^ \t]|[^A-Za-z]\.|\.[ \t]*\S|cannot|gonna|gotta|lemme|gimme|wanna")
+SIMPLE_TOKEN = re.compile(r"[a-z]+|[?!]+|[,;.]")
+# words handled by the rules only, assimilations and abbreviations before a number, e.g. "no. 5"
+SLOW_WORDS = {"cannot", "gonna", "gotta", "lemme", "gimme", "wanna",
+              "art", "ca", "fig", "figs", "no", "nos", "op", "pp"}
+
+# lines the Java lexer may tokenize differently, i.e. abbreviations, urls, emails, sgml and html entities,
+# file names (e.g. "7.h"), "+" and "&" words (e.g. "C++", "S&Ls"), smileys with "_" (e.g. "-_-")
+# and parenthesized smileys (e.g. "(~')", "(^_^)", "(xx)")
+ABBREVIATION = re.compile(r"(?i)(?:[a-z](?:\.[a-z])*|%s)\." % "|".join(
+    [ABMONTH, ABDAYS, ABSTATE, ABCOMP, ABNUM, ABNUM2, ABPTIT, ABTITLE, ABCOMP2,
+     r"etc|al|seq|Bldg|vol|Prop|vs|Alex|Cie|a\.k\.a|TREAS|Wm|Jos|cf"]))
+DOTTED_WORD = re.compile(r"[A-Za-z][A-Za-z.]*\.")
+# abbreviations before a number ending a line, depend on whether the next line starts with a number
+NUMBER_ABBREVIATION_END = re.compile(r"(?<![A-Za-z])(?:%s)\.$" % ABNUM3)
+NOT_EXACT = re.compile(r"www\.|://|@|&#?[A-Za-z0-9]+;|\.(?:com|net|org|edu)|[<>]|[^\t\x20-\x7e]"
+                       r"|(?<![A-Za-z0-9])[yY]['`](?![aA][lL][lL]|[kK][nN][oO][wW]|[eE][mM])[A-Za-z]"
+                       r"|\+|[A-Za-z]&[A-Za-z]|[0-9][A-Za-z0-9]*\.[A-Za-z]|[^A-Za-z0-9 \t]_|_[^A-Za-z0-9 \t]"
+                       r"|\((?=[^ \t()]*[^A-Za-z0-9 \t()])[^ \t()]{2,}\)|\(xx\)")
+
+
+def _is_exact_line(line):
+    if NOT_EXACT.search(line):
+        return False
+    if "." in line:
+        for m in DOTTED_WORD.finditer(line):
+            # an abbreviation may start the word, follow a dot or a lowercase letter (e.g. "'emMr.")
+            word = m.group()
+            if m.start() > 0 and line[m.start() - 1] in "'`" and word.lower() in ("s.", "d.", "m.", "t."):
+                continue  # 's, 'd, 'm, n't
+            for i, c in enumerate(word):
+                if (i == 0 or word[i - 1] == "." or (c.isupper() and word[i - 1].islower())) \
+                        and ABBREVIATION.match(word, i):
+                    return False
+    return True
+
+
+def _is_exact_tokens(tokens):
+    for i, token in enumerate(tokens):
+        if len(token) > 1 and token[-1] == "." and token[-2].isalpha():
+            return False
+        if token.isalpha() and i + 1 < len(tokens) and tokens[i + 1][0] == "." \
+                and ABBREVIATION.match(token + "."):
+            return False
+    return True
+
+
+def _convert(name, token, text, end):
+    """map a matched token to the output tokens, as done by the actions of the Java lexer"""
+    if name == "assimilation":
+        return [token[:3], token[3:]]
+    elif name == "sentence_end":
+        return [token, "."]
+    elif name == "letter_end":
+        return [token[0], "."]
+    elif name == "bracket":
+        return [BRACKETS[token]]
+    elif name == "smiley":
+        return [token.replace("(", "-LRB-").replace(")", "-RRB-")]
+    elif name == "hyphens":
+        return ["--"] if 3 <= len(token) <= 4 else [token]
+    elif name == "ldots":
+        return ["..."]
+    elif name in ("frac", "phone"):
+        return ["".join([BRACKETS.get(c, c) for c in token.replace(" ", NBSP)])]
+    elif name == "open_dblquote":
+        return ["``"]
+    elif name == "close_dblquote":
+        return ["''"]
+    elif name == "quote" and token == "'" and text[end:end + 1].isalpha() and text[end + 1:end + 2].strip():
+        return ["`"]
+    return [token]
+
+
+def lex(text, end=None):
+    """
+    Args:
+        text: str, the text to tokenize
+        end: int, only tokenize text[:end], the rest of the text is only used as the trailing context of the rules
+    Returns:
+        tokens: list(str), PTB tokens, not lowercased
+    """
+    tokens = []
+    pos = 0
+    n = len(text) if end is None else end
+    while pos < n:
+        c = text[pos]
+        if c in " \t\n":
+            pos += 1
+            continue
+        m = ALPHA_WORD.match(text, pos)
+        if m and m.group().lower() not in SLOW_WORDS and (
+                text[m.end():m.end() + 1] != "." or (m.end() - pos > 1 and not ABBREVIATION.match(text, pos))):
+            tokens.append(m.group())
+            pos = m.end()
+            continue
+        m = FAST_PUNCT.match(text, pos)
+        if m:
+            tokens.append(m.group())
+            pos = m.end()
+            continue
+        best_name, best_match = None, None
+        for name, rule in RULES:
+            m = rule.match(text, pos)
+            if m is not None and m.end(1) > pos and (best_match is None or m.end() > best_match.end()):
+                best_name, best_match = name, m
+        if best_match is None:
+            tokens.append(c)
+            pos += 1
+            continue
+        pos = best_match.end(1)
+        tokens.extend(_convert(best_name, best_match.group(1), text, pos))
+    return tokens
+
+
+def tokenize_simple(line):
+    """
+    Args:
+        line: str, a single sentence, without '\n'
+    Returns:
+        list(str), lowercased PTB tokens of a simple sentence, which only depend on the sentence itself
+            and are the same as the Java PTBTokenizer output, None for other sentences.
+    """
+    if sys.version_info[0] < 3:
+        line = line.encode("utf-8") if isinstance(line, unicode) else line
+    if SIMPLE_LINE.match(line) and not NUMBER_ABBREVIATION_END.search(line):
+        lowered = line.lower()
+        if not SIMPLE_LINE_EXCEPTION.search(lowered) and _is_exact_line(line):
+            return SIMPLE_TOKEN.findall(lowered)
+    return None
+
+
+def tokenize(line, next_line=None):
+    """
+    Args:
+        line: str, a single sentence, without '\n'
+        next_line: str, the following sentence, a few rules of the Java lexer look ahead across lines.
+            None if it is the last line of the input, which the Java lexer treats differently
+    Returns:
+        tokens: list(str), lowercased PTB tokens, punctuations are not removed
+        exact: bool, whether the tokens are guaranteed to be the same as the Java PTBTokenizer output,
+            if False, the tokens are only a best guess and the line should be tokenized with Java
+    """
+    if sys.version_info[0] < 3:
+        line = line.encode("utf-8") if isinstance(line, unicode) else line
+        next_line = next_line.encode("utf-8") if isinstance(next_line, unicode) else next_line
+    tokens = tokenize_simple(line)
+    if tokens is not None:
+        return tokens, True
+    text = line if next_line is None else line + "\n" + next_line
+    tokens = [t.lower() for t in lex(text, len(line))]
+    return tokens, _is_exact_line(line) and _is_exact_tokens(tokens)
@@ -11,8 +11,11 @@
 import os
 import sys
 import subprocess
-import tempfile
+import re
+import threading
 import itertools
+from distutils.spawn import find_executable
+import ptblexer
 
 # path to the stanford corenlp jar
 STANFORD_CORENLP_3_4_1_JAR = 'stanford-corenlp-3.4.1.jar'
@@ -21,48 +24,196 @@ STANFORD_CORENLP_3_4_1_JAR = 'stanford-corenlp-3.4.1.jar'
 PUNCTUATIONS = ["''", "'", "``", "`", "-LRB-", "-RRB-", "-LCB-", "-RCB-", \
         ".", "?", "!", ",", ":", "-", "--", "...", ";"] 
 
+# the Java tokenizer only writes its output when the output buffer is full or at the end of the input,
+# so each batch of sentences streamed to it ends with a marker line followed by padding lines
+END_OF_BATCH = 'ptbtokenizerendofbatch'
+PADDING_LINE = ' '.join(['ptbtokenizerpadding'] * 1000)
+N_PADDING_LINES = 2
+
+# characters other than '\n' that the Java tokenizer treats as line breaks
+LINE_BREAKS = re.compile('[\r\x0b\x0c]')
+
 class PTBTokenizer:
     """Python wrapper of Stanford PTBTokenizer"""
 
-    def tokenize(self, captions_for_image):
-        cmd = ['java', '-cp', STANFORD_CORENLP_3_4_1_JAR, \
-                'edu.stanford.nlp.process.PTBTokenizer', \
-                '-preserveLines', '-lowerCase']
+    def __init__(self, use_java=False):
+        # by default, sentences are tokenized in-process with ptblexer, only the few sentences
+        # it cannot guarantee to tokenize the same way as the Java tokenizer are sent to Java.
+        # use_java=True tokenizes all the sentences with the Java tokenizer.
+        # The Java tokenizer is a single process reused by all the calls, call close() to stop it.
+        # Without java, the sentences ptblexer cannot tokenize exactly keep its best guess,
+        # which version() tells apart from the exact tokenization.
+        self.use_java = use_java
+        self.java_available = find_executable('java') is not None
+        self.java_worker = None
+
+    def version(self):
+        """str, changes whenever the tokenization output may change, e.g. to key cached results"""
+        if self.use_java:
+            return "java-3.4.1"
+        if not self.java_available:
+            return "py-" + ptblexer.PTBLEXER_VERSION + "-nojava"
+        return "py-" + ptblexer.PTBLEXER_VERSION
 
+    def tokenize(self, captions_for_image):
         # ======================================================
         # prepare data for PTB Tokenizer
         # ======================================================
         final_tokenized_captions_for_image = {}
         image_id = [k for k, v in captions_for_image.items() for _ in range(len(v))]
-        sentences = '\n'.join([c['caption'].replace('\n', ' ') for k, v in captions_for_image.items() for c in v])
-
-        # ======================================================
-        # save sentences to temporary file
-        # ======================================================
-        path_to_jar_dirname=os.path.dirname(os.path.abspath(__file__))
-        tmp_file = tempfile.NamedTemporaryFile(delete=False, dir=path_to_jar_dirname)
-        tmp_file.write(sentences)
-        tmp_file.close()
+        sentences = [c['caption'].replace('\n', ' ') for k, v in captions_for_image.items() for c in v]
 
         # ======================================================
         # tokenize sentence
         # ======================================================
-        cmd.append(os.path.basename(tmp_file.name))
-        p_tokenizer = subprocess.Popen(cmd, cwd=path_to_jar_dirname, \
-                stdout=subprocess.PIPE)
-        token_lines = p_tokenizer.communicate(input=sentences.rstrip())[0]
-        lines = token_lines.split('\n')
-        # remove temp file
-        os.remove(tmp_file.name)
+        if self.use_java:
+            lines = [line.rstrip().split(' ') for line in self.tokenize_java(sentences)]
+        else:
+            lines = self.tokenize_python(sentences)
 
         # ======================================================
         # create dictionary for tokenized captions
         # ======================================================
-        for k, line in zip(image_id, lines):
+        for k, tokens in zip(image_id, lines):
             if not k in final_tokenized_captions_for_image:
                 final_tokenized_captions_for_image[k] = []
-            tokenized_caption = ' '.join([w for w in line.rstrip().split(' ') \
+            tokenized_caption = ' '.join([w for w in tokens \
                     if w not in PUNCTUATIONS])
             final_tokenized_captions_for_image[k].append(tokenized_caption)
 
         return final_tokenized_captions_for_image
+
+    def tokenize_python(self, sentences):
+        """
+        Args:
+            sentences: list(str), sentences without '\n'
+        Returns:
+            list(list(str)), lowercased tokens of each sentence, same as the Java tokenizer output
+        """
+        lines = []
+        inexact_ids = []
+        # the tokens of simple sentences do not depend on the following sentence,
+        # so repeated ones, e.g. the generic captions of a weak model, are only tokenized once
+        simple_tokens = {}
+        for i, sentence in enumerate(sentences):
+            if sentence in simple_tokens:
+                lines.append(simple_tokens[sentence])
+                continue
+            tokens = ptblexer.tokenize_simple(sentence)
+            if tokens is not None:
+                simple_tokens[sentence] = tokens
+                lines.append(tokens)
+                continue
+            next_sentence = sentences[i + 1] if i + 1 < len(sentences) else None
+            tokens, exact = ptblexer.tokenize(sentence, next_line=next_sentence)
+            lines.append(tokens)
+            if not exact:
+                inexact_ids.append(i)
+        if len(inexact_ids) == 0:
+            return lines
+        if not self.java_available:
+            sys.stderr.write("java is not available, %d sentences might be tokenized differently "
+                             "from the Stanford PTBTokenizer\n" % len(inexact_ids))
+            return lines
+
+        # the Java lexer looks ahead across lines, e.g. "Mr." followed by a capitalized word,
+        # so each inexact sentence is sent along with the following sentences up to a non-empty one.
+        ranges = []
+        for i in inexact_ids:
+            end = i + 1
+            while end < len(sentences) and not sentences[end].strip():
+                end += 1
+            end = min(end + 1, len(sentences))
+            if len(ranges) > 0 and i <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([i, end])
+        range_ids = [i for st, ed in ranges for i in range(st, ed)]
+        # java was found, a failure to run it is an error, the best guess tokens are not returned
+        # as they would be cached under the exact version()
+        java_lines = self.tokenize_java([sentences[i] for i in range_ids])
+        id2java_line = dict(zip(range_ids, java_lines))
+        for i in inexact_ids:
+            if i in id2java_line:
+                lines[i] = id2java_line[i].rstrip().split(' ')
+        return lines
+
+    def tokenize_java(self, sentences):
+        """
+        Args:
+            sentences: list(str), sentences without '\n'
+        Returns:
+            list(str), one line of space separated tokens for each sentence
+        """
+        # the Java tokenizer is started on first use, and kept running for the following calls
+        if self.java_worker is None:
+            self.java_worker = PTBTokenizerWorker()
+        return self.java_worker.tokenize(sentences)
+
+    def close(self):
+        if self.java_worker is not None:
+            self.java_worker.close()
+            self.java_worker = None
+
+
+class PTBTokenizerWorker:
+    """A long-running Stanford PTBTokenizer process, sentences are streamed to it line by line"""
+
+    def __init__(self):
+        cmd = ['java', '-cp', STANFORD_CORENLP_3_4_1_JAR, \
+                'edu.stanford.nlp.process.PTBTokenizer', \
+                '-preserveLines', '-lowerCase']
+        # buffered pipes, the output is read line by line
+        self.p_tokenizer = subprocess.Popen(cmd, bufsize=-1, \
+                cwd=os.path.dirname(os.path.abspath(__file__)), \
+                stdin=subprocess.PIPE, \
+                stdout=subprocess.PIPE)
+        # number of padding lines of the previous batch that are not read yet
+        self.n_pending_lines = 0
+        # Used to guarantee thread safety
+        self.lock = threading.Lock()
+
+    def tokenize(self, sentences):
+        """
+        Args:
+            sentences: list(str), sentences without '\n'
+        Returns:
+            list(str), one line of space separated tokens for each sentence
+        """
+        # the lexer also breaks lines at these characters, which would shift the output lines
+        sentences = [LINE_BREAKS.sub(' ', sentence) for sentence in sentences]
+        # the batch is followed by an empty line, which the lexer treats like the end of the input for
+        # sentence final abbreviations, then by the end of batch line and the padding lines.
+        data = '\n'.join(sentences + ['', END_OF_BATCH] + [PADDING_LINE] * N_PADDING_LINES) + '\n'
+
+        self.lock.acquire()
+        try:
+            # the tokenizer stops reading when its stdout pipe is full,
+            # so the sentences are written from another thread while the tokens are read.
+            writer = threading.Thread(target=self._write, args=(data,))
+            writer.start()
+            for _ in range(self.n_pending_lines):
+                self.p_tokenizer.stdout.readline()
+            token_lines = [self.p_tokenizer.stdout.readline().rstrip('\n') for _ in range(len(sentences) + 2)]
+            writer.join()
+            self.n_pending_lines = N_PADDING_LINES
+        finally:
+            self.lock.release()
+        if token_lines[-1] != END_OF_BATCH:
+            raise RuntimeError("PTBTokenizer output is out of sync with its input")
+        return token_lines[:-2]
+
+    def _write(self, data):
+        self.p_tokenizer.stdin.write(data)
+        self.p_tokenizer.stdin.flush()
+
+    def close(self):
+        self.lock.acquire()
+        if self.p_tokenizer.poll() is None:
+            self.p_tokenizer.stdin.close()
+            self.p_tokenizer.kill()
+            self.p_tokenizer.wait()
+        self.lock.release()
+
+    def __del__(self):
+        self.close()
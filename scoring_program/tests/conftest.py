@@ -0,0 +1,20 @@
+import os
+import sys
+from distutils.spawn import find_executable
+import pytest
+
+# the evaluation modules import each other as top level modules, as when run from scoring_program
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+requires_java = pytest.mark.skipif(find_executable("java") is None, reason="java is not available")
+
+# the words of the random sentences of the scorer tests, a small vocabulary so that they share many n-grams
+VOCAB = ["a", "man", "woman", "is", "cutting", "the", "onion", "with", "knife", "and", "then", "on"]
+
+
+def random_tokens(rng, max_len, vocab_size=len(VOCAB)):
+    return [rng.choice(VOCAB[:vocab_size]) for _ in range(rng.randint(0, max_len))]
+
+
+def random_sentence(rng, max_len=12):
+    return " ".join(random_tokens(rng, max_len))
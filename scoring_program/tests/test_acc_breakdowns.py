@@ -0,0 +1,16 @@
+from evaluate_how2qa import eval_qa, eval_qa_breakdowns
+from evaluate_vlep import MISSING_FIELD_VALUE, get_acc_breakdowns
+
+
+def test_breakdown_keeps_mixed_value_types():
+    gt_data = [{"tag": 1}, {"tag": "1"}, {"tag": 1}, {"tag": [0, 1]}, {}]
+    breakdowns = get_acc_breakdowns([True, False, False, True, True], gt_data, ["tag"])
+    assert breakdowns == {"tag": {1: 50.0, "1": 0.0, "[0, 1]": 100.0, MISSING_FIELD_VALUE: 100.0}}
+
+
+def test_eval_qa_breakdowns():
+    gt = [{"qid": 100, "answer_idx": 0, "vid_name": "a"}, {"qid": 101, "answer_idx": 3, "vid_name": "a"},
+          {"qid": 102, "answer_idx": 1, "vid_name": "b"}]
+    submission = {"100": 0, "101": 2, "102": 1}
+    assert eval_qa(submission, gt) == 66.67
+    assert eval_qa_breakdowns(submission, gt, ["vid_name"]) == {"vid_name": {"a": 50.0, "b": 100.0}}
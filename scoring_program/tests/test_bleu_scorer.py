@@ -0,0 +1,76 @@
+import math
+import random
+import pytest
+from pycocoevalcap.bleu.bleu import Bleu
+from pycocoevalcap.bleu.bleu_scorer import BleuScorer, cook_refs, cook_test
+from conftest import random_sentence
+
+
+def random_captions(seed, n_images=200):
+    rng = random.Random(seed)
+    gts = {i: [random_sentence(rng) for _ in range(rng.randint(1, 5))] for i in range(n_images)}
+    res = {i: [random_sentence(rng)] for i in range(n_images)}
+    return gts, res
+
+
+def baseline_compute_score(ctest, n, option):
+    """the per sentence loop of BleuScorer.compute_score before it was vectorized"""
+    small = 1e-9
+    tiny = 1e-15
+    bleu_list = [[] for _ in range(n)]
+    totalcomps = {'testlen': 0, 'reflen': 0, 'guess': [0] * n, 'correct': [0] * n}
+    for comps in ctest:
+        testlen = comps['testlen']
+        totalcomps['testlen'] += testlen
+        reflens = comps['reflen']
+        if option == "shortest":
+            reflen = min(reflens)
+        elif option == "average":
+            reflen = float(sum(reflens)) / len(reflens)
+        else:
+            reflen = min((abs(l - testlen), l) for l in reflens)[1]
+        totalcomps['reflen'] += reflen
+        for key in ['guess', 'correct']:
+            for k in range(n):
+                totalcomps[key][k] += comps[key][k]
+        bleu = 1.
+        for k in range(n):
+            bleu *= (float(comps['correct'][k]) + tiny) / (float(comps['guess'][k]) + small)
+            bleu_list[k].append(bleu ** (1. / (k + 1)))
+        ratio = (testlen + tiny) / (reflen + small)
+        if ratio < 1:
+            for k in range(n):
+                bleu_list[k][-1] *= math.exp(1 - 1 / ratio)
+
+    bleus = []
+    bleu = 1.
+    for k in range(n):
+        bleu *= float(totalcomps['correct'][k] + tiny) / (totalcomps['guess'][k] + small)
+        bleus.append(bleu ** (1. / (k + 1)))
+    ratio = (totalcomps['testlen'] + tiny) / (totalcomps['reflen'] + small)
+    if ratio < 1:
+        for k in range(n):
+            bleus[k] *= math.exp(1 - 1 / ratio)
+    return bleus, bleu_list
+
+
+@pytest.mark.parametrize("option", ["closest", "average", "shortest"])
+@pytest.mark.parametrize("seed", [0, 1])
+def test_bleu_scorer_matches_baseline(option, seed):
+    gts, res = random_captions(seed)
+    scorer = BleuScorer(n=4)
+    for i in sorted(gts):
+        scorer += (res[i][0], gts[i])
+    score, scores = scorer.compute_score(option=option)
+    baseline_score, baseline_scores = baseline_compute_score(scorer.ctest, 4, option)
+    assert score == baseline_score
+    assert scores == baseline_scores
+
+
+def test_bleu_matches_baseline():
+    gts, res = random_captions(2)
+    score, scores = Bleu(4).compute_score(gts, res)
+    ctest = [cook_test(res[i][0], cook_refs(gts[i])) for i in gts.keys()]
+    baseline_score, baseline_scores = baseline_compute_score(ctest, 4, "closest")
+    assert score == baseline_score
+    assert scores == baseline_scores
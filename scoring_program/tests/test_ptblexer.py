@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import pytest
+from pycocoevalcap.tokenizer import ptblexer
+from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer, PTBTokenizerWorker
+from conftest import requires_java
+
+# sentences hitting the less common rules of the Java lexer, one per line, in this order
+ADVERSARIAL_SENTENCES = [
+    "a man is cutting an onion with a knife.",
+    "don't do it, it's what they've said we'd do.",
+    "I can't, won't and cannot go; gonna wanna gotta.",
+    "THEY'VE said WE'RE fine and You'Ll see 'VE",
+    "C++ and C# and F# are programming languages",
+    "-_- is a smiley, so are :-) and ;) and :D",
+    "o'o O'o o'O o`o y'all y'know y'am",
+    "7.h and 3.x and 1ab.c and 1.a and 1ab.ee and 7.txt",
+    "'90S huis\xe2\x80\xa6 and '90s and '90S",
+    "S&lS/aee and S&Ls and s&ls and AT&T and A&B and a&b",
+    "'e* 'ab '5l 'e 'e 'e' x 'e. )'T'rn y3E'O- Y3E'O ab'c",
+    "'N x 'N, 'n' 'cause 'Till 'TIL 'til 'em 'EM 'twas",
+    "Dunkin' SOMETHIN' OL' ol` nat'l NAT'L ev'ry EV'RY nor'easter NOR'EASTER",
+    "cont'd CONT'D Cont'd. cont'd. cap'n Cap'N CAP'N c'est C'EST c'mon",
+    "PRO- Anti- pro-life -RRB- -rrb- -Lcb- S&P-500 s&p-500 c.d.s C.D.S",
+    "x+y x++ I+Is+ a_b x_ _x __ ___ a__b -_ _- *_*",
+    "Mr. Smith and Mrs. Smith went to Washington D.C. on Jan. 5",
+    "the U.S. is big. The end.",
+    "see fig. 5 and no. 7 and pp. 10-12",
+    "call (555) 123-4567 or +1 555.123.4567 at 3/4 past 1 1/2",
+    "\"quoted\" text with ``double'' quotes and 'single' ones",
+    "[brackets] (parens) {braces} <tags> and www.example.com or a@b.com",
+    "... .. . . . !!! ??? ?! -- --- ---- - / = \\ | ~ ^ % $ # @",
+    "",
+    "e.g. i.e. etc. vs. al. Inc. Corp. Ltd. Jr. Sr.",
+    "he said 'hello' and left.",
+    "a (~') b (^_^) (^^) (x_x) (xx) (XX) ('~) (-.-) (...) (?) (ab)",
+]
+
+
+@pytest.fixture(scope="module")
+def java_worker():
+    worker = PTBTokenizerWorker()
+    yield worker
+    worker.close()
+
+
+def lex_sentences(sentences):
+    return [ptblexer.tokenize(sentence, sentences[i + 1] if i + 1 < len(sentences) else None)
+            for i, sentence in enumerate(sentences)]
+
+
+@requires_java
+def test_exact_lines_match_java(java_worker):
+    java_lines = java_worker.tokenize(ADVERSARIAL_SENTENCES)
+    for sentence, (tokens, exact), java_line in zip(ADVERSARIAL_SENTENCES, lex_sentences(ADVERSARIAL_SENTENCES),
+                                                    java_lines):
+        if exact:
+            assert tokens == java_line.split(), sentence
+
+
+@requires_java
+@pytest.mark.parametrize("sentence, java_tokens", [
+    ("C++", "c++"),
+    ("-_-", "-_-"),
+    ("o'o", "o'o"),
+    ("7.h", "7.h"),
+    ("'90S\xe2\x80\xa6", "'90s ..."),
+    ("S&lS/aee", "s&ls / aee"),
+    ("(~')", "-lrb-~'-rrb-"),
+    ("(xx)", "-lrb-xx-rrb-"),
+])
+def test_lexer_matches_java_when_exact(java_worker, sentence, java_tokens):
+    assert java_worker.tokenize([sentence]) == [java_tokens]
+    tokens, exact = ptblexer.tokenize(sentence)
+    assert not exact or tokens == java_tokens.split()
+
+
+@requires_java
+def test_tokenizer_matches_java():
+    captions = {i: [{"caption": sentence}] for i, sentence in enumerate(ADVERSARIAL_SENTENCES)}
+    tokenizer = PTBTokenizer()
+    java_tokenizer = PTBTokenizer(use_java=True)
+    try:
+        assert tokenizer.tokenize(captions) == java_tokenizer.tokenize(captions)
+    finally:
+        tokenizer.close()
+        java_tokenizer.close()
+
+
+def test_tokenizer_without_java():
+    tokenizer = PTBTokenizer()
+    exact_version = tokenizer.version()
+    tokenizer.java_available = False
+
+    def fail(sentences):
+        raise AssertionError("java is not available")
+
+    tokenizer.tokenize_java = fail
+    # the best guess tokens of the inexact sentences are not cached under the exact version
+    assert tokenizer.version() != exact_version
+    assert tokenizer.tokenize({0: [{"caption": "C++ (~') is fun."}]}) == {0: ["c + + -lrb- ~ -rrb- is fun"]}
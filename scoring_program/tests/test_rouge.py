@@ -0,0 +1,40 @@
+import random
+import pytest
+from pycocoevalcap.rouge.rouge import Rouge, bit_lcs, lcs_masks, my_lcs
+from conftest import random_sentence, random_tokens
+
+
+def dp_lcs(string, sub):
+    """the dynamic programming my_lcs before the bit-parallel one"""
+    lengths = [[0 for i in range(0, len(sub) + 1)] for j in range(0, len(string) + 1)]
+    for j in range(1, len(sub) + 1):
+        for i in range(1, len(string) + 1):
+            if string[i - 1] == sub[j - 1]:
+                lengths[i][j] = lengths[i - 1][j - 1] + 1
+            else:
+                lengths[i][j] = max(lengths[i - 1][j], lengths[i][j - 1])
+    return lengths[len(string)][len(sub)]
+
+
+@pytest.mark.parametrize("max_len, vocab_size", [(8, 2), (20, 5), (100, 12)])
+def test_bit_lcs_matches_dp(max_len, vocab_size):
+    rng = random.Random(max_len)
+    for _ in range(300):
+        a = random_tokens(rng, max_len, vocab_size)
+        b = random_tokens(rng, max_len, vocab_size)
+        assert bit_lcs(lcs_masks(a), len(a), b) == dp_lcs(b, a)
+        assert my_lcs(a, b) == my_lcs(b, a) == dp_lcs(a, b)
+
+
+def test_rouge_matches_dp():
+    rng = random.Random(0)
+    gts = {i: [random_sentence(rng, 15) for _ in range(rng.randint(1, 5))] for i in range(200)}
+    res = {i: [random_sentence(rng, 15)] for i in range(200)}
+    rouge = Rouge()
+    _, scores = rouge.compute_score(gts, res)
+    for i, score in zip(gts.keys(), scores.tolist()):
+        token_c = res[i][0].split(" ")
+        lcs = [dp_lcs(ref.split(" "), token_c) for ref in gts[i]]
+        prec_max = max(l / float(len(token_c)) for l in lcs)
+        rec_max = max(l / float(len(ref.split(" "))) for l, ref in zip(lcs, gts[i]))
+        assert score == rouge.score_stats(prec_max, rec_max)
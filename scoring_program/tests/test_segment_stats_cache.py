@@ -0,0 +1,119 @@
+import json
+import os
+import evaluate_tvc
+from evaluate_tvc import SegmentStatsCache, TVRCaptionEval
+from pycocoevalcap.meteor.meteor import MeteorPool
+from conftest import requires_java
+
+GT_CAPTIONS = {
+    1: ["a man cuts an onion with a knife.", "someone is chopping an onion."],
+    2: ["a woman pours water into a pot.", "water is poured in the pot."],
+    3: ["the man adds salt to the soup.", "salt is added to the soup."],
+}
+PRED_CAPTIONS = {1: "a man is cutting an onion.", 2: "a woman pours water.", 3: "the man adds some salt."}
+
+
+def test_cache_round_trip(tmpdir):
+    cache_dir = str(tmpdir)
+    cache = SegmentStatsCache(cache_dir=cache_dir)
+    key = SegmentStatsCache.key(1, "a man", ["a man", "a woman"], "v1")
+    assert cache.get(key) is None
+    assert not cache.modified
+    cache.save()
+    assert not os.path.exists(cache.cache_path)
+
+    entry = ("stats line", {"testlen": 2}, (1.0, 0.5))
+    cache.put(key, entry)
+    assert cache.modified
+    cache.save()
+    assert not cache.modified
+
+    cache = SegmentStatsCache(cache_dir=cache_dir)
+    assert cache.get(key) == entry
+    assert not cache.modified
+    # any change of the prediction, the references or the version is a miss
+    assert cache.get(SegmentStatsCache.key(1, "a man", ["a man"], "v1")) is None
+    assert cache.get(SegmentStatsCache.key(1, "a woman", ["a man", "a woman"], "v1")) is None
+    assert cache.get(SegmentStatsCache.key(1, "a man", ["a man", "a woman"], "v2")) is None
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    cache = SegmentStatsCache(cache_dir=str(tmpdir), max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def write_captions(tmpdir):
+    gt_path = str(tmpdir.join("gt.jsonl"))
+    pred_path = str(tmpdir.join("pred.jsonl"))
+    with open(gt_path, "w") as f:
+        for clip_id, captions in sorted(GT_CAPTIONS.items()):
+            f.write(json.dumps({"clip_id": clip_id, "descs": [{"desc": c} for c in captions]}) + "\n")
+    with open(pred_path, "w") as f:
+        for clip_id, caption in sorted(PRED_CAPTIONS.items()):
+            f.write(json.dumps({"clip_id": clip_id, "descs": [{"desc": caption}]}) + "\n")
+    return pred_path, gt_path
+
+
+@requires_java
+def test_cached_stats_give_the_same_scores(tmpdir):
+    pred_path, gt_path = write_captions(tmpdir)
+    cache_dir = str(tmpdir.join("cache"))
+
+    meteor_pool = MeteorPool()
+
+    def make_eval(stats_cache):
+        return TVRCaptionEval(pred_path, gt_path, cache_dir=cache_dir, parallel=False, meteor_pool=meteor_pool,
+                              stats_cache=stats_cache)
+
+    try:
+        tvc_eval = make_eval(None)
+        tvc_eval.evaluate()
+        expected = tvc_eval.eval_res
+
+        cache = SegmentStatsCache(cache_dir=cache_dir)
+        tvc_eval = make_eval(cache)
+        tvc_eval.evaluate()
+        assert tvc_eval.eval_res == expected
+        assert len(cache.entries) == len(GT_CAPTIONS)
+        cache.save()
+
+        # all the clips are found in the reloaded cache, their stats are not computed again
+        cache = SegmentStatsCache(cache_dir=cache_dir)
+        tvc_eval = make_eval(cache)
+
+        def fail(*args):
+            raise AssertionError("cached clips are scored again")
+
+        tvc_eval.compute_stats = fail
+        tvc_eval.evaluate()
+        assert tvc_eval.eval_res == expected
+        assert not cache.modified
+    finally:
+        meteor_pool.close()
+
+
+@requires_java
+def test_single_shard_is_computed_in_process(tmpdir, monkeypatch):
+    pred_path, gt_path = write_captions(tmpdir)
+    cache_dir = str(tmpdir.join("cache"))
+    meteor_pool = MeteorPool()
+    try:
+        tvc_eval = TVRCaptionEval(pred_path, gt_path, cache_dir=cache_dir, parallel=False, meteor_pool=meteor_pool)
+        tvc_eval.evaluate()
+        expected = tvc_eval.eval_res
+
+        def fail(*args):
+            raise AssertionError("a worker process is forked for a single shard")
+
+        monkeypatch.setattr(evaluate_tvc, "start_worker_processes", fail)
+        tvc_eval = TVRCaptionEval(pred_path, gt_path, cache_dir=cache_dir, parallel=True, meteor_pool=meteor_pool)
+        tvc_eval.evaluate()
+        assert tvc_eval.eval_res == expected
+    finally:
+        meteor_pool.close()
@@ -0,0 +1,132 @@
+import json
+import numpy as np
+import pytest
+from validate_submission import validate_caption_submission, validate_qa_submission, \
+    validate_retrieval_submission, validate_task
+
+CAPTION_GT_IDS = {1, 2}
+RETRIEVAL_GT_IDS = {10, 11}
+VIDEO_INDICES = {0, 1, 2}
+QA_GT_QID2ANS = {100: 0, 101: 3}
+
+
+def write_text(tmpdir, name, text):
+    path = str(tmpdir.join(name))
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+
+def check_errors(errors, error):
+    """error is the first message, a malformed entry may also be reported as missing"""
+    if error is None:
+        assert errors == []
+    else:
+        assert len(errors) > 0 and error in errors[0], errors
+
+
+def caption_line(clip_id, descs):
+    return json.dumps({"clip_id": clip_id, "descs": descs}) + "\n"
+
+
+def vcmr_query(desc_id, predictions):
+    return {"desc_id": desc_id, "predictions": predictions}
+
+
+VALID_VCMR = [vcmr_query(10, [[0, 1.0, 2.0, 0.5]]), vcmr_query(11, [[2, 0.0, 3.0, 0.1]])]
+
+
+@pytest.mark.parametrize("text, error", [
+    (caption_line(1, [{"desc": "a man"}]) + caption_line(2, [{"desc": "a woman"}]), None),
+    (caption_line(1, [{"desc": "a man"}]) + caption_line(2, [{"desc": "a wo"}])[:20], "not valid json"),
+    (caption_line(1, [{"desc": "a man"}]) + caption_line(2, []), "non-empty list of descs"),
+    (caption_line(1, [{"desc": "a man"}]) + caption_line(2, [{"text": "a woman"}]), "non-empty list of descs"),
+    (caption_line(1, [{"desc": "a man"}]), "missing clip_ids 2"),
+    (caption_line(1, [{"desc": "a man"}]) + caption_line(2, [{"desc": "a woman"}]) + caption_line(3, [{"desc": "a"}]),
+     "clip_ids not in the GT 3"),
+])
+def test_validate_caption_submission(tmpdir, text, error):
+    errors = validate_caption_submission(write_text(tmpdir, "pred.jsonl", text), CAPTION_GT_IDS)
+    check_errors(errors, error)
+
+
+@pytest.mark.parametrize("submission, error", [
+    ({"VCMR": VALID_VCMR}, None),
+    ({"VCMR": VALID_VCMR, "VR": [vcmr_query(10, [0, 1]), vcmr_query(11, [2])]}, None),
+    ([VALID_VCMR], "should be a dict"),
+    ({"VR": [vcmr_query(10, [0]), vcmr_query(11, [1])]}, "missing the VCMR predictions"),
+    ({"VCMR": {"10": [[0, 1.0, 2.0, 0.5]]}}, "should be a list of queries"),
+    ({"VCMR": VALID_VCMR + [{"desc_id": 12}]}, "should be {\"desc_id\": int, \"predictions\": non-empty list}"),
+    ({"VCMR": VALID_VCMR + [vcmr_query(12, [])]}, "should be {\"desc_id\": int, \"predictions\": non-empty list}"),
+    ({"VCMR": VALID_VCMR + [vcmr_query(12, [[0, 1.0]])]}, "each prediction should be"),
+    ({"VCMR": VALID_VCMR + [vcmr_query(12, [[0, float("nan"), 2.0, 0.5]])]}, "nan or inf values"),
+    ({"VCMR": VALID_VCMR + [vcmr_query(12, [[7, 1.0, 2.0, 0.5]])]}, "unknown video indices 7"),
+    ({"VCMR": VALID_VCMR[:1]}, "VCMR is missing desc_ids 11"),
+])
+def test_validate_retrieval_submission(tmpdir, submission, error):
+    path = write_text(tmpdir, "pred.json", json.dumps(submission))
+    errors = validate_retrieval_submission(path, RETRIEVAL_GT_IDS, VIDEO_INDICES, "VCMR")
+    check_errors(errors, error)
+
+
+def test_validate_truncated_retrieval_submission(tmpdir):
+    path = write_text(tmpdir, "pred.json", json.dumps({"VCMR": VALID_VCMR})[:-10])
+    errors = validate_retrieval_submission(path, RETRIEVAL_GT_IDS, VIDEO_INDICES, "VCMR")
+    assert len(errors) == 1 and "not a valid json file" in errors[0]
+
+
+@pytest.mark.parametrize("text, exact_ids, error", [
+    (json.dumps({"100": 0, "101": 3}), True, None),
+    (json.dumps({"100": 0, "101": 3, "102": 1}), False, None),
+    (json.dumps({"100": 0, "101": 3})[:-3], False, "not a valid json file"),
+    (json.dumps([0, 3]), False, "should be a dict"),
+    (json.dumps({"100": 0, "101": "x"}), False, "should have an int answer in [0, 4)"),
+    (json.dumps({"100": 0, "101": 4}), False, "should have an int answer in [0, 4)"),
+    (json.dumps({"100": 0}), False, "missing qids 101"),
+    (json.dumps({"100": 0, "101": 3, "102": 1}), True, "qids not in the GT 102"),
+])
+def test_validate_json_qa_submission(tmpdir, text, exact_ids, error):
+    path = write_text(tmpdir, "pred.json", text)
+    errors = validate_qa_submission(path, QA_GT_QID2ANS, 4, exact_ids=exact_ids)
+    check_errors(errors, error)
+
+
+@pytest.mark.parametrize("qids, scores, error", [
+    ([100, 101], np.zeros((2, 4)), None),
+    ([100, 101], np.zeros((2, 5)), "5 answer choices scored, 4 expected"),
+    ([100, 101, 101], np.zeros((3, 4)), "repeated qids"),
+    ([100, 101], [[0, 0, 0, 0], [0, np.inf, 0, 0]], "nan or inf values"),
+    ([100], np.zeros((1, 4)), "missing qids 101"),
+    ([100, 101], np.zeros((3, 4)), "not a valid score submission"),
+])
+def test_validate_npz_qa_submission(tmpdir, qids, scores, error):
+    path = str(tmpdir.join("pred.npz"))
+    np.savez(path, qid=np.array(qids), scores=np.array(scores, dtype=np.float64))
+    errors = validate_qa_submission(path, QA_GT_QID2ANS, 4)
+    check_errors(errors, error)
+
+
+def test_validate_npy_qa_submission(tmpdir):
+    path = str(tmpdir.join("pred.npy"))
+    np.save(path, np.array([100, 101], dtype=np.float64))
+    errors = validate_qa_submission(path, QA_GT_QID2ANS, 4)
+    assert len(errors) == 1 and "not a valid score submission" in errors[0]
+
+
+def test_validate_task_missing_submission_file(tmpdir):
+    truth_dir = tmpdir.mkdir("truth")
+    write_text(truth_dir, "how2qa_val_release.jsonl", json.dumps({"qid": 100, "answer_idx": 0}) + "\n")
+    errors = validate_task("how2qa", str(tmpdir.mkdir("submission")), str(truth_dir),
+                           cache_dir=str(tmpdir.join("cache")))
+    assert len(errors) == 1 and "missing val submission file" in errors[0]
+
+
+def test_validate_task_with_unwritable_cache(tmpdir):
+    truth_dir = tmpdir.mkdir("truth")
+    write_text(truth_dir, "how2qa_val_release.jsonl", json.dumps({"qid": 100, "answer_idx": 0}) + "\n")
+    submit_dir = tmpdir.mkdir("submission")
+    write_text(submit_dir, "how2qa_val_predictions.json", json.dumps({"100": 5}))
+    # a file where the cache directory should be, so that it can neither be created nor written to
+    cache_dir = write_text(tmpdir, "cache", "")
+    errors = validate_task("how2qa", str(submit_dir), str(truth_dir), cache_dir=cache_dir)
+    assert len(errors) == 1 and "should have an int answer in [0, 4)" in errors[0]
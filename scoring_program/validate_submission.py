@@ -0,0 +1,372 @@
+"""
+Check the submission files of each task before any of them is evaluated:
+- every file the evaluator reads is there and is not truncated,
+- the entries follow the task format, e.g. a non-empty "descs" list for each captioning clip,
+- the ids cover the GT ids, e.g. the clip_id / desc_id / qid sets the evaluators assert on,
+- the values are in range, e.g. the video indices of the retrieval predictions.
+So that a malformed task fails the run in seconds, not after the tasks before it are scored.
+"""
+import os
+import json
+from os.path import join
+import numpy as np
+from evaluate_tvc import CACHE_DIR, get_file_hash, load_pickle, save_pickle
+from evaluate_vlep import find_submission_path, is_array_submission, load_score_submission
+
+# the submission and GT files of each split, the first split is the only one evaluated with `val_only`,
+# same as the `file_paths` of each `eval_{task}`. The QA submissions are given without extension,
+# see `find_submission_path`.
+TASK2SPLIT_FILES = dict(
+    tvc=[("val", "tvc_val_predictions.jsonl", "tvc_val_archive.jsonl"),
+         ("test", "tvc_test_predictions.jsonl", "tvc_test_gt.jsonl")],
+    yc2c=[("val", "yc2c_val_predictions.jsonl", "yc2c_val_release.jsonl"),
+          ("test", "yc2c_test_predictions.jsonl", "yc2c_test_gt.jsonl")],
+    vatex_en_c=[("test_public", "vatex_en_c_test_public_predictions.jsonl", "vatex_en_c_test_public_release.jsonl"),
+                ("test_private", "vatex_en_c_test_private_predictions.jsonl", "vatex_en_c_test_private_gt.jsonl")],
+    tvr=[("val", "tvr_val_predictions.json", "tvr_val_archive.jsonl"),
+         ("test", "tvr_test_predictions.json", "tvr_test_gt.jsonl")],
+    how2r=[("val", "how2r_val_predictions.json", "how2r_val_1k_release.jsonl"),
+           ("test_public", "how2r_test_public_predictions.json", "how2r_test_public_1k_gt.jsonl")],
+    yc2r=[("val", "yc2r_val_predictions.json", "yc2r_val_release.jsonl"),
+          ("test", "yc2r_test_predictions.json", "yc2r_test_gt.jsonl")],
+    vatex_en_r=[("val", "vatex_en_r_val_predictions.json", "vatex_en_r_val_release.jsonl"),
+                ("test_public", "vatex_en_r_test_public_predictions.json", "vatex_en_r_test_public_gt.jsonl")],
+    how2qa=[("val", "how2qa_val_predictions", "how2qa_val_release.jsonl"),
+            ("test_public", "how2qa_test_public_predictions", "how2qa_test_public_gt.jsonl")],
+    tvqa=[("val", "tvqa_val_predictions", "tvqa_val_solution.json"),
+          ("test", "tvqa_test_predictions", "tvqa_test_solution.json")],
+    violin=[("test", "violin_test_predictions", "violin_test_release.jsonl"),
+            ("test_private", "violin_test_private_predictions", "violin_test_private_gt.jsonl")],
+    vlep=[("dev", "vlep_dev_predictions", "vlep_dev_archive.jsonl"),
+          ("test", "vlep_test_predictions", "vlep_test_archive.jsonl")],
+)
+
+# the task type submission each retrieval task is ranked by, see `evaluate.TYPE2LEADERBOARD_METRICS`
+RETRIEVAL_TASK2REQUIRED_TYPE = dict(tvr="VCMR", how2r="VCMR", yc2r="VR", vatex_en_r="VR")
+
+QA_TASKS = ["how2qa", "tvqa", "violin", "vlep"]
+
+# {task: (GT id field, GT answer field)} of the multiple choice QA tasks with .jsonl GT,
+# tvqa GT is a {"solution": {show: {qid: answer}}} .json file.
+QA_TASK2GT_FIELDS = dict(
+    how2qa=("qid", "answer_idx"),
+    violin=("example_id", "answer"),
+    vlep=("example_id", "answer"),
+)
+
+# number of answer choices of each question of the QA tasks
+QA_TASK2N_CHOICES = dict(how2qa=4, tvqa=5, violin=2, vlep=2)
+
+# QA tasks whose submission must have exactly the GT ids, the others may have extra ids
+QA_EXACT_ID_TASKS = ["how2qa", "violin"]
+
+MAX_SHOWN_ERRORS = 3  # max number of offending entries shown in each error message
+
+
+def format_ids(ids):
+    ids = sorted(ids)
+    shown = ", ".join([str(e) for e in ids[:MAX_SHOWN_ERRORS]])
+    return shown if len(ids) <= MAX_SHOWN_ERRORS else "{}, ... ({} in total)".format(shown, len(ids))
+
+
+def load_gt_ids(gt_path, name, build_func, cache_dir=CACHE_DIR):
+    """
+    Args:
+        gt_path: str, GT file
+        name: str, name of the GT data in the cache
+        build_func: callable, () -> the GT data to check the submissions against, e.g. its set of ids
+        cache_dir: str, the GT data is compiled once for each version of the GT file, and pickled there.
+            If None, or if the cache cannot be read or written, the GT data is built in memory.
+    Returns:
+        the output of build_func
+    """
+    if cache_dir is None:
+        return build_func()
+
+    cache_path = join(cache_dir, "gt_ids_{}_{}.pkl".format(name, get_file_hash(gt_path)))
+    try:
+        if os.path.exists(cache_path):
+            return load_pickle(cache_path)
+    except (IOError, OSError) as e:
+        print("Failed to read the cached GT {} at {}: {}".format(name, cache_path, e))
+    data = build_func()
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        save_pickle(data, cache_path)
+    except (IOError, OSError) as e:
+        print("Failed to cache the GT {} at {}: {}".format(name, cache_path, e))
+    return data
+
+
+def build_caption_gt_ids(gt_path):
+    with open(gt_path, "r") as f:
+        return set([json.loads(line.strip("\n"))["clip_id"] for line in f])
+
+
+def build_retrieval_gt_ids(gt_path):
+    with open(gt_path, "r") as f:
+        return set([int(json.loads(line.strip("\n"))["desc_id"]) for line in f])
+
+
+def build_qa_gt_ids(gt_path, task):
+    """{qid (int): answer (int)} of the GT"""
+    if task == "tvqa":
+        with open(gt_path, "r") as f:
+            solution = json.load(f)["solution"]
+        return {int(k): int(v) for show_solution in solution.values() for k, v in show_solution.items()}
+    id_field, answer_field = QA_TASK2GT_FIELDS[task]
+    with open(gt_path, "r") as f:
+        return {int(e[id_field]): int(e[answer_field]) for e in (json.loads(line.strip("\n")) for line in f)}
+
+
+def validate_caption_submission(submission_path, gt_ids):
+    """
+    Args:
+        submission_path: str, .jsonl captioning submission, one {"clip_id": ..., "descs": [{"desc": str}]} per line,
+            read one line at a time.
+        gt_ids: set, the GT clip_ids, the submission must have exactly these clips.
+    Returns:
+        list(str), error messages, empty if the submission is valid
+    """
+    errors = []
+    bad_lines = []
+    submission_ids = set()
+    with open(submission_path, "r") as f:
+        for line_idx, line in enumerate(f):
+            try:
+                e = json.loads(line.strip("\n"))
+            except ValueError:
+                bad_lines.append(line_idx + 1)
+                continue
+            if not isinstance(e, dict) or "clip_id" not in e or not isinstance(e.get("descs"), list) \
+                    or len(e["descs"]) == 0 \
+                    or not all(isinstance(d, dict) and isinstance(d.get("desc"), basestring) for d in e["descs"]):
+                bad_lines.append(line_idx + 1)
+                continue
+            submission_ids.add(e["clip_id"])
+    if len(bad_lines) > 0:
+        errors.append("{}: lines {} are not valid json with a clip_id and a non-empty list of descs {{\"desc\": str}}"
+                      ", is the file truncated?".format(submission_path, format_ids(bad_lines)))
+    missing_ids = gt_ids - submission_ids
+    if len(missing_ids) > 0:
+        errors.append("{}: missing clip_ids {}".format(submission_path, format_ids(missing_ids)))
+    extra_ids = submission_ids - gt_ids
+    if len(extra_ids) > 0:
+        errors.append("{}: clip_ids not in the GT {}".format(submission_path, format_ids(extra_ids)))
+    return errors
+
+
+def validate_retrieval_predictions(task_submission, task_type, video_indices):
+    """
+    Args:
+        task_submission: list(dict), the submission of task_type, see `evaluate_tvr.eval_by_task_type`
+        task_type: str, one of ["VCMR", "SVMR", "VR"]
+        video_indices: set(int), the indices of the videos of the split
+    Returns:
+        desc_ids: set(int), the desc_ids of task_submission
+        errors: list(str)
+    """
+    if not isinstance(task_submission, list):
+        return set(), ["{} should be a list of queries".format(task_type)]
+    desc_ids = set()
+    bad_queries = []
+    predictions = []
+    for query_idx, e in enumerate(task_submission):
+        try:
+            desc_id = int(e["desc_id"])
+            query_predictions = e["predictions"]
+        except (TypeError, KeyError, ValueError):
+            bad_queries.append(query_idx)
+            continue
+        if not isinstance(query_predictions, list) or len(query_predictions) == 0:
+            bad_queries.append(query_idx)
+            continue
+        desc_ids.add(desc_id)
+        # only the top 100 predictions of each query are read by the evaluation
+        predictions.extend(query_predictions[:100])
+    errors = []
+    if len(bad_queries) > 0:
+        errors.append("{}: queries {} should be {{\"desc_id\": int, \"predictions\": non-empty list}}"
+                      .format(task_type, format_ids(bad_queries)))
+    if len(predictions) == 0:
+        return desc_ids, errors
+
+    # a single array of all the predictions, [vid_name_idx, st, ed] for VCMR and SVMR, vid_name_idx for VR
+    try:
+        if task_type == "VR":
+            predictions = np.array(predictions, dtype=np.float64)
+            valid_shape = predictions.ndim == 1
+        else:
+            predictions = np.array([p[:3] for p in predictions], dtype=np.float64)
+            valid_shape = predictions.ndim == 2 and predictions.shape[1] == 3
+    except (TypeError, ValueError):
+        valid_shape = False
+    if not valid_shape:
+        errors.append("{}: each prediction should be {}".format(
+            task_type, "a video index (int)" if task_type == "VR"
+            else "[video index (int), st (float), ed (float), score (float)]"))
+        return desc_ids, errors
+
+    if not np.all(np.isfinite(predictions)):
+        errors.append("{}: predictions have nan or inf values".format(task_type))
+    video_idx = predictions if task_type == "VR" else predictions[:, 0]
+    unknown_video_idx = set(video_idx[np.isfinite(video_idx)].astype(np.int64).tolist()) - video_indices
+    if len(unknown_video_idx) > 0:
+        errors.append("{}: unknown video indices {}, see the video2dur_idx file of the split"
+                      .format(task_type, format_ids(unknown_video_idx)))
+    return desc_ids, errors
+
+
+def validate_retrieval_submission(submission_path, gt_ids, video_indices, required_task_type):
+    """
+    Args:
+        submission_path: str, .json retrieval submission {task_type: list(dict)}.
+            Loaded at once, the json module has no streaming parser.
+        gt_ids: set(int), the GT desc_ids, each submitted task type must have all of them
+        video_indices: set(int), the indices of the videos of the split
+        required_task_type: str, the task type the task is ranked by
+    Returns:
+        list(str), error messages, empty if the submission is valid
+    """
+    try:
+        with open(submission_path, "r") as f:
+            submission = json.load(f)
+    except ValueError:
+        return ["{}: not a valid json file, is it truncated?".format(submission_path)]
+    if not isinstance(submission, dict):
+        return ["{}: should be a dict {{task_type: list(dict)}}".format(submission_path)]
+    if required_task_type not in submission:
+        return ["{}: missing the {} predictions".format(submission_path, required_task_type)]
+
+    errors = []
+    for task_type in ["VCMR", "SVMR", "VR"]:
+        if task_type not in submission:
+            continue
+        desc_ids, task_errors = validate_retrieval_predictions(submission[task_type], task_type, video_indices)
+        errors.extend(["{}: {}".format(submission_path, e) for e in task_errors])
+        missing_ids = gt_ids - desc_ids
+        if len(missing_ids) > 0:
+            errors.append("{}: {} is missing desc_ids {}".format(submission_path, task_type, format_ids(missing_ids)))
+    return errors
+
+
+def validate_qa_submission(submission_path, gt_qid2ans, n_choices, exact_ids=False):
+    """
+    Args:
+        submission_path: str, .json {qid: answer (int)} submission, or .npz / .npy score submission,
+            see `evaluate_vlep.load_score_submission`
+        gt_qid2ans: dict, {qid (int): answer (int)}
+        n_choices: int, number of answer choices, answers must be in [0, n_choices)
+        exact_ids: bool, if True the submission must have exactly the GT qids, otherwise at least them
+    Returns:
+        list(str), error messages, empty if the submission is valid
+    """
+    if is_array_submission(submission_path):
+        try:
+            qids, scores = load_score_submission(submission_path)
+        except (AssertionError, IOError, KeyError, ValueError) as e:
+            return ["{}: not a valid score submission, {}".format(submission_path, e)]
+        errors = []
+        if len(set(qids.tolist())) != len(qids):
+            errors.append("{}: repeated qids".format(submission_path))
+        if not np.all(np.isfinite(scores)):
+            errors.append("{}: scores have nan or inf values".format(submission_path))
+        if scores.shape[1] != n_choices:
+            errors.append("{}: {} answer choices scored, {} expected"
+                          .format(submission_path, scores.shape[1], n_choices))
+        submission_qids = set(qids.tolist())
+    else:
+        try:
+            with open(submission_path, "r") as f:
+                submission = json.load(f)
+        except ValueError:
+            return ["{}: not a valid json file, is it truncated?".format(submission_path)]
+        if not isinstance(submission, dict):
+            return ["{}: should be a dict {{qid: answer (int)}}".format(submission_path)]
+        errors = []
+        submission_qids = set()
+        bad_qids = []
+        for k, v in submission.items():
+            try:
+                qid, answer = int(k), int(v)
+            except (TypeError, ValueError):
+                bad_qids.append(k)
+                continue
+            if not 0 <= answer < n_choices:
+                bad_qids.append(k)
+            submission_qids.add(qid)
+        if len(bad_qids) > 0:
+            errors.append("{}: qids {} should have an int answer in [0, {})"
+                          .format(submission_path, format_ids(bad_qids), n_choices))
+
+    gt_qids = set(gt_qid2ans.keys())
+    missing_qids = gt_qids - submission_qids
+    if len(missing_qids) > 0:
+        errors.append("{}: missing qids {}".format(submission_path, format_ids(missing_qids)))
+    extra_qids = submission_qids - gt_qids
+    if exact_ids and len(extra_qids) > 0:
+        errors.append("{}: qids not in the GT {}".format(submission_path, format_ids(extra_qids)))
+    return errors
+
+
+def validate_task(task, submit_dir, truth_dir, val_only=True, cache_dir=CACHE_DIR):
+    """
+    Args:
+        task: str, one of the keys of TASK2SPLIT_FILES
+        submit_dir: str, the submission directory of the task
+        truth_dir: str, the GT directory of the task
+        val_only: bool, if True only check the split evaluated with `val_only`, see TASK2SPLIT_FILES
+        cache_dir: str, see `load_gt_ids`
+    Returns:
+        list(str), error messages, empty if all the submission files of the task are valid
+    """
+    split_files = TASK2SPLIT_FILES[task][:1] if val_only else TASK2SPLIT_FILES[task]
+    if task in RETRIEVAL_TASK2REQUIRED_TYPE:
+        with open(join(truth_dir, "{}_video2dur_idx.json".format(task)), "r") as f:
+            video2dur_idx = json.load(f)
+
+    errors = []
+    for split_name, submission_name, gt_name in split_files:
+        gt_path = join(truth_dir, gt_name)
+        if task in QA_TASKS:
+            submission_path = find_submission_path(submit_dir, submission_name)
+        else:
+            submission_path = join(submit_dir, submission_name)
+        if not os.path.exists(submission_path):
+            errors.append("{}: missing {} submission file".format(submission_path, split_name))
+            continue
+
+        if task in RETRIEVAL_TASK2REQUIRED_TYPE:
+            gt_ids = load_gt_ids(gt_path, "desc_ids", lambda: build_retrieval_gt_ids(gt_path), cache_dir=cache_dir)
+            video_indices = set([v[1] for v in video2dur_idx[split_name].values()])
+            errors.extend(validate_retrieval_submission(
+                submission_path, gt_ids, video_indices, RETRIEVAL_TASK2REQUIRED_TYPE[task]))
+        elif task in QA_TASKS:
+            gt_qid2ans = load_gt_ids(gt_path, "qid2ans", lambda: build_qa_gt_ids(gt_path, task), cache_dir=cache_dir)
+            errors.extend(validate_qa_submission(submission_path, gt_qid2ans, QA_TASK2N_CHOICES[task],
+                                                exact_ids=task in QA_EXACT_ID_TASKS))
+        else:
+            gt_ids = load_gt_ids(gt_path, "clip_ids", lambda: build_caption_gt_ids(gt_path), cache_dir=cache_dir)
+            errors.extend(validate_caption_submission(submission_path, gt_ids))
+    return errors
+
+
+def validate_submission(submit_dir, truth_dir, tasks, val_only=True, cache_dir=CACHE_DIR):
+    """
+    Args:
+        submit_dir: str, contains a submission directory for each task, see `evaluate.eval_main`
+        truth_dir: str, contains a GT directory for each task
+        tasks: list(str), the submitted tasks
+        val_only: bool, see `validate_task`
+        cache_dir: str, see `load_gt_ids`
+    Returns:
+        dict, {task: list(str) error messages} of the tasks with invalid submission files
+    """
+    task2errors = {}
+    for task in tasks:
+        errors = validate_task(task, join(submit_dir, task), join(truth_dir, task),
+                               val_only=val_only, cache_dir=cache_dir)
+        if len(errors) > 0:
+            task2errors[task] = errors
+    return task2errors